@@ -0,0 +1,130 @@
+"""Reader for the shared memory audio tap published by AudioMonitor.publish.
+
+Any number of processes can read the same capture, each with its own cursor.
+Only numpy is needed, not PulseAudio:
+
+    reader = AudioTapReader("main")
+    while True:
+        data = reader.read(512 * reader.channels)
+"""
+import mmap
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"PATAP01\0"
+DATA_OFFSET = 64
+# magic, rate, channels, sample_size, reserved, capacity
+HEADER_FORMAT = "<8sIIIIQ"
+WRITE_SEQ_OFFSET = 32
+MAX_WRITE_OFFSET = 40
+
+
+class AudioTapReader:
+    def __init__(self, name, from_start=False):
+        """
+        name: segment name given to AudioMonitor.publish
+        from_start: start at the oldest sample still in the ring instead of
+            the newest one
+        """
+        fd = os.open(os.path.join("/dev/shm", name), os.O_RDONLY)
+        try:
+            self._mm = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+        magic, self.rate, self.channels, sample_size, _, self.capacity = (
+            struct.unpack_from(HEADER_FORMAT, self._mm)
+        )
+        if magic != MAGIC:
+            raise ValueError(f"{name} is not an audio tap segment")
+        if sample_size != 2:
+            raise ValueError(f"unsupported sample size {sample_size}")
+
+        self._write_seq = np.frombuffer(
+            self._mm, dtype=np.uint64, count=1, offset=WRITE_SEQ_OFFSET
+        )
+        self._max_write = np.frombuffer(
+            self._mm, dtype=np.uint64, count=1, offset=MAX_WRITE_OFFSET
+        )
+        self._data = np.frombuffer(
+            self._mm, dtype=np.int16, count=self.capacity, offset=DATA_OFFSET
+        )
+
+        seq = self.write_seq
+        self.cursor = max(seq - self.capacity, 0) if from_start else seq
+        self.overruns = 0
+        self.lost_samples = 0
+
+    @property
+    def write_seq(self):
+        """Total number of samples the monitor has written."""
+        return int(self._write_seq[0])
+
+    def available(self):
+        return self.write_seq - self.cursor
+
+    def oldest_safe(self):
+        """Oldest sample position the monitor can not be overwriting. It
+        copies samples in before publishing write_seq, so a write in progress
+        reaches up to the largest write so far past it."""
+        oldest = self.write_seq + int(self._max_write[0]) - self.capacity
+        # whole frames
+        return oldest + (-oldest) % self.channels
+
+    def read(self, n_samples=None, copy=True):
+        """Read up to n_samples (all channels counted) past the cursor.
+
+        Falling behind the oldest safe sample skips ahead to it and counts an
+        overrun. A copy is checked again once made: samples the monitor may
+        have been overwriting meanwhile are dropped from its start, so it can
+        come back shorter than available() said, but never torn.
+
+        With copy=False the result is a read-only view into the ring whenever
+        it does not wrap around. Views are not checked: one is only intact
+        while oldest_safe() has not passed its first sample, i.e. until the
+        monitor has written about `capacity` more samples.
+        """
+        oldest = self.oldest_safe()
+        if self.cursor < oldest:
+            self.overruns += 1
+            self.lost_samples += oldest - self.cursor
+            self.cursor = oldest
+
+        n = self.write_seq - self.cursor
+        if n_samples is not None:
+            n = min(n, n_samples)
+        n -= n % self.channels
+
+        start = self.cursor % self.capacity
+        if start + n <= self.capacity:
+            data = self._data[start : start + n]
+            if copy:
+                data = data.copy()
+        else:
+            data = np.concatenate(
+                (self._data[start:], self._data[: start + n - self.capacity])
+            )
+            copy = True
+
+        # the writer may have lapped us while we were copying
+        torn = min(self.oldest_safe() - self.cursor, n) if copy else 0
+        if torn > 0:
+            self.overruns += 1
+            self.lost_samples += torn
+            data = data[torn:]
+        self.cursor += n
+        return data
+
+    def close(self):
+        self._write_seq = None
+        self._max_write = None
+        self._data = None
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
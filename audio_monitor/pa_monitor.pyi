@@ -1,15 +1,100 @@
 import numpy as np
 
+MAX_FEATURE_BANDS: int
+
 class AudioMonitor:
     def __init__(
-        self, monitored_stream_name: str, delay_seconds: float = 0.1
+        self,
+        monitored_stream_name: str,
+        delay_seconds: float = 0.1,
+        fragment_seconds: float = 0.01,
     ) -> None: ...
     """
     monitored_stream_name: str
-    delay_seconds: float = 0.1. now this parameter is not used, and the delay effect 
-        is achieved by the internal delay of the virtual sink and the playback sink.
+    delay_seconds: float = 0.1. target delay between capturing the audio and
+        playing it back on the monitored sink. The playback queue is held at
+        this length, so it is also the time the consumer has to react.
+    fragment_seconds: float = 0.01. target capture fragment size. Smaller
+        fragments lower the capture latency at the cost of more wakeups.
     """
     def run(self) -> None: ...
+    @property
+    def ready(self) -> bool: ...
+    """Whether the streams are connected and audio is flowing into the queue."""
+    def wait_ready(self, timeout: float = -1.0) -> bool: ...
+    """
+    Block (without holding the GIL) until the monitor is ready. Returns False
+    if timeout seconds pass first, a negative timeout waits forever. Raises
+    RuntimeError if startup failed.
+    """
+    def startup_timings(self) -> dict[str, float]: ...
+    """Seconds since run() at which each completed startup step finished."""
     def stop(self) -> None: ...
     def get_data(self, n_samples: int) -> np.ndarray: ...
     def queue_length(self) -> int: ...
+    def reroute_count(self) -> int: ...
+    """
+    Number of sink inputs moved to the virtual sink after startup. Every
+    input that appears on the monitored sink, or is moved back to it, is
+    rerouted on the fly without interrupting the capture.
+    """
+    def sink_inputs(self) -> list[int]: ...
+    """Indices of the sink inputs currently routed through the virtual sink.
+    The newest one's volume sets the normalization."""
+    def silence_seconds(self) -> float: ...
+    """
+    Seconds of audio captured since the last capture fragment whose RMS was
+    above the silence threshold, 0 while sound is playing. Measured on the
+    capture thread after volume normalization, so it is free to poll.
+    """
+    def rms(self) -> float: ...
+    """RMS of the last capture fragment, full scale = 1."""
+    def set_silence_threshold(self, rms: float) -> None: ...
+    """RMS (full scale = 1) at or below which a fragment counts as silent,
+    1e-3 (about -60 dBFS) by default."""
+    def latency(self) -> dict[str, float]: ...
+    """
+    Latencies in seconds reported by the server:
+    record: capture stream latency.
+    playback: playback stream latency, i.e. the actual audio delay.
+    queued: audio captured but not yet read with get_data.
+    target_delay: the requested delay_seconds.
+    budget: playback - queued, the time left before the oldest unread sample
+        becomes audible.
+    flushes: number of times the playback queue was flushed after growing
+        past twice the target delay.
+    """
+    def publish(self, name: str, capacity_seconds: float = 5.0) -> None: ...
+    """
+    Mirror the captured audio into the named POSIX shared memory segment
+    /dev/shm/<name>, a ring of capacity_seconds of interleaved samples with a
+    monotonic write sequence. Read it from any process with
+    audio_tap.AudioTapReader. get_data keeps working independently. Raises
+    RuntimeError once the monitor has been stopped.
+    """
+    def enable_features(
+        self,
+        hop_length: int = 512,
+        bands: list[tuple[float, float]] = [
+            (30, 120),
+            (120, 500),
+            (500, 2000),
+            (2000, 8000),
+        ],
+        capacity: int = 1024,
+    ) -> None: ...
+    """
+    Compute per-hop features on the capture thread as audio arrives: RMS and
+    peak of the mono downmix and the mean power in each (low, high) Hz band,
+    using one band-pass biquad per band (at most MAX_FEATURE_BANDS). At most
+    capacity records are kept, the oldest are dropped first. Raises
+    RuntimeError once the monitor has been stopped.
+    """
+    def get_features(self) -> np.ndarray: ...
+    """
+    Pop the pending feature records as a structured array with fields
+    hop (uint64), time (float64, seconds of audio since capture started),
+    rms (float32), peak (float32) and bands (float32, MAX_FEATURE_BANDS).
+    Returns an empty array if enable_features was not called, or once the
+    monitor has been stopped.
+    """
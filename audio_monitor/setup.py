@@ -124,6 +124,7 @@ setup(
     description="Python bindings for monitoring PulseAudio streams. Based on libpulse (c++) and pybind11.",
     long_description="",
     ext_modules=[CMakeExtension("pa_monitor", sourcedir=".")],
+    py_modules=["audio_tap"],
     cmdclass={"build_ext": CMakeBuild},
     package_data={"": ["*.pyi"]},
     zip_safe=False,
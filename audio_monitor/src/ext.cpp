@@ -8,15 +8,64 @@
 namespace py = pybind11;
 
 PYBIND11_MODULE(pa_monitor, m) {
+    PYBIND11_NUMPY_DTYPE(FeatureRecord, hop, time, rms, peak, bands);
+    m.attr("MAX_FEATURE_BANDS") = MAX_FEATURE_BANDS;
+
     py::class_<PulseAudioMonitor>(m, "AudioMonitor")
-        .def(py::init<const std::string &, float>(),
-             py::arg("monitored_stream_name"), py::arg("delay_seconds") = 0.1)
+        .def(py::init<const std::string &, float, float>(),
+             py::arg("monitored_stream_name"), py::arg("delay_seconds") = 0.1,
+             py::arg("fragment_seconds") = 0.01)
         .def("run", &PulseAudioMonitor::run)
+        .def_property_readonly("ready", &PulseAudioMonitor::ready)
+        .def("wait_ready", &PulseAudioMonitor::wait_ready,
+             py::arg("timeout") = -1.0,
+             py::call_guard<py::gil_scoped_release>())
+        .def("startup_timings",
+             [](PulseAudioMonitor &self) {
+                 py::dict d;
+                 for (const auto &step : self.startup_timings())
+                     d[py::str(step.first)] = step.second;
+                 return d;
+             })
         .def("stop", &PulseAudioMonitor::stop)
         .def("get_data", [](PulseAudioMonitor &self, int n_samples) {
             std::vector<DataType> data;
             self.get_data(n_samples, data);
             return py::array_t<DataType>(data.size(), data.data());
         })
-        .def("queue_length", &PulseAudioMonitor::queue_length);
+        .def("queue_length", &PulseAudioMonitor::queue_length)
+        .def("reroute_count", &PulseAudioMonitor::reroute_count)
+        .def("sink_inputs", &PulseAudioMonitor::sink_inputs)
+        .def("silence_seconds", &PulseAudioMonitor::silence_seconds)
+        .def("rms", &PulseAudioMonitor::rms)
+        .def("set_silence_threshold", &PulseAudioMonitor::set_silence_threshold,
+             py::arg("rms"))
+        .def("enable_features", &PulseAudioMonitor::enable_features,
+             py::arg("hop_length") = 512,
+             py::arg("bands") =
+                 std::vector<std::pair<float, float>>{{30, 120},
+                                                      {120, 500},
+                                                      {500, 2000},
+                                                      {2000, 8000}},
+             py::arg("capacity") = 1024)
+        .def("publish", &PulseAudioMonitor::publish, py::arg("name"),
+             py::arg("capacity_seconds") = 5.0)
+        .def("get_features",
+             [](PulseAudioMonitor &self) {
+                 std::vector<FeatureRecord> records;
+                 self.get_features(records);
+                 return py::array_t<FeatureRecord>(records.size(),
+                                                   records.data());
+             })
+        .def("latency", [](PulseAudioMonitor &self) {
+            auto info = self.latency();
+            py::dict d;
+            d["record"] = info.record_seconds;
+            d["playback"] = info.playback_seconds;
+            d["queued"] = info.queued_seconds;
+            d["target_delay"] = info.target_delay_seconds;
+            d["budget"] = info.budget_seconds;
+            d["flushes"] = info.playback_flushes;
+            return d;
+        });
 }
@@ -0,0 +1,212 @@
+#pragma once
+
+#include <atomic>
+#include <cmath>
+#include <cstddef>
+#include <cstdint>
+#include <deque>
+#include <limits>
+#include <mutex>
+#include <stdexcept>
+#include <string>
+#include <utility>
+#include <vector>
+
+/**
+ * @brief Per-hop features computed on the capture thread. Fixed size so it can
+ * be handed to Python as a structured numpy array.
+ */
+constexpr int MAX_FEATURE_BANDS = 8;
+
+struct FeatureRecord {
+    uint64_t hop;  // index of the hop since capture started
+    double time;   // seconds of audio captured at the end of the hop
+    float rms;     // of the mono downmix, full scale = 1
+    float peak;    // absolute peak of the mono downmix
+    float bands[MAX_FEATURE_BANDS]; // mean power per band, unused bands are 0
+};
+
+/**
+ * @brief RBJ band-pass biquad (0 dB peak gain) in transposed direct form II.
+ */
+class Biquad {
+  public:
+    Biquad(double rate, double low_hz, double high_hz) {
+        double f0 = std::sqrt(low_hz * high_hz);
+        double q = f0 / (high_hz - low_hz);
+        double w0 = 2 * M_PI * f0 / rate;
+        double alpha = std::sin(w0) / (2 * q);
+        double a0 = 1 + alpha;
+        b0 = alpha / a0;
+        b2 = -alpha / a0;
+        a1 = -2 * std::cos(w0) / a0;
+        a2 = (1 - alpha) / a0;
+    }
+
+    float process(float x) {
+        float y = b0 * x + z1;
+        z1 = -a1 * y + z2;
+        z2 = b2 * x - a2 * y;
+        return y;
+    }
+
+  private:
+    // b1 is always 0 for a band-pass
+    float b0, b2, a1, a2;
+    float z1 = 0, z2 = 0;
+};
+
+/**
+ * @brief Downmix interleaved audio to mono, accumulate RMS, peak and band
+ * energies over each hop and queue one FeatureRecord per completed hop.
+ * process() runs on the mainloop thread, pop() on the consumer thread.
+ */
+template <typename T> class FeatureExtractor {
+  public:
+    FeatureExtractor(int rate, int channels, std::size_t hop_length,
+                     const std::vector<std::pair<float, float>> &bands,
+                     std::size_t capacity)
+        : rate(rate), channels(channels), hop_length(hop_length),
+          capacity(capacity) {
+        if (hop_length == 0 || capacity == 0)
+            throw std::invalid_argument(
+                "hop_length and capacity should be positive");
+        if (bands.size() > MAX_FEATURE_BANDS)
+            throw std::invalid_argument("at most " +
+                                        std::to_string(MAX_FEATURE_BANDS) +
+                                        " bands are supported");
+        for (const auto &band : bands) {
+            if (!(0 < band.first && band.first < band.second &&
+                  band.second < rate / 2.0))
+                throw std::invalid_argument(
+                    "bands should be (low, high) with 0 < low < high < "
+                    "rate / 2");
+            filters.emplace_back(rate, band.first, band.second);
+        }
+        reset_accumulators();
+    }
+
+    void process(const T *interleaved, std::size_t n_frames) {
+        const float scale =
+            1.0f / (channels * (float)std::numeric_limits<T>::max());
+        const std::size_t n_bands = filters.size();
+        for (std::size_t i = 0; i < n_frames; i++) {
+            float x = 0;
+            for (int c = 0; c < channels; c++)
+                x += interleaved[i * channels + c];
+            x *= scale;
+
+            sum_squares += x * x;
+            float magnitude = std::fabs(x);
+            peak = magnitude > peak ? magnitude : peak;
+            for (std::size_t b = 0; b < n_bands; b++) {
+                float y = filters[b].process(x);
+                band_squares[b] += y * y;
+            }
+
+            if (++hop_fill == hop_length)
+                emit();
+        }
+    }
+
+    void pop(std::vector<FeatureRecord> &out) {
+        std::lock_guard<std::mutex> lock(mutex);
+        out.insert(out.end(), records.begin(), records.end());
+        records.erase(records.begin(), records.end());
+    }
+
+    std::size_t pending() {
+        std::lock_guard<std::mutex> lock(mutex);
+        return records.size();
+    }
+
+  private:
+    void emit() {
+        FeatureRecord record{};
+        record.hop = hop_count;
+        record.time = (double)(hop_count + 1) * hop_length / rate;
+        record.rms = std::sqrt(sum_squares / hop_length);
+        record.peak = peak;
+        for (std::size_t b = 0; b < filters.size(); b++)
+            record.bands[b] = band_squares[b] / hop_length;
+        hop_count++;
+        reset_accumulators();
+
+        std::lock_guard<std::mutex> lock(mutex);
+        // drop the oldest records if the consumer falls behind
+        if (records.size() == capacity)
+            records.pop_front();
+        records.push_back(record);
+    }
+
+    void reset_accumulators() {
+        hop_fill = 0;
+        sum_squares = 0;
+        peak = 0;
+        for (auto &e : band_squares)
+            e = 0;
+    }
+
+    const int rate;
+    const int channels;
+    const std::size_t hop_length;
+    std::vector<Biquad> filters;
+
+    std::size_t hop_fill = 0;
+    uint64_t hop_count = 0;
+    float sum_squares = 0;
+    float peak = 0;
+    float band_squares[MAX_FEATURE_BANDS];
+
+    std::mutex mutex;
+    const std::size_t capacity;
+    std::deque<FeatureRecord> records;
+};
+
+/**
+ * @brief Tracks how long the captured audio has stayed below an RMS threshold,
+ * one fragment at a time. process() runs on the mainloop thread, the other
+ * methods from any thread.
+ */
+template <typename T> class SilenceDetector {
+  public:
+    SilenceDetector(int rate, int channels, float threshold)
+        : rate(rate), channels(channels), threshold(threshold) {}
+
+    void process(const T *interleaved, std::size_t n_samples) {
+        if (n_samples == 0)
+            return;
+        // a plain sum of squares, vectorised, no downmix or filtering
+        float sum_squares = 0;
+        for (std::size_t i = 0; i < n_samples; i++) {
+            float x = interleaved[i];
+            sum_squares += x * x;
+        }
+        float rms = std::sqrt(sum_squares / n_samples) /
+                    (float)std::numeric_limits<T>::max();
+        last_rms.store(rms, std::memory_order_relaxed);
+        if (rms > threshold.load(std::memory_order_relaxed))
+            silent_frames.store(0, std::memory_order_relaxed);
+        else
+            silent_frames.fetch_add(n_samples / channels,
+                                    std::memory_order_relaxed);
+    }
+
+    void set_threshold(float rms) {
+        threshold.store(rms, std::memory_order_relaxed);
+    }
+
+    // seconds of audio captured since the last fragment above the threshold
+    double silent_seconds() const {
+        return (double)silent_frames.load(std::memory_order_relaxed) / rate;
+    }
+
+    float rms() const { return last_rms.load(std::memory_order_relaxed); }
+
+  private:
+    const int rate;
+    const int channels;
+    std::atomic<float> threshold;
+    std::atomic<float> last_rms{0};
+    std::atomic<uint64_t> silent_frames{0};
+};
@@ -1,24 +1,31 @@
+#include <algorithm>
+#include <chrono>
 #include <cstddef>
 #include <ctime>
 #include <deque>
 #include <fstream>
+#include <future>
 #include <iostream>
+#include <limits>
+#include <memory>
+#include <mutex>
 #include <pulse/pulseaudio.h>
 #include <random>
+#include <stdexcept>
 #include <string>
 #include <thread>
+#include <utility>
 #include <vector>
 
+#include "feature_extractor.hpp"
+#include "shm_tap.hpp"
+
 /**
  * @brief Given a sink to be monitored, create a virtual sink, to redirect its
  * sink input to, record from the virtual sink and then route back to the
  * original sink with desired delay.
- * @todo use poll based read from the recording stream to implement active
- * control of the delay time.
  * @todo handle destroy the virtual sink and redirect the sink input back to
  * original sink
- * @todo use semaphor variable instead of a chain to initiate the sinks and
- * streams.
  */
 #define S16LE
 // #define U8
@@ -50,6 +57,9 @@ template <typename T> class FixedDeque {
     void insert(typename std::deque<T>::iterator dst, const T *begin,
                 const T *end) {
         dq_.insert(dst, begin, end);
+        if (dq_.size() > max_size_) {
+            dq_.erase(dq_.begin(), dq_.begin() + (dq_.size() - max_size_));
+        }
     }
 
     typename std::deque<T>::iterator begin() { return dq_.begin(); }
@@ -85,6 +95,23 @@ std::string generateRandomString(size_t length) {
 const int RATE = 44100;
 const int CHANNELS = 2;
 
+/**
+ * @brief Scale `n` samples from `src` into `dst`, saturating at the limits of
+ * DataType. Written as a branch-free loop over contiguous memory so the
+ * compiler can vectorise it.
+ */
+inline void normalize_samples(const DataType *src, DataType *dst, std::size_t n,
+                              float factor) {
+    constexpr float lo = std::numeric_limits<DataType>::min();
+    constexpr float hi = std::numeric_limits<DataType>::max();
+    for (std::size_t i = 0; i < n; i++) {
+        float v = static_cast<float>(src[i]) * factor;
+        v = v < lo ? lo : v;
+        v = v > hi ? hi : v;
+        dst[i] = static_cast<DataType>(v);
+    }
+}
+
 /**
  * @todo support dynamically change the monitored source device when the default
  * source is changed
@@ -92,9 +119,17 @@ const int CHANNELS = 2;
 class PulseAudioMonitor {
   public:
     PulseAudioMonitor(const std::string &monitored_source_name,
-                      float delay_seconds = 0.1)
+                      float delay_seconds = 0.1, float fragment_seconds = 0.01)
         : monitored_source_name(monitored_source_name),
-          delay_bytes(delay_seconds * RATE * CHANNELS * sizeof(DataType)) {
+          delay_bytes(delay_seconds * RATE * CHANNELS * sizeof(DataType)),
+          fragment_bytes(fragment_seconds * RATE * CHANNELS *
+                         sizeof(DataType)) {
+        // keep both sizes aligned to whole frames
+        delay_bytes -= delay_bytes % (CHANNELS * sizeof(DataType));
+        fragment_bytes -= fragment_bytes % (CHANNELS * sizeof(DataType));
+        if (fragment_bytes == 0)
+            fragment_bytes = CHANNELS * sizeof(DataType);
+
         if (this->monitored_source_name.find(".monitor") != std::string::npos) {
             this->sink_name = this->monitored_source_name;
             this->sink_name.erase(sink_name.find(".monitor"));
@@ -134,12 +169,47 @@ class PulseAudioMonitor {
 
     ~PulseAudioMonitor() { stop(); };
 
-    void run() { pa_threaded_mainloop_start(mainloop); }
+    void run() {
+        run_start = std::chrono::steady_clock::now();
+        pa_threaded_mainloop_start(mainloop);
+    }
+
+    bool ready() {
+        return ready_future.wait_for(std::chrono::seconds(0)) ==
+               std::future_status::ready;
+    }
+
+    /**
+     * @brief Block until the streams are connected and the sink input has been
+     * moved, or until timeout_seconds elapse (negative waits forever).
+     * @return whether the monitor is ready. Throws if startup failed.
+     */
+    bool wait_ready(double timeout_seconds) {
+        if (timeout_seconds < 0) {
+            ready_future.wait();
+        } else if (ready_future.wait_for(std::chrono::duration<double>(
+                       timeout_seconds)) != std::future_status::ready) {
+            return false;
+        }
+        ready_future.get();
+        return true;
+    }
+
+    /**
+     * @brief Startup steps completed so far, with the time in seconds since
+     * run() at which each of them finished.
+     */
+    std::vector<std::pair<std::string, double>> startup_timings() {
+        std::lock_guard<std::mutex> lock(startup_mutex);
+        return startup_steps;
+    }
 
     void stop() {
         if (!mainloop)
             return;
         pa_threaded_mainloop_lock(mainloop);
+        // the moves back below must not be rerouted
+        stopping = true;
 
         // destroy streams
         std::cout << "Destroying streams..." << std::endl;
@@ -156,32 +226,23 @@ class PulseAudioMonitor {
 
         if (context) {
             pa_operation *op;
-            if (sink_input_idx != PA_INVALID_INDEX) {
-                std::cout << "Redirecting sink input back to original sink..."
+            if (!routed_sink_inputs.empty()) {
+                std::cout << "Redirecting " << routed_sink_inputs.size()
+                          << " sink inputs back to original sink..."
                           << std::endl;
-                op = pa_context_move_sink_input_by_index(
-                    context, sink_input_idx, sink_idx,
-                    &PulseAudioMonitor::redirect_sink_input_cb, this);
-                // std::cout << "Waiting for operations to complete..."
-                //   << std::endl;
-                while (true) {
-                    pa_operation_state_t state = pa_operation_get_state(op);
-                    if (state == PA_OPERATION_RUNNING) {
-                        // Operation is still running, wait a bit
-                        // std::cout << "yield conttrol..." << std::endl;
-                        pa_threaded_mainloop_wait(mainloop);
-                    } else if (state == PA_OPERATION_DONE) {
-                        // Operation completed successfully
-                        // std::cout << "Operation completed." << std::endl;
-                        pa_operation_unref(op);
-                        break;
-                    } else {
-                        // Operation failed
-                        std::cerr << "Operation failed" << std::endl;
-                        pa_operation_unref(op);
-                        break;
-                    }
+                // issue every move before waiting for any of them
+                std::vector<pa_operation *> ops;
+                for (uint32_t index : routed_sink_inputs) {
+                    op = pa_context_move_sink_input_by_index(
+                        context, index, sink_idx,
+                        &PulseAudioMonitor::redirect_sink_input_cb, this);
+                    if (op)
+                        ops.push_back(op);
                 }
+                routed_sink_inputs.clear();
+                sink_input_idx = PA_INVALID_INDEX;
+                for (pa_operation *move_op : ops)
+                    wait_operation(move_op);
             }
 
             if (virtual_sink_module_idx != PA_INVALID_INDEX) {
@@ -190,26 +251,8 @@ class PulseAudioMonitor {
                     context, virtual_sink_module_idx,
                     &PulseAudioMonitor::unload_module_cb, this);
                 virtual_sink_module_idx = PA_INVALID_INDEX;
-                // std::cout << "Waiting for operations to complete..."
-                //   << std::endl;
-                while (true) {
-                    pa_operation_state_t state = pa_operation_get_state(op);
-                    if (state == PA_OPERATION_RUNNING) {
-                        // Operation is still running, wait a bit
-                        // std::cout << "yield conttrol..." << std::endl;
-                        pa_threaded_mainloop_wait(mainloop);
-                    } else if (state == PA_OPERATION_DONE) {
-                        // Operation completed successfully
-                        // std::cout << "Operations completed." << std::endl;
-                        pa_operation_unref(op);
-                        break;
-                    } else {
-                        // Operation failed
-                        std::cerr << "Operation failed" << std::endl;
-                        pa_operation_unref(op);
-                        break;
-                    }
-                }
+                if (op)
+                    wait_operation(op);
             }
 
             std::cout << "Disconnecting context..." << std::endl;
@@ -224,6 +267,18 @@ class PulseAudioMonitor {
         mainloop = nullptr;
     }
 
+    /**
+     * @brief Wait for op to finish, the mainloop lock held, and unref it.
+     * Its callback has to signal the mainloop.
+     */
+    void wait_operation(pa_operation *op) {
+        while (pa_operation_get_state(op) == PA_OPERATION_RUNNING)
+            pa_threaded_mainloop_wait(mainloop);
+        if (pa_operation_get_state(op) != PA_OPERATION_DONE)
+            std::cerr << "Operation failed" << std::endl;
+        pa_operation_unref(op);
+    }
+
     static void unload_module_cb(pa_context *c, int success, void *userdata) {
         std::cout << "unload_module_cb" << std::endl;
         auto monitor = static_cast<PulseAudioMonitor *>(userdata);
@@ -256,17 +311,144 @@ class PulseAudioMonitor {
          * @param data: the data to be retrieved, data shape: (length,
          * channels)
          *
+         * Called from Python while the capture thread appends to data_queue,
+         * so the queue is only touched under the mainloop lock. Without a
+         * mainloop there is no capture thread left to race with.
          */
-        if (data_queue.size() < length * CHANNELS) {
-            return;
+        pa_threaded_mainloop *loop = mainloop;
+        if (loop)
+            pa_threaded_mainloop_lock(loop);
+        if (data_queue.size() >= length * CHANNELS) {
+            data.insert(data.end(), data_queue.begin(),
+                        data_queue.begin() + length * CHANNELS);
+            data_queue.erase(data_queue.begin(),
+                             data_queue.begin() + length * CHANNELS);
         }
-        data.insert(data.end(), data_queue.begin(),
-                    data_queue.begin() + length * CHANNELS);
-        data_queue.erase(data_queue.begin(),
-                         data_queue.begin() + length * CHANNELS);
+        if (loop)
+            pa_threaded_mainloop_unlock(loop);
+    }
+
+    std::size_t queue_length() {
+        if (!mainloop)
+            return data_queue.size();
+        pa_threaded_mainloop_lock(mainloop);
+        std::size_t length = data_queue.size();
+        pa_threaded_mainloop_unlock(mainloop);
+        return length;
+    }
+
+    /**
+     * @brief Compute per-hop features (RMS, peak, band energies of the mono
+     * downmix) on the capture thread as audio arrives.
+     * @param hop_length: samples per hop, per channel
+     * @param bands: (low, high) edges in Hz of up to MAX_FEATURE_BANDS
+     * band-pass filters
+     * @param capacity: number of records kept before the oldest are dropped
+     */
+    void enable_features(std::size_t hop_length,
+                         const std::vector<std::pair<float, float>> &bands,
+                         std::size_t capacity) {
+        if (!mainloop)
+            throw std::runtime_error("enable_features after stop()");
+        auto extractor = std::make_shared<FeatureExtractor<DataType>>(
+            RATE, CHANNELS, hop_length, bands, capacity);
+        pa_threaded_mainloop_lock(mainloop);
+        features = extractor;
+        pa_threaded_mainloop_unlock(mainloop);
+    }
+
+    /**
+     * @brief Mirror the captured audio into a named shared memory ring that
+     * any process can read with audio_tap.AudioTapReader.
+     * @param name: segment name, without the leading slash
+     * @param capacity_seconds: length of the ring
+     */
+    void publish(const std::string &name, float capacity_seconds) {
+        if (!mainloop)
+            throw std::runtime_error("publish after stop()");
+        auto new_tap = std::make_shared<SharedMemoryTap<DataType>>(
+            name, RATE, CHANNELS,
+            (std::size_t)(capacity_seconds * RATE) * CHANNELS);
+        pa_threaded_mainloop_lock(mainloop);
+        tap = new_tap;
+        pa_threaded_mainloop_unlock(mainloop);
+    }
+
+    /**
+     * @brief Seconds of captured audio since the last fragment whose RMS
+     * (after volume normalization, full scale = 1) was above the silence
+     * threshold. Drops back to 0 with the first fragment of sound.
+     */
+    double silence_seconds() { return silence.silent_seconds(); }
+
+    // RMS of the last captured fragment
+    float rms() { return silence.rms(); }
+
+    void set_silence_threshold(float rms) { silence.set_threshold(rms); }
+
+    void get_features(std::vector<FeatureRecord> &records) {
+        if (!mainloop)
+            return;
+        pa_threaded_mainloop_lock(mainloop);
+        auto extractor = features;
+        pa_threaded_mainloop_unlock(mainloop);
+        if (extractor)
+            extractor->pop(records);
+    }
+
+    /**
+     * @brief Number of sink inputs moved to the virtual sink after startup,
+     * as they appeared on (or were moved back to) the monitored sink.
+     */
+    std::size_t reroute_count() {
+        if (!mainloop)
+            return reroutes;
+        pa_threaded_mainloop_lock(mainloop);
+        std::size_t count = reroutes;
+        pa_threaded_mainloop_unlock(mainloop);
+        return count;
+    }
+
+    // indices of the sink inputs currently routed through the virtual sink
+    std::vector<uint32_t> sink_inputs() {
+        if (!mainloop)
+            return {};
+        pa_threaded_mainloop_lock(mainloop);
+        auto indices = routed_sink_inputs;
+        pa_threaded_mainloop_unlock(mainloop);
+        return indices;
     }
 
-    std::size_t queue_length() { return data_queue.size(); }
+    struct LatencyInfo {
+        double record_seconds = 0;
+        double playback_seconds = 0;
+        double queued_seconds = 0;
+        double target_delay_seconds = 0;
+        double budget_seconds = 0;
+        std::size_t playback_flushes = 0;
+    };
+
+    /**
+     * @brief Snapshot the stream latencies reported by the server.
+     * budget_seconds is the time left between the oldest unread sample in the
+     * queue and the moment it becomes audible, i.e. what the consumer may
+     * spend before the visuals lag the sound.
+     */
+    LatencyInfo latency() {
+        LatencyInfo info;
+        info.target_delay_seconds = bytes_to_seconds(delay_bytes);
+        if (!mainloop)
+            return info;
+        pa_threaded_mainloop_lock(mainloop);
+        info.record_seconds = stream_latency_seconds(record_stream);
+        info.playback_seconds = stream_latency_seconds(playback_stream);
+        info.queued_seconds =
+            bytes_to_seconds(data_queue.size() * sizeof(DataType));
+        info.playback_flushes = playback_flushes;
+        pa_threaded_mainloop_unlock(mainloop);
+        info.budget_seconds = info.playback_seconds - info.queued_seconds;
+        return info;
+    }
 
   private:
     static void context_state_cb(pa_context *c, void *userdata) {
@@ -274,15 +456,62 @@ class PulseAudioMonitor {
         switch (pa_context_get_state(c)) {
         case PA_CONTEXT_READY: {
             std::cout << "Context ready." << std::endl;
-
-            // get the sink index and sink input index
+            monitor->mark_startup_step("context");
+
+            // track volume changes through events instead of polling them
+            // from the read callback, and route the sink inputs that appear
+            // on the monitored sink later on
+            pa_context_set_subscribe_callback(
+                c, &PulseAudioMonitor::subscribe_cb, monitor);
+            pa_operation *sub_op = pa_context_subscribe(
+                c,
+                static_cast<pa_subscription_mask_t>(
+                    PA_SUBSCRIPTION_MASK_SINK | PA_SUBSCRIPTION_MASK_SINK_INPUT),
+                nullptr, nullptr);
+            if (sub_op)
+                pa_operation_unref(sub_op);
+
+            // the queries below are independent of each other, issue them
+            // all at once and join their results in route_sink_input()
             pa_operation *op = pa_context_get_sink_info_by_name(
                 c, monitor->sink_name.c_str(),
                 &PulseAudioMonitor::get_monitored_sink_idx_cb, monitor);
+            if (!op) {
+                monitor->abort_startup("Failed to get sink info");
+                return;
+            }
+            pa_operation_unref(op);
+
+            op = pa_context_get_sink_input_info_list(
+                c, &PulseAudioMonitor::get_sink_input_idx_cb, monitor);
+            if (!op) {
+                monitor->abort_startup("Failed to get sink input info list");
+                return;
+            }
+            pa_operation_unref(op);
+
+            // Create virtual sink
+            op = pa_context_load_module(
+                c, "module-null-sink",
+                ("sink_name=" + monitor->virtual_sink_name +
+                 " "
+                 "sink_properties=device.description=NullSink")
+                    .c_str(),
+                &PulseAudioMonitor::create_virtual_sink_cb, monitor);
+            if (!op) {
+                monitor->abort_startup("Failed to load module");
+                return;
+            }
             pa_operation_unref(op);
 
+            // the original sink is known by name, so playback can be set up
+            // while the virtual sink is still being created
+            monitor->connect_playback_stream(c);
         }; break;
         case PA_CONTEXT_FAILED:
+            monitor->abort_startup(std::string("Context failed: ") +
+                                   pa_strerror(pa_context_errno(c)));
+            break;
         case PA_CONTEXT_TERMINATED:
             monitor->mainloop_api->quit(monitor->mainloop_api, 1);
             break;
@@ -293,48 +522,49 @@ class PulseAudioMonitor {
 
     static void get_monitored_sink_idx_cb(pa_context *c, const pa_sink_info *i,
                                           int eol, void *userdata) {
+        auto monitor = static_cast<PulseAudioMonitor *>(userdata);
+        if (eol < 0) {
+            monitor->abort_startup("Sink not found: " + monitor->sink_name);
+            return;
+        }
         if (eol != 0)
             return;
-        auto monitor = static_cast<PulseAudioMonitor *>(userdata);
         if (monitor->sink_idx != PA_INVALID_INDEX)
             return;
         monitor->sink_idx = i->index;
+        monitor->current_sink_volume = pa_cvolume_avg(&i->volume);
+        monitor->update_normalization_factor();
         std::cout << "Sink info ready: sink #" << monitor->sink_idx << ": "
                   << monitor->sink_name << std::endl;
-        // get the sink input index by sink index
-        pa_operation *op = pa_context_get_sink_input_info_list(
-            c, &PulseAudioMonitor::get_sink_input_idx_cb, monitor);
-        if (!op) {
-            std::cerr << "Failed to get sink input info list" << std::endl;
-            monitor->mainloop_api->quit(monitor->mainloop_api, 1);
-            return;
-        }
-        pa_operation_unref(op);
+        monitor->mark_startup_step("sink_info");
+        monitor->route_sink_input(c);
     }
 
     static void get_sink_input_idx_cb(pa_context *c,
                                       const pa_sink_input_info *i, int eol,
                                       void *userdata) {
-        if (eol != 0)
-            return;
         auto monitor = static_cast<PulseAudioMonitor *>(userdata);
-        if (monitor->sink_input_idx != PA_INVALID_INDEX)
+        if (eol != 0) {
+            monitor->sink_inputs_listed = true;
+            monitor->mark_startup_step("sink_input_list");
+            monitor->route_sink_input(c);
             return;
-        if (i->sink == monitor->sink_idx) {
-            monitor->sink_input_idx = i->index;
-            std::cout << "Sink input info ready: sink input #"
-                      << monitor->sink_input_idx << ": " << i->name
-                      << std::endl;
-            // Create virtual sink
-            pa_operation *op = pa_context_load_module(
-                c, "module-null-sink",
-                ("sink_name=" + monitor->virtual_sink_name +
-                 " "
-                 "sink_properties=device.description=NullSink")
-                    .c_str(),
-                &PulseAudioMonitor::create_virtual_sink_cb, monitor);
-            pa_operation_unref(op);
         }
+        // the sink index may not be known yet, keep every input and filter
+        // once both lists are in
+        monitor->add_sink_input_candidate(i);
+    }
+
+    // the latest info of an input wins, it may be listed and announced too
+    void add_sink_input_candidate(const pa_sink_input_info *i) {
+        auto &candidates = sink_input_candidates;
+        candidates.erase(std::remove_if(candidates.begin(), candidates.end(),
+                                        [i](const SinkInputCandidate &input) {
+                                            return input.index == i->index;
+                                        }),
+                         candidates.end());
+        candidates.push_back({i->index, i->sink, i->client,
+                              pa_cvolume_avg(&i->volume), i->name});
     }
 
     static void create_virtual_sink_cb(pa_context *c, uint32_t idx,
@@ -342,11 +572,12 @@ class PulseAudioMonitor {
         auto monitor = static_cast<PulseAudioMonitor *>(userdata);
 
         if (idx == PA_INVALID_INDEX) {
-            std::cerr << "Failed to load module" << std::endl;
+            monitor->abort_startup("Failed to load module");
             return;
         }
 
         std::cout << "Virtual sink ready: loaded module #" << idx << std::endl;
+        monitor->mark_startup_step("load_null_sink");
 
         monitor->virtual_sink_module_idx = idx;
 
@@ -354,8 +585,7 @@ class PulseAudioMonitor {
             c, monitor->virtual_sink_name.c_str(),
             &PulseAudioMonitor::get_virtual_sink_idx_cb, monitor);
         if (!op) {
-            std::cerr << "Failed to get sink info list" << std::endl;
-            monitor->mainloop_api->quit(monitor->mainloop_api, 1);
+            monitor->abort_startup("Failed to get sink info list");
             return;
         }
         pa_operation_unref(op);
@@ -363,111 +593,271 @@ class PulseAudioMonitor {
 
     static void get_virtual_sink_idx_cb(pa_context *c, const pa_sink_info *i,
                                         int eol, void *userdata) {
+        auto monitor = static_cast<PulseAudioMonitor *>(userdata);
+        if (eol < 0) {
+            monitor->abort_startup("Virtual sink not found");
+            return;
+        }
         if (eol != 0)
             return;
-        auto monitor = static_cast<PulseAudioMonitor *>(userdata);
         monitor->virtual_sink_idx = i->index;
+        monitor->virtual_sink_monitor_name = i->monitor_source_name;
         std::cout << "Virtual sink info ready: virtual sink #"
                   << monitor->virtual_sink_idx << ": "
-                  << monitor->virtual_sink_name << std::endl;
-        // move the sink input to the virtual sink
-        pa_operation *op = pa_context_move_sink_input_by_index(
-            c, monitor->sink_input_idx, monitor->virtual_sink_idx,
-            &PulseAudioMonitor::redirect_sink_input_to_virtual_sink_cb,
-            monitor);
-        pa_operation_unref(op);
+                  << monitor->virtual_sink_name << ", monitor source "
+                  << monitor->virtual_sink_monitor_name << std::endl;
+        monitor->mark_startup_step("virtual_sink_info");
+
+        monitor->connect_record_stream(c);
+        monitor->route_sink_input(c);
     }
 
+    struct MoveRequest {
+        PulseAudioMonitor *monitor;
+        uint32_t index;
+        pa_volume_t volume;
+        bool startup;
+    };
+
     static void redirect_sink_input_to_virtual_sink_cb(pa_context *c,
                                                        int success,
                                                        void *userdata) {
-        if (success < 0) {
-            std::cerr << "Failed to move sink input" << std::endl;
-            return;
+        std::unique_ptr<MoveRequest> request(
+            static_cast<MoveRequest *>(userdata));
+        auto monitor = request->monitor;
+        if (success) {
+            std::cout << "Move input ready: moved sink input #"
+                      << request->index << " to virtual sink #"
+                      << monitor->virtual_sink_idx << std::endl;
+            // the newest input sets the normalization
+            monitor->sink_input_idx = request->index;
+            monitor->current_sink_input_volume = request->volume;
+            monitor->update_normalization_factor();
+            if (!request->startup)
+                monitor->reroutes++;
+        } else {
+            // it most likely went away in the meantime
+            std::cerr << "Failed to move sink input #" << request->index
+                      << std::endl;
+            monitor->forget_sink_input(c, request->index);
+        }
+        if (request->startup && --monitor->startup_moves == 0) {
+            monitor->mark_startup_step("move_sink_input");
+            monitor->sink_input_routed = true;
+            monitor->check_ready();
         }
+    }
+
+    static void stream_state_cb(pa_stream *s, void *userdata) {
         auto monitor = static_cast<PulseAudioMonitor *>(userdata);
-        std::cout << "Move input ready: moved sink input #"
-                  << monitor->sink_input_idx << " to virtual sink #"
-                  << monitor->virtual_sink_idx << std::endl;
-
-        // get virtual sink monitor source name by idx
-        pa_operation *op = pa_context_get_sink_info_by_index(
-            c, monitor->virtual_sink_idx,
-            &PulseAudioMonitor::get_virtual_sink_monitor_name_cb, monitor);
+        const char *name =
+            s == monitor->record_stream ? "record_stream" : "playback_stream";
+        switch (pa_stream_get_state(s)) {
+        case PA_STREAM_READY:
+            monitor->mark_startup_step(name);
+            monitor->check_ready();
+            break;
+        case PA_STREAM_FAILED:
+            monitor->abort_startup(std::string("Stream failed: ") + name);
+            break;
+        default:
+            break;
+        }
+    }
+
+    /**
+     * @brief Move the sink inputs playing on the monitored sink to the
+     * virtual sink. Called after each of the startup queries it depends on
+     * and only acts once all of them have answered.
+     */
+    void route_sink_input(pa_context *c) {
+        if (sink_input_routed || startup_moves > 0)
+            return;
+        if (sink_idx == PA_INVALID_INDEX || !sink_inputs_listed ||
+            virtual_sink_idx == PA_INVALID_INDEX)
+            return;
+
+        // counted up front so the first answer does not end the startup
+        std::vector<SinkInputCandidate> inputs;
+        for (const auto &input : sink_input_candidates) {
+            if (input.sink != sink_idx || input.client == own_client(c) ||
+                is_routed(input.index))
+                continue;
+            std::cout << "Sink input info ready: sink input #" << input.index
+                      << ": " << input.name << std::endl;
+            inputs.push_back(input);
+        }
+        sink_input_candidates.clear();
+
+        if (inputs.empty()) {
+            std::cerr << "No sink input is playing on sink " << sink_name
+                      << std::endl;
+            sink_input_routed = true;
+            check_ready();
+            return;
+        }
+        startup_moves = inputs.size();
+        for (const auto &input : inputs)
+            move_to_virtual_sink(c, input.index, input.volume, true);
+    }
+
+    /**
+     * @brief Move a sink input to the virtual sink. It counts as routed from
+     * now on, so the events it triggers meanwhile do not move it twice.
+     */
+    void move_to_virtual_sink(pa_context *c, uint32_t index,
+                              pa_volume_t volume, bool startup) {
+        routed_sink_inputs.push_back(index);
+        auto request = new MoveRequest{this, index, volume, startup};
+        pa_operation *op = pa_context_move_sink_input_by_index(
+            c, index, virtual_sink_idx,
+            &PulseAudioMonitor::redirect_sink_input_to_virtual_sink_cb,
+            request);
+        if (!op) {
+            // answer as the server would have
+            redirect_sink_input_to_virtual_sink_cb(c, 0, request);
+            return;
+        }
         pa_operation_unref(op);
     }
 
-    static void get_virtual_sink_monitor_name_cb(pa_context *c,
-                                                 const pa_sink_info *i, int eol,
-                                                 void *userdata) {
-        if (eol != 0)
+    bool is_routed(uint32_t index) {
+        return std::find(routed_sink_inputs.begin(), routed_sink_inputs.end(),
+                         index) != routed_sink_inputs.end();
+    }
+
+    /**
+     * @brief Stop tracking a sink input that went away or was moved
+     * elsewhere. If it set the normalization, the newest remaining input
+     * takes over.
+     */
+    void forget_sink_input(pa_context *c, uint32_t index) {
+        auto it = std::find(routed_sink_inputs.begin(),
+                            routed_sink_inputs.end(), index);
+        if (it == routed_sink_inputs.end())
             return;
-        auto monitor = static_cast<PulseAudioMonitor *>(userdata);
-        std::cout << "Virtual sink monitor source ready: "
-                  << i->monitor_source_name << std::endl;
-        monitor->virtual_sink_monitor_name = i->monitor_source_name;
+        routed_sink_inputs.erase(it);
+        if (index != sink_input_idx)
+            return;
+        current_sink_input_volume = PA_VOLUME_NORM;
+        update_normalization_factor();
+        if (routed_sink_inputs.empty()) {
+            sink_input_idx = PA_INVALID_INDEX;
+            return;
+        }
+        sink_input_idx = routed_sink_inputs.back();
+        pa_operation *op = pa_context_get_sink_input_info(
+            c, sink_input_idx, &PulseAudioMonitor::sink_input_event_cb, this);
+        if (op)
+            pa_operation_unref(op);
+    }
+
+    // our own playback stream plays on the monitored sink too
+    static uint32_t own_client(pa_context *c) {
+        return pa_context_get_index(c);
+    }
 
+    void connect_record_stream(pa_context *c) {
         // create a recording stream
-        monitor->record_stream =
-            pa_stream_new(c, "pa_monitor-recording_stream",
-                          monitor->sample_specifications, monitor->channel_map);
-        if (!monitor->record_stream) {
-            std::cerr << "Failed to create recording stream" << std::endl;
-            monitor->mainloop_api->quit(monitor->mainloop_api, 1);
+        record_stream = pa_stream_new(c, "pa_monitor-recording_stream",
+                                      sample_specifications, channel_map);
+        if (!record_stream) {
+            abort_startup("Failed to create recording stream");
             return;
         }
-        // record from the virtual sink monitor
+        pa_stream_set_state_callback(
+            record_stream, &PulseAudioMonitor::stream_state_cb, this);
+        // set the read callback
+        pa_stream_set_read_callback(record_stream,
+                                    &PulseAudioMonitor::stream_read_cb, this);
+
+        // record from the virtual sink monitor, asking the server for
+        // fragments of the requested size rather than its default
+        pa_buffer_attr record_attr;
+        record_attr.maxlength = (uint32_t)-1;
+        record_attr.tlength = (uint32_t)-1;
+        record_attr.prebuf = (uint32_t)-1;
+        record_attr.minreq = (uint32_t)-1;
+        record_attr.fragsize = (uint32_t)fragment_bytes;
         int success = pa_stream_connect_record(
-            monitor->record_stream, monitor->virtual_sink_monitor_name.c_str(),
-            nullptr, PA_STREAM_AUTO_TIMING_UPDATE);
+            record_stream, virtual_sink_monitor_name.c_str(), &record_attr,
+            static_cast<pa_stream_flags_t>(PA_STREAM_ADJUST_LATENCY |
+                                           PA_STREAM_INTERPOLATE_TIMING |
+                                           PA_STREAM_AUTO_TIMING_UPDATE));
         if (success < 0) {
-            std::cerr << "Failed to connect recording stream" << std::endl;
-            monitor->mainloop_api->quit(monitor->mainloop_api, 1);
+            abort_startup("Failed to connect recording stream");
             return;
         }
         std::cout << "Connected recording stream to monitor source: "
-                  << monitor->virtual_sink_monitor_name << std::endl;
-
-        // set the read callback
-        pa_stream_set_read_callback(monitor->record_stream,
-                                    &PulseAudioMonitor::stream_read_cb,
-                                    monitor);
-        // todo: change this to a poll based callback to actively control the
-        // delay
+                  << virtual_sink_monitor_name << std::endl;
+    }
 
+    void connect_playback_stream(pa_context *c) {
         // create a playback stream
-        monitor->playback_stream =
-            pa_stream_new(c, "pa_monitor-playback_stream",
-                          monitor->sample_specifications, monitor->channel_map);
-        if (!monitor->playback_stream) {
-            std::cerr << "Failed to create playback stream" << std::endl;
-            monitor->mainloop_api->quit(monitor->mainloop_api, 1);
+        playback_stream = pa_stream_new(c, "pa_monitor-playback_stream",
+                                        sample_specifications, channel_map);
+        if (!playback_stream) {
+            abort_startup("Failed to create playback stream");
             return;
         }
+        pa_stream_set_state_callback(
+            playback_stream, &PulseAudioMonitor::stream_state_cb, this);
 
         // connect the playback stream to original sink
         pa_buffer_attr buffer_attr;
         buffer_attr.maxlength =
             RATE * CHANNELS * sizeof(DataType); // max delay is 1s
-        buffer_attr.tlength = (uint32_t)(monitor->delay_bytes);
+        buffer_attr.tlength = (uint32_t)(delay_bytes);
         buffer_attr.prebuf = (uint32_t)-1;
         buffer_attr.minreq = (uint32_t)-1;
         buffer_attr.fragsize = (uint32_t)-1;
 
         pa_stream_flags_t flags = static_cast<pa_stream_flags_t>(
-            PA_STREAM_ADJUST_LATENCY | PA_STREAM_AUTO_TIMING_UPDATE);
-        success = pa_stream_connect_playback(
-            monitor->playback_stream, monitor->sink_name.c_str(), &buffer_attr,
-            flags, nullptr, nullptr);
+            PA_STREAM_ADJUST_LATENCY | PA_STREAM_INTERPOLATE_TIMING |
+            PA_STREAM_AUTO_TIMING_UPDATE);
+        int success =
+            pa_stream_connect_playback(playback_stream, sink_name.c_str(),
+                                       &buffer_attr, flags, nullptr, nullptr);
         if (success < 0) {
-            std::cerr << "Failed to connect playback stream" << std::endl;
-            monitor->mainloop_api->quit(monitor->mainloop_api, 1);
+            abort_startup("Failed to connect playback stream");
             return;
         }
-        std::cout << "Connected playback stream to sink: " << monitor->sink_name
+        std::cout << "Connected playback stream to sink: " << sink_name
                   << std::endl;
     }
 
+    void check_ready() {
+        if (ready_set || !sink_input_routed)
+            return;
+        if (!record_stream ||
+            pa_stream_get_state(record_stream) != PA_STREAM_READY)
+            return;
+        if (!playback_stream ||
+            pa_stream_get_state(playback_stream) != PA_STREAM_READY)
+            return;
+        ready_set = true;
+        mark_startup_step("ready");
+        ready_promise.set_value();
+    }
+
+    void abort_startup(const std::string &message) {
+        std::cerr << message << std::endl;
+        if (!ready_set) {
+            ready_set = true;
+            ready_promise.set_exception(
+                std::make_exception_ptr(std::runtime_error(message)));
+        }
+        mainloop_api->quit(mainloop_api, 1);
+    }
+
+    void mark_startup_step(const std::string &step) {
+        double elapsed = std::chrono::duration<double>(
+                             std::chrono::steady_clock::now() - run_start)
+                             .count();
+        std::lock_guard<std::mutex> lock(startup_mutex);
+        startup_steps.emplace_back(step, elapsed);
+    }
+
     static void stream_read_cb(pa_stream *s, std::size_t length,
                                void *userdata) {
         // constantly read data from the stream and store into local buffer
@@ -479,19 +869,19 @@ class PulseAudioMonitor {
             monitor->mainloop_api->quit(monitor->mainloop_api, 1);
             return;
         }
+        if (!data) {
+            // empty buffer or a hole in the stream, nothing to copy
+            if (length)
+                pa_stream_drop(s);
+            return;
+        }
 
-        // Get record stream latency
-        // pa_usec_t record_latency;
-        // int negative;
-        // int ret = pa_stream_get_latency(s, &record_latency, &negative);
-        // if (ret == 0) {
-        //     std::cout << "Record stream latency: " << record_latency
-        //               << " microseconds" << std::endl;
-        // } else {
-        //     std::cerr << "Failed to get record stream latency" << std::endl;
-        // }
-
-        int success = pa_stream_write(monitor->playback_stream, data, length,
+        // the playback delay is held at the target by tlength, the fragment
+        // is written whole so the audio is never cut
+        monitor->check_playback_overrun();
+        int success = 0;
+        if (pa_stream_get_state(monitor->playback_stream) == PA_STREAM_READY)
+            success = pa_stream_write(monitor->playback_stream, data, length,
                                       nullptr, 0, PA_SEEK_RELATIVE);
         if (success < 0) {
             std::cerr << "Failed to write to playback stream" << std::endl;
@@ -499,42 +889,57 @@ class PulseAudioMonitor {
             return;
         }
 
-        // Get playback stream latency
-        // pa_usec_t playback_latency;
-        // ret = pa_stream_get_latency(monitor->playback_stream, &playback_latency,
-        //                             &negative);
-        // if (ret == 0) {
-        //     std::cout << "Playback stream latency: " << playback_latency
-        //               << " microseconds" << std::endl;
-        // } else {
-        //     std::cerr << "Failed to get playback stream latency" << std::endl;
-        // }
-
+        // apply normalization to the chunk of data before the fragment is
+        // released back to the server
+        std::size_t n_samples = length / sizeof(DataType);
+        monitor->scratch.resize(n_samples);
+        normalize_samples(static_cast<const DataType *>(data),
+                          monitor->scratch.data(), n_samples,
+                          monitor->normalization_factor);
         pa_stream_drop(s);
 
+        monitor->silence.process(monitor->scratch.data(), n_samples);
+        if (monitor->tap)
+            monitor->tap->write(monitor->scratch.data(), n_samples);
+        if (monitor->features)
+            monitor->features->process(monitor->scratch.data(),
+                                       n_samples / CHANNELS);
+
         // insert data to the queues
-        monitor->data_queue.insert(
-            monitor->data_queue.end(), static_cast<const DataType *>(data),
-            static_cast<const DataType *>(data + length));
-
-        // apply normalization to the chunk of data
-        pa_operation *o = pa_context_get_sink_info_by_index(
-            monitor->context, monitor->sink_idx,
-            &PulseAudioMonitor::get_sink_volume_cb, monitor);
-        pa_operation_unref(o);
-        o = pa_context_get_sink_input_info(
-            monitor->context, monitor->sink_input_idx,
-            &PulseAudioMonitor::get_sink_input_volume_cb, monitor);
-        pa_operation_unref(o);
+        monitor->data_queue.insert(monitor->data_queue.end(),
+                                   monitor->scratch.data(),
+                                   monitor->scratch.data() + n_samples);
+    }
 
-        float normalization_factor =
-            ((float)PA_VOLUME_NORM / monitor->current_sink_volume) *
-            ((float)PA_VOLUME_NORM / monitor->current_sink_input_volume);
+    static void subscribe_cb(pa_context *c, pa_subscription_event_type_t t,
+                             uint32_t idx, void *userdata) {
+        auto monitor = static_cast<PulseAudioMonitor *>(userdata);
+        auto type = t & PA_SUBSCRIPTION_EVENT_TYPE_MASK;
+        if (monitor->stopping)
+            return;
 
-        for (std::size_t i = -length / sizeof(DataType); i < 0; i++) {
-            monitor->data_queue[monitor->data_queue.size() + i] *=
-                normalization_factor;
+        pa_operation *op = nullptr;
+        switch (t & PA_SUBSCRIPTION_EVENT_FACILITY_MASK) {
+        case PA_SUBSCRIPTION_EVENT_SINK:
+            if (type == PA_SUBSCRIPTION_EVENT_CHANGE &&
+                idx == monitor->sink_idx)
+                op = pa_context_get_sink_info_by_index(
+                    c, idx, &PulseAudioMonitor::get_sink_volume_cb, monitor);
+            break;
+        case PA_SUBSCRIPTION_EVENT_SINK_INPUT:
+            if (type == PA_SUBSCRIPTION_EVENT_REMOVE) {
+                monitor->forget_sink_input(c, idx);
+                break;
+            }
+            // a new input, one moved to another sink or a volume change
+            op = pa_context_get_sink_input_info(
+                c, idx, &PulseAudioMonitor::sink_input_event_cb, monitor);
+            break;
+        default:
+            break;
         }
+        if (op)
+            pa_operation_unref(op);
     }
 
     static void get_sink_volume_cb(pa_context *c, const pa_sink_info *i,
@@ -542,16 +947,96 @@ class PulseAudioMonitor {
         if (eol != 0)
             return;
         auto monitor = static_cast<PulseAudioMonitor *>(userdata);
-        monitor->current_sink_volume = i->volume.values[0];
+        monitor->current_sink_volume = pa_cvolume_avg(&i->volume);
+        monitor->update_normalization_factor();
     }
 
-    static void get_sink_input_volume_cb(pa_context *c,
-                                         const pa_sink_input_info *i, int eol,
-                                         void *userdata) {
+    static void sink_input_event_cb(pa_context *c, const pa_sink_input_info *i,
+                                    int eol, void *userdata) {
         if (eol != 0)
             return;
         auto monitor = static_cast<PulseAudioMonitor *>(userdata);
-        monitor->current_sink_input_volume = i->volume.values[0];
+        if (monitor->stopping)
+            return;
+        if (!monitor->sink_input_routed && monitor->startup_moves == 0) {
+            // the startup routing has not run yet, it waits for the sink and
+            // the virtual sink and moves the candidates on the sink then
+            monitor->add_sink_input_candidate(i);
+            return;
+        }
+        if (i->sink == monitor->sink_idx) {
+            // a new input on the monitored sink, or one moved back to it
+            if (i->client != own_client(c) && !monitor->is_routed(i->index)) {
+                std::cout << "Rerouting sink input #" << i->index << ": "
+                          << i->name << std::endl;
+                monitor->move_to_virtual_sink(
+                    c, i->index, pa_cvolume_avg(&i->volume), false);
+            }
+            return;
+        }
+        if (i->sink != monitor->virtual_sink_idx) {
+            // moved elsewhere by the user, leave it there on stop
+            monitor->forget_sink_input(c, i->index);
+            return;
+        }
+        if (i->index == monitor->sink_input_idx) {
+            monitor->current_sink_input_volume = pa_cvolume_avg(&i->volume);
+            monitor->update_normalization_factor();
+        }
+    }
+
+    static double bytes_to_seconds(std::size_t bytes) {
+        return (double)bytes / (RATE * CHANNELS * sizeof(DataType));
+    }
+
+    static double stream_latency_seconds(pa_stream *s) {
+        if (!s || pa_stream_get_state(s) != PA_STREAM_READY)
+            return 0;
+        pa_usec_t usec;
+        int negative = 0;
+        if (pa_stream_get_latency(s, &usec, &negative) < 0)
+            return 0;
+        double seconds = (double)usec / PA_USEC_PER_SEC;
+        return negative ? -seconds : seconds;
+    }
+
+    /**
+     * @brief Flush the playback queue once it holds twice the target delay,
+     * e.g. after a stall or when the two sink clocks have drifted apart: one
+     * gap instead of playing ever later.
+     */
+    void check_playback_overrun() {
+        if (flushing_playback)
+            return;
+        double target = bytes_to_seconds(delay_bytes);
+        if (stream_latency_seconds(playback_stream) <=
+            2 * target + bytes_to_seconds(fragment_bytes))
+            return;
+        pa_operation *o = pa_stream_flush(
+            playback_stream, &PulseAudioMonitor::playback_flushed_cb, this);
+        if (!o)
+            return;
+        flushing_playback = true;
+        pa_operation_unref(o);
+    }
+
+    static void playback_flushed_cb(pa_stream *, int success, void *userdata) {
+        auto monitor = static_cast<PulseAudioMonitor *>(userdata);
+        monitor->flushing_playback = false;
+        if (success)
+            monitor->playback_flushes++;
+    }
+
+    void update_normalization_factor() {
+        // a muted stream carries no signal, leave it unscaled
+        if (current_sink_volume == PA_VOLUME_MUTED ||
+            current_sink_input_volume == PA_VOLUME_MUTED) {
+            normalization_factor = 1.0f;
+            return;
+        }
+        normalization_factor =
+            ((float)PA_VOLUME_NORM / current_sink_volume) *
+            ((float)PA_VOLUME_NORM / current_sink_input_volume);
     }
 
   private:
@@ -568,14 +1053,52 @@ class PulseAudioMonitor {
     FixedDeque<DataType> data_queue{RATE * CHANNELS * 20};
     pa_volume_t current_sink_volume = PA_VOLUME_NORM;
     pa_volume_t current_sink_input_volume = PA_VOLUME_NORM;
+    // only touched from the mainloop thread
+    float normalization_factor = 1.0f;
+    std::vector<DataType> scratch;
+    std::shared_ptr<FeatureExtractor<DataType>> features;
+    std::shared_ptr<SharedMemoryTap<DataType>> tap;
+    // about -60 dBFS
+    SilenceDetector<DataType> silence{RATE, CHANNELS, 1e-3f};
 
     uint32_t sink_idx = PA_INVALID_INDEX;
+    // the newest routed sink input, its volume sets the normalization
     uint32_t sink_input_idx = PA_INVALID_INDEX;
+    // every sink input moved (or being moved) to the virtual sink, and how
+    // many were moved after startup
+    std::vector<uint32_t> routed_sink_inputs;
+    std::size_t reroutes = 0;
     uint32_t virtual_sink_module_idx = PA_INVALID_INDEX;
     uint32_t virtual_sink_idx = PA_INVALID_INDEX;
     std::string virtual_sink_name;
     std::string virtual_sink_monitor_name;
     pa_stream *playback_stream = nullptr;
     pa_stream *record_stream = nullptr;
+
+    struct SinkInputCandidate {
+        uint32_t index;
+        uint32_t sink;
+        uint32_t client;
+        pa_volume_t volume;
+        std::string name;
+    };
+    std::vector<SinkInputCandidate> sink_input_candidates;
+    bool sink_inputs_listed = false;
+    // moves issued at startup and not answered yet
+    std::size_t startup_moves = 0;
+    bool sink_input_routed = false;
+    bool stopping = false;
+
+    // readiness is only set from the mainloop thread
+    bool ready_set = false;
+    std::promise<void> ready_promise;
+    std::shared_future<void> ready_future = ready_promise.get_future().share();
+    std::chrono::steady_clock::time_point run_start =
+        std::chrono::steady_clock::now();
+    std::mutex startup_mutex;
+    std::vector<std::pair<std::string, double>> startup_steps;
     size_t delay_bytes = 0;
+    size_t fragment_bytes = 0;
+    size_t playback_flushes = 0;
+    bool flushing_playback = false;
 };
@@ -0,0 +1,126 @@
+#pragma once
+
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <cstddef>
+#include <cstdint>
+#include <cstring>
+#include <new>
+#include <stdexcept>
+#include <string>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+/**
+ * @brief Layout of the shared memory segment, read by audio_tap.py. Samples
+ * are interleaved and start at TAP_DATA_OFFSET, the ring holds `capacity`
+ * samples (all channels counted). write_seq is the total number of samples
+ * ever written, so a reader at position p finds sample p at p % capacity and
+ * has been overrun once write_seq - p > capacity. Samples are copied in
+ * before write_seq is published, so a write in progress can already be
+ * overwriting up to max_write samples past write_seq: a reader has to treat
+ * p as gone once write_seq + max_write > p + capacity.
+ */
+constexpr char TAP_MAGIC[8] = "PATAP01";
+constexpr std::size_t TAP_DATA_OFFSET = 64;
+
+struct TapHeader {
+    char magic[8];
+    uint32_t rate;
+    uint32_t channels;
+    uint32_t sample_size;
+    uint32_t reserved;
+    uint64_t capacity;
+    std::atomic<uint64_t> write_seq;
+    // largest single write so far
+    std::atomic<uint64_t> max_write;
+};
+static_assert(sizeof(TapHeader) <= TAP_DATA_OFFSET,
+              "tap header overlaps the data");
+static_assert(offsetof(TapHeader, write_seq) == 32,
+              "audio_tap.py expects write_seq at offset 32");
+static_assert(offsetof(TapHeader, max_write) == 40,
+              "audio_tap.py expects max_write at offset 40");
+
+/**
+ * @brief Single writer ring buffer in a named POSIX shared memory segment.
+ * The segment is unlinked when the tap is destroyed.
+ */
+template <typename T> class SharedMemoryTap {
+  public:
+    SharedMemoryTap(const std::string &name, int rate, int channels,
+                    std::size_t capacity)
+        : name("/" + name), capacity(capacity - capacity % channels) {
+        if (this->capacity == 0)
+            throw std::invalid_argument("capacity should hold a frame");
+        size = TAP_DATA_OFFSET + this->capacity * sizeof(T);
+
+        int fd = shm_open(this->name.c_str(), O_CREAT | O_RDWR, 0644);
+        if (fd < 0)
+            throw std::runtime_error("shm_open failed for " + this->name +
+                                     ": " + std::strerror(errno));
+        if (ftruncate(fd, size) < 0) {
+            close(fd);
+            shm_unlink(this->name.c_str());
+            throw std::runtime_error("ftruncate failed for " + this->name);
+        }
+        void *addr =
+            mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+        close(fd);
+        if (addr == MAP_FAILED) {
+            shm_unlink(this->name.c_str());
+            throw std::runtime_error("mmap failed for " + this->name);
+        }
+        base = static_cast<uint8_t *>(addr);
+
+        header = new (base) TapHeader();
+        std::memcpy(header->magic, TAP_MAGIC, sizeof(TAP_MAGIC));
+        header->rate = rate;
+        header->channels = channels;
+        header->sample_size = sizeof(T);
+        header->capacity = this->capacity;
+        header->max_write.store(0, std::memory_order_relaxed);
+        header->write_seq.store(0, std::memory_order_release);
+        data = reinterpret_cast<T *>(base + TAP_DATA_OFFSET);
+    }
+
+    SharedMemoryTap(const SharedMemoryTap &) = delete;
+    SharedMemoryTap &operator=(const SharedMemoryTap &) = delete;
+
+    ~SharedMemoryTap() {
+        munmap(base, size);
+        shm_unlink(name.c_str());
+    }
+
+    void write(const T *samples, std::size_t n) {
+        uint64_t seq = header->write_seq.load(std::memory_order_relaxed);
+        // only the newest `capacity` samples can be kept
+        if (n > capacity) {
+            samples += n - capacity;
+            seq += n - capacity;
+            n = capacity;
+        }
+        // announced before the samples it covers are overwritten
+        if (n > header->max_write.load(std::memory_order_relaxed))
+            header->max_write.store(n, std::memory_order_seq_cst);
+        std::size_t pos = seq % capacity;
+        std::size_t first = std::min(n, capacity - pos);
+        std::memcpy(data + pos, samples, first * sizeof(T));
+        std::memcpy(data, samples + first, (n - first) * sizeof(T));
+        header->write_seq.store(seq + n, std::memory_order_release);
+    }
+
+    const std::string &segment_name() const { return name; }
+
+  private:
+    std::string name;
+    std::size_t capacity;
+    std::size_t size = 0;
+    uint8_t *base = nullptr;
+    TapHeader *header = nullptr;
+    T *data = nullptr;
+};
@@ -0,0 +1,161 @@
+"""Check that PreallocatedAnalyser does not allocate in the hop loop.
+
+Runs MusicAnalyser and PreallocatedAnalyser over the same synthetic audio
+(noise bursts over a tone) and reports for each
+- net: bytes still allocated after --hops hops that were not before them,
+  traced by tracemalloc with the interpreter's free lists filled and the
+  garbage collector off, after --settle hops
+- temporaries: mean of the per hop peak of tracemalloc above the start of
+  the hop, i.e. what the allocator is asked for and given back every hop
+- latency: p50 / p99 / max of analyze without tracing, the tail is what the
+  allocations cost
+and checks that the two report the same onsets and pulses:
+
+    python -m benchmarks.analyzer_allocations
+    python -m benchmarks.analyzer_allocations --onset-mode mel --bands 16
+
+Exits with status 1 when the preallocated analyser leaves anything allocated,
+allocates more than --max-temp-bytes per hop, or disagrees with
+MusicAnalyser.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from music_analyser import MusicAnalyser
+from music_analyser.preallocated import PreallocatedAnalyser
+
+
+def make_audio(seconds, sr, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    bursts = rng.standard_normal(len(t)) * (np.sin(2 * np.pi * 2 * t) > 0.5)
+    y = 0.1 * bursts + 0.2 * np.sin(2 * np.pi * 440 * t) + 0.05 * rng.standard_normal(len(t))
+    return (np.clip(y, -1, 1) * np.iinfo(np.int16).max).astype(np.int16)
+
+
+def hops(audio, hop):
+    return [audio[i : i + hop] for i in range(0, len(audio) - hop + 1, hop)]
+
+
+def fill_free_lists():
+    """Fill the interpreter's free lists. A full collection empties them, and
+    the blocks they keep are still traced by tracemalloc: every hop that
+    frees one more tuple (numpy's axis tuples) than it takes would show up
+    as growth until up to 2000 tuples of each length are kept."""
+    keep = [tuple(range(n)) for n in range(1, 20) for _ in range(2000)]
+    keep += [float(i) + 0.5 for i in range(1000)]
+    keep += [[i] for i in range(1000)] + [{i: i} for i in range(1000)]
+    del keep
+
+
+def trace(analyser, settle, frames):
+    """Bytes allocated at the end of each hop of frames, relative to the end
+    of the first one, and the per hop peaks above the start of the hop."""
+    gc.collect()
+    # a full collection in the loop would empty the free lists again
+    gc.disable()
+    try:
+        fill_free_lists()
+        # preallocated too, a growing list would count as net allocations,
+        # and so would enumerate's indices past the cached small ints
+        peaks = np.zeros(len(frames))
+        after = np.zeros(len(frames))
+        indices = list(range(len(frames)))
+        tracemalloc.start()
+        for frame in settle:
+            analyser.analyze(frame)
+        # bound before the first hop, so the loop holds as much from then on
+        before, peak = tracemalloc.get_traced_memory()
+        for i, frame in zip(indices, frames):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            analyser.analyze(frame)
+            after[i], peak = tracemalloc.get_traced_memory()
+            peaks[i] = peak - before
+        tracemalloc.stop()
+    finally:
+        gc.enable()
+    # from the end of the first hop, whose results the loop holds from then on
+    return after - after[0], peaks
+
+
+def latency(analyser, frames):
+    times = []
+    for frame in frames:
+        st = time.perf_counter()
+        analyser.analyze(frame)
+        times.append(time.perf_counter() - st)
+    times = np.array(times) * 1e3
+    return dict(p50=np.percentile(times, 50), p99=np.percentile(times, 99), max=times.max())
+
+
+def compare(frames, kwargs):
+    """Hops where the two analysers disagree on the pulse or the onsets."""
+    standard, preallocated = MusicAnalyser(**kwargs), PreallocatedAnalyser(**kwargs)
+    mismatches = 0
+    for frame in frames:
+        a = standard.analyze(frame)
+        b = preallocated.analyze(frame)
+        if a["send_pulse"] != b.send_pulse or not np.array_equal(a["onsets"], b.onsets):
+            mismatches += 1
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sr", type=int, default=44100)
+    parser.add_argument("--hop-length", type=int, default=512)
+    parser.add_argument("--hops-per-analyse", type=int, default=3)
+    parser.add_argument("--onset-mode", default="linear", choices=["linear", "mel"])
+    parser.add_argument("--bands", type=int, default=0, help="band levels per hop")
+    parser.add_argument("--settle", type=int, default=10, help="hops before measuring")
+    parser.add_argument("--hops", type=int, default=200, help="hops measured")
+    parser.add_argument("--max-temp-bytes", type=int, default=4096)
+    args = parser.parse_args()
+
+    kwargs = dict(
+        sr=args.sr,
+        hop_length=args.hop_length,
+        onset_mode=args.onset_mode,
+        n_bands=args.bands,
+    )
+    hop = args.hop_length * args.hops_per_analyse
+    n = args.settle + args.hops
+    frames = hops(make_audio(n * hop / args.sr + 1, args.sr), hop)[:n]
+
+    failures = 0
+    print(f"{'analyser':>22} {'net bytes':>10} {'temp bytes':>11} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+    for cls in (MusicAnalyser, PreallocatedAnalyser):
+        analyser = cls(**kwargs)
+        # MusicAnalyser prints its STFT time every hop
+        with contextlib.redirect_stdout(io.StringIO()):
+            analyser.warmup()
+            growth, peaks = trace(analyser, frames[: args.settle], frames[args.settle :])
+            net, temp = int(growth[-1]), float(np.mean(peaks))
+            lat = latency(analyser, frames[args.settle :])
+        print(f"{cls.__name__:>22} {net:>10} {temp:>11.0f} {lat['p50']:>7.2f} {lat['p99']:>7.2f} {lat['max']:>7.2f}")
+        if cls is PreallocatedAnalyser:
+            if growth.any():
+                print(f"  {int(growth.max())} bytes left allocated over {args.hops} hops")
+                failures += 1
+            if temp > args.max_temp_bytes:
+                print(f"  {temp:.0f} bytes allocated per hop, more than {args.max_temp_bytes}")
+                failures += 1
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        mismatches = compare(frames, kwargs)
+    print(f"{mismatches} of {len(frames)} hops differ from MusicAnalyser")
+    failures += mismatches > 0
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
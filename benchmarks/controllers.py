@@ -0,0 +1,241 @@
+"""Benchmark the controller render loops on the fake backends.
+
+For every light strip effect and LED count this measures
+- throughput: frames per second when update() runs back to back
+- jitter: spread of the SPI transfer intervals of the run thread around dt
+and for pulses, the time from send_pulse() to the first frame of the pulse
+and the same throughput / jitter for the ferrofluid walk, from its duty cycle
+changes. Nothing here needs a Pi:
+
+    python -m benchmarks.controllers --counts 14 150 1000 --save today.json
+    python -m benchmarks.controllers --compare today.json
+
+--compare exits with status 1 when a throughput dropped or a latency grew by
+more than --tolerance against the saved results.
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+
+import numpy as np
+
+from controller.backends import FakeGPIO, FakeSpi
+from controller.ferro_controller import FerroFluidController
+from controller.light_controller import LightStripController
+
+EFFECTS = ["breathe", "water", "sparkling", "spectrum"]
+DEFAULT_COUNTS = [14, 60, 150, 300, 1000]
+# every bit is sent as 0b11000000 when the strip is dark
+ONE_BIT = 0b11111000
+
+
+class PulseSpi(FakeSpi):
+    """Also timestamps the frames with every LED off, i.e. the first frame of
+    a pulse."""
+
+    def __init__(self):
+        super().__init__()
+        self.dark_frames = []
+
+    def xfer2(self, data):
+        if ONE_BIT not in data:
+            self.dark_frames.append(time.perf_counter())
+        return super().xfer2(data)
+
+
+def stop_thread(controller):
+    controller.running = False
+    controller.run_thread.join()
+
+
+def interval_stats(times, dt):
+    intervals = np.diff(times)
+    if len(intervals) == 0:
+        return dict(ticks=0, mean_ms=0.0, jitter_ms=0.0, p99_ms=0.0)
+    return dict(
+        ticks=len(intervals),
+        mean_ms=float(intervals.mean() * 1e3),
+        # spread around the nominal period, late ticks included
+        jitter_ms=float(np.sqrt(np.mean((intervals - dt) ** 2)) * 1e3),
+        p99_ms=float(np.percentile(intervals, 99) * 1e3),
+    )
+
+
+def bench_light(effect, led_count, duration, dt):
+    spi = FakeSpi()
+    controller = LightStripController(dt=dt, led_count=led_count, spi=spi)
+    controller.set_mode(effect, 60, [255, 160, 8])
+    if effect == "spectrum":
+        controller.spectrum_timeout = float("inf")
+        controller.set_bands(np.random.rand(16).astype(np.float32))
+
+    # jitter of the run thread as it runs on the device
+    spi.transfers.clear()
+    time.sleep(duration)
+    stop_thread(controller)
+    result = interval_stats([t for t, _ in spi.transfers], dt)
+    result.update(effect=effect, led_count=led_count)
+
+    # throughput with the thread stopped, update() back to back
+    st = time.perf_counter()
+    frames = 0
+    while time.perf_counter() - st < duration:
+        controller.update()
+        frames += 1
+    result["fps"] = frames / (time.perf_counter() - st)
+    result["wire_ms"] = spi.wire_seconds(len(spi.last_data)) * 1e3
+    return result
+
+
+def bench_pulse(led_count, dt, n_pulses, max_pulse_s):
+    """Pulses over breathe, which never renders a dark frame, so the first
+    dark frame after send_pulse() is the pulse's."""
+    spi = PulseSpi()
+    controller = LightStripController(dt=dt, led_count=led_count, spi=spi)
+    controller.set_mode("breathe", 60, [255, 160, 8])
+    result = dict(effect="pulse", led_count=led_count, pulse_latency_ms=None)
+
+    # a pulse renders one frame per pixel for four turns, skip counts where
+    # that takes longer than max_pulse_s
+    st = time.perf_counter()
+    for _ in range(5):
+        controller.strip.show()
+    frame_s = (time.perf_counter() - st) / 5
+    result["pulse_s"] = 4 * led_count * frame_s
+    if result["pulse_s"] > max_pulse_s:
+        stop_thread(controller)
+        return result
+
+    latencies = []
+    for _ in range(n_pulses):
+        # land anywhere in the tick
+        time.sleep(np.random.uniform(dt, 3 * dt))
+        n_dark = len(spi.dark_frames)
+        n_frames = len(spi.transfers)
+        st = time.perf_counter()
+        controller.send_pulse("", 255, 0.0)
+        while len(spi.dark_frames) == n_dark:
+            time.sleep(0.0001)
+        latencies.append(spi.dark_frames[n_dark] - st)
+        while controller.do_pulse:
+            time.sleep(0.001)
+        pulse_frames = list(spi.transfers)[n_frames:]
+    stop_thread(controller)
+    result["pulse_latency_ms"] = float(np.median(latencies) * 1e3)
+    # render rate of the last pulse
+    times = [t for t, _ in pulse_frames if t >= spi.dark_frames[n_dark]]
+    result["fps"] = (len(times) - 1) / (times[-1] - times[0])
+    result["wire_ms"] = spi.wire_seconds(len(spi.last_data)) * 1e3
+    return result
+
+
+def bench_ferro(duration, dt):
+    gpio = FakeGPIO()
+    controller = FerroFluidController(dt=dt, gpio=gpio)
+    controller.set_mode("walk", 120)
+
+    # every tick changes several duty cycles back to back, group them
+    gpio.duty_changes.clear()
+    time.sleep(duration)
+    stop_thread(controller)
+    times = np.array([t for t, _, _ in gpio.duty_changes])
+    ticks = times[np.concatenate(([True], np.diff(times) > dt / 2))] if len(times) else times
+    result = interval_stats(ticks, dt)
+    result.update(effect="ferro walk", led_count=None)
+
+    st = time.perf_counter()
+    frames = 0
+    while time.perf_counter() - st < duration:
+        controller.t += dt
+        controller.update()
+        frames += 1
+    result["fps"] = frames / (time.perf_counter() - st)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Print and count the regressions of results against baseline."""
+    previous = {(r["effect"], r["led_count"]): r for r in baseline}
+    regressions = 0
+    for r in results:
+        old = previous.get((r["effect"], r["led_count"]))
+        if old is None:
+            continue
+        name = r["effect"] if r["led_count"] is None else f"{r['effect']} x{r['led_count']}"
+        if "fps" in r and "fps" in old and r["fps"] < old["fps"] * (1 - tolerance):
+            print(f"REGRESSION {name}: {old['fps']:.0f} -> {r['fps']:.0f} fps")
+            regressions += 1
+        new_lat, old_lat = r.get("pulse_latency_ms"), old.get("pulse_latency_ms")
+        if new_lat is not None and old_lat is not None and new_lat > old_lat * (1 + tolerance):
+            print(f"REGRESSION {name}: pulse latency {old_lat:.2f} -> {new_lat:.2f} ms")
+            regressions += 1
+    return regressions
+
+
+def format_row(r):
+    def cell(key, width, fmt):
+        value = r.get(key)
+        return f"{'-' if value is None else format(value, fmt):>{width}}"
+
+    return " ".join(
+        [
+            f"{r['effect']:>12}",
+            cell("led_count", 6, "d"),
+            cell("fps", 9, ".0f"),
+            cell("wire_ms", 8, ".2f"),
+            cell("mean_ms", 8, ".2f"),
+            cell("jitter_ms", 9, ".2f"),
+            cell("p99_ms", 8, ".2f"),
+            cell("pulse_latency_ms", 9, ".2f"),
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--counts", type=int, nargs="+", default=DEFAULT_COUNTS, help="LED counts")
+    parser.add_argument("--effects", nargs="+", default=EFFECTS, choices=EFFECTS)
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds per measurement")
+    parser.add_argument("--dt", type=float, default=0.005, help="light strip tick")
+    parser.add_argument("--pulses", type=int, default=5, help="pulses per latency measurement")
+    parser.add_argument("--max-pulse-s", type=float, default=5.0, help="skip longer pulses")
+    parser.add_argument("--no-ferro", action="store_true")
+    parser.add_argument("--save", help="write the results as json")
+    parser.add_argument("--compare", help="json results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    runs = [
+        (bench_light, (effect, n, args.duration, args.dt))
+        for effect in args.effects
+        for n in args.counts
+    ]
+    runs += [(bench_pulse, (n, args.dt, args.pulses, args.max_pulse_s)) for n in args.counts]
+    if not args.no_ferro:
+        runs.append((bench_ferro, (args.duration, 0.01)))
+
+    print(f"{'effect':>12} {'leds':>6} {'fps':>9} {'wire ms':>8} {'tick ms':>8} {'jitter ms':>9} {'p99 ms':>8} {'pulse ms':>9}")
+    results = []
+    for bench, bench_args in runs:
+        # the controllers print on every mode change and pulse
+        with contextlib.redirect_stdout(io.StringIO()):
+            r = bench(*bench_args)
+        results.append(r)
+        print(format_row(r))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        print(f"{regressions} regressions against {args.compare}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,71 @@ colors_dict = {
 # analyzer paramters
 sr = 44100
 delay_seconds = 0.2
+# capture fragment requested from pulseaudio, ~ one hop
+fragment_seconds = 0.01
+# how long to wait for the audio monitor to start capturing
+startup_timeout_s = 5.0
 history_s = 0.5
 hop_length = 512
 frame_length = 2048
+# "linear" computes spectral flux over all STFT bins, "mel" over n_mels log-mel bands
+onset_mode = "linear"
+n_mels = 48
+# band levels streamed to the light strip every hop for its "spectrum" mode,
+# 0 keeps the light strip on pulses and canned animations
+spectrum_bands = 0
+# fraction of real time a hop's analysis may take before the analyser steps
+# down to cheaper configurations (shorter history, fewer bins, energy flux
+# only), None always analyses in full. The preallocated analyser never degrades
+cost_budget = 0.8
+# after this many seconds of silence the analyser stops analysing and the
+# controllers switch to a low frame rate ambient effect until sound returns,
+# None never idles
+idle_after_s = 10.0
+# capture fragments with an RMS (full scale = 1) at or below this are silent
+silence_threshold = 1e-3
+# analyse in workspaces allocated once instead of allocating every hop, for
+# steadier hop latency (music_analyser/preallocated.py, not with --track-cache)
+preallocate = False
+
+# runtime.py profiles, main.py runs "hop" and main_poll.py "poll"
+# read: "hop" analyses hops_per_analyse hops at a time, "queue" all the audio
+#     queued since the last read
+# poll_s: how often capture checks the monitor for new audio
+# capture_timeout_s: warn when no audio arrived for this long
+# frame_queue: reads waiting for analysis, the oldest is dropped beyond
+# analyse_deadline_s: a hop analysed later than this after its audio was read
+#     is late, and its pulse is dropped
+# event_deadline_s: controller events waiting longer than this are dropped
+# send_timeout_s: give up waiting for a controller server after this long
+profiles = {
+    "hop": dict(
+        read="hop",
+        poll_s=0.002,
+        capture_timeout_s=1.0,
+        frame_queue=8,
+        analyse_deadline_s=0.1,
+        event_deadline_s=0.05,
+        send_timeout_s=0.1,
+    ),
+    "poll": dict(
+        read="queue",
+        poll_s=0.005,
+        capture_timeout_s=1.0,
+        frame_queue=2,
+        analyse_deadline_s=0.15,
+        event_deadline_s=0.05,
+        send_timeout_s=0.1,
+    ),
+}
+runtime_profile = "hop"
 
 # change this to accomadate the audio monitor
 # analyze time (~0.02s) ~= hops_per_analyse * time_interval (hop_length / sr ~ 0.01s)
-hops_per_analyse = 3
\ No newline at end of file
+hops_per_analyse = 3
+# publish controller events to every node running
+# `python -m controller.<light|ferro>_controller --publisher <this host>`
+# instead of requesting the servers on localhost
+fanout = False
+# how far ahead events are scheduled, must cover the slowest node's network
+fanout_lead_s = 0.05
@@ -0,0 +1,115 @@
+"""Output backends for the controllers.
+
+The hardware backends import spidev and RPi.GPIO only when they are opened,
+so the controllers can be imported and driven anywhere. The fakes keep the
+same interface and timestamp every SPI transfer and duty cycle change, which
+is what the benchmarks (benchmarks/controllers.py) measure.
+"""
+import collections
+import time
+
+# recorded events kept per fake, enough for minutes of output at 200 Hz
+MAX_EVENTS = 100000
+
+
+def open_spi(bus, device, max_speed_hz):
+    import spidev
+
+    spi = spidev.SpiDev()
+    spi.open(bus, device)
+    spi.max_speed_hz = max_speed_hz
+    return spi
+
+
+def import_gpio():
+    import RPi.GPIO as GPIO
+
+    return GPIO
+
+
+class FakeSpi:
+    def __init__(self, simulate_wire_time=False):
+        """
+        simulate_wire_time: block in xfer2 for as long as the bytes would take
+            on the wire at max_speed_hz, as spidev does
+        """
+        self.max_speed_hz = 8000000
+        self.simulate_wire_time = simulate_wire_time
+        # (time, n_bytes) of every transfer, time from time.perf_counter
+        self.transfers = collections.deque(maxlen=MAX_EVENTS)
+        # all transfers, including those no longer kept
+        self.n_transfers = 0
+        self.last_data = None
+
+    def open(self, bus, device):
+        pass
+
+    def wire_seconds(self, n_bytes):
+        return n_bytes * 8 / self.max_speed_hz
+
+    def xfer2(self, data):
+        self.transfers.append((time.perf_counter(), len(data)))
+        self.n_transfers += 1
+        self.last_data = data
+        if self.simulate_wire_time:
+            time.sleep(self.wire_seconds(len(data)))
+        return [0] * len(data)
+
+    def close(self):
+        pass
+
+
+class FakePWM:
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0
+
+    def start(self, duty_cycle):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.gpio.duty_changes.append((time.perf_counter(), self.pin, duty_cycle))
+        self.gpio.n_duty_changes += 1
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+
+class FakeGPIO:
+    """Stands in for the RPi.GPIO module."""
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.mode = None
+        self.pins = {}
+        # (time, pin, value) of every output / duty cycle change
+        self.outputs = collections.deque(maxlen=MAX_EVENTS)
+        self.duty_changes = collections.deque(maxlen=MAX_EVENTS)
+        self.n_duty_changes = 0
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction):
+        self.pins[pin] = direction
+
+    def output(self, pin, value):
+        self.outputs.append((time.perf_counter(), pin, value))
+
+    def PWM(self, pin, frequency):
+        return FakePWM(self, pin, frequency)
+
+    def cleanup(self):
+        self.pins.clear()
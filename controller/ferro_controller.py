@@ -2,10 +2,15 @@ import time
 import numpy as np
 import zmq
 import threading
-import RPi.GPIO as GPIO
+
+from .backends import import_gpio
+from .inbox import EventInbox
+from .journal import EventJournal
 
 class FerroFluidController:
-    def __init__(self, dt=0.01):
+    def __init__(self, dt=0.01, gpio=None):
+        # gpio: the RPi.GPIO module, or backends.FakeGPIO off-device
+        self.gpio = GPIO = gpio if gpio is not None else import_gpio()
         self.pins = {
             'downleft': 26,
             'downright': 16,
@@ -28,6 +33,12 @@ class FerroFluidController:
 
         self.dt = dt
         self.t = 0
+        # nothing is playing: the fluid rests on the middle magnet, held at
+        # ambient_duty, and the loop only wakes up every idle_dt
+        self.idle = False
+        self.idle_dt = 0.1
+        self.ambient_duty = 60
+        self.ambient_set = False
         self.mode = "walk"
         self.pulse_pattern = "NULL"
         self.pattern_interval = 10.0
@@ -38,6 +49,7 @@ class FerroFluidController:
         self.target_magnet_idx = 0
         self.default_intensity = 90
         self.pulse_strength = 20
+        self.pulses_expired = 0
 
         self.running = True
         self.run_thread = threading.Thread(target=self.run)
@@ -65,7 +77,15 @@ class FerroFluidController:
     def set_next_beat_time(self, next_beat_time):
         self.next_beat = next_beat_time
 
+    def set_idle(self, idle):
+        self.idle = idle
+        print(f"Ferrofluid {'idle' if idle else 'active'}")
+
     def update(self):
+        if self.idle:
+            self.ambient()
+            return
+        self.ambient_set = False
         if self.mode == "walk":
             self.walk()
         else:
@@ -106,13 +126,24 @@ class FerroFluidController:
         else:
             self.random_magnet_idx = self.target_magnet_idx
 
+    def ambient(self):
+        # set the duty cycles once, instead of toggling the PWM every tick
+        if self.ambient_set:
+            return
+        self._energyoff()
+        self.middle.ChangeDutyCycle(self.ambient_duty)
+        self.ambient_set = True
+
     def pulse(self):
         pulse_intensity = self.default_intensity - self.pulse_strength * (1 - np.cos(2 * np.pi * self.t / self.pattern_interval))
         magnet = self.get_magnet_by_idx(self.random_magnet_idx)
         magnet.ChangeDutyCycle(pulse_intensity)
 
-    def send_pulse(self, pulse_pattern_string, strength, duration):
+    def send_pulse(self, pulse_pattern_string, strength, duration, deadline=None):
         # TOFIX: next time, mimic the implmentation in light controller, all patterns run in the run thread
+        if deadline is not None and time.time() > deadline:
+            self.pulses_expired += 1
+            return
         self.pulse_strength = 50
         time.sleep(0.5)
         self.pulse_strength = self.default_intensity
@@ -134,7 +165,8 @@ class FerroFluidController:
             st = time.time()
             self.update()
             end = time.time()
-            sleep_time = max(0, self.dt - (end - st))
+            dt = self.idle_dt if self.idle else self.dt
+            sleep_time = max(0, dt - (end - st))
             self.t += (end - st) + sleep_time
             self.t %= self.pattern_interval
             time.sleep(sleep_time)
@@ -143,13 +175,36 @@ class FerroFluidController:
         self.running = False
         self.run_thread.join()
         self._energyoff()
-        GPIO.cleanup()
+        self.gpio.cleanup()
         print("FerrofluidController stopped and GPIO cleaned up.")
 
 
 class FerroControllerServer:
-    def __init__(self, fero_controller: FerroFluidController):
+    def __init__(
+        self,
+        fero_controller: FerroFluidController,
+        journal_path=None,
+        bind=True,
+        max_age=0.1,
+        tick_s=0.01,
+    ):
+        """
+        journal_path: append every received event to this journal
+        bind: listen for clients, False to only submit() and tick() (replay)
+        max_age: seconds a pulse without a deadline may wait to be applied
+        tick_s: longest wait between two ticks applying the received events
+        """
         self.fero_controller = fero_controller
+        self.journal = None
+        if journal_path is not None:
+            self.journal = EventJournal(journal_path, "ferro")
+        # events received since the last tick, coalesced when applied
+        self.inbox = EventInbox(max_age, wakeup=bind)
+        self.tick_s = tick_s
+        # set by a stop message, from any source
+        self.stopped = False
+        if not bind:
+            return
 
         # Set up ZMQ context and socket
         self.context = zmq.Context()
@@ -158,40 +213,80 @@ class FerroControllerServer:
 
     def run(self):
         print("Ferrofluid Controller Server started. Waiting for requests...")
-        while True:
-            message = self.socket.recv_pyobj()
-            print(f"Received message: {message}")
-
-            if message["type"] == "set_mode":
-                self.handle_set_mode(message["mode"], message["tempo"])
-            elif message["type"] == "send_pulse":
-                self.handle_send_pulse(
-                    message["pulse_pattern"],
-                    message["strength"],
-                    message["duration"],
-                )
-            elif message["type"] == "stop":
-                self.handle_stop()
-            else:
-                print("Unknown message type.")
-
-            self.socket.send_pyobj("OK")
-
-            if message["type"] == "stop":
-                break
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        # wakes up as soon as a fan-out subscriber submits an event, which
+        # it does at the synced fire time
+        poller.register(self.inbox, zmq.POLLIN)
+        while not self.stopped:
+            poller.poll(self.tick_s * 1000)
+            # drain every queued request, replying on receipt so clients
+            # never wait for a pulse
+            while self.socket.poll(0):
+                message = self.socket.recv_pyobj()
+                self.socket.send_pyobj("OK")
+                print(f"Received message: {message}")
+                self.submit(message)
+            self.tick()
+
+    def submit(self, message):
+        """Queue message for the next tick, from any thread."""
+        if self.journal is not None:
+            self.journal.append(message)
+        self.inbox.put(message)
+
+    def tick(self):
+        for message in self.inbox.drain():
+            self.handle_message(message)
+
+    def handle_message(self, message):
+        if message["type"] == "set_mode":
+            self.handle_set_mode(message["mode"], message["tempo"])
+        elif message["type"] == "send_pulse":
+            self.handle_send_pulse(
+                message["pulse_pattern"],
+                message["strength"],
+                message["duration"],
+                message.get("deadline"),
+            )
+        elif message["type"] == "set_idle":
+            self.handle_set_idle(message["idle"])
+        elif message["type"] == "stop":
+            self.handle_stop()
+        else:
+            print("Unknown message type.")
 
     def handle_set_mode(self, mode, tempo):
         self.fero_controller.set_mode(mode, tempo)
 
-    def handle_send_pulse(self, pulse_pattern, strength, duration):
-        self.fero_controller.send_pulse(pulse_pattern, strength, duration)
+    def handle_send_pulse(self, pulse_pattern, strength, duration, deadline=None):
+        self.fero_controller.send_pulse(pulse_pattern, strength, duration, deadline)
+
+    def handle_set_idle(self, idle):
+        self.fero_controller.set_idle(idle)
 
     def handle_stop(self):
-        self.fero_controller.stop()
+        if not self.stopped:
+            self.stopped = True
+            self.fero_controller.stop()
+            if self.journal is not None:
+                self.journal.close()
+            print(
+                f"Ferrofluid server events: {self.inbox.stats()}, "
+                f"{self.fero_controller.pulses_expired} pulses expired"
+            )
 
 
 class FerroControllerClient:
-    def __init__(self):
+    def __init__(self, journal_path=None, pulse_ttl=0.1):
+        # journal_path: append every event sent to this journal
+        # pulse_ttl: seconds a pulse stays worth applying, the server drops
+        # it after that, None for no deadline
+        self.pulse_ttl = pulse_ttl
+        self.journal = None
+        if journal_path is not None:
+            self.journal = EventJournal(journal_path, "ferro")
+
         # Set up ZMQ context and socket
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.REQ)
@@ -203,6 +298,7 @@ class FerroControllerClient:
             "mode": mode,
             "tempo": tempo,
         }
+        self._journal(message)
         self.socket.send_pyobj(message)
         response = self.socket.recv_pyobj()
         # print(f"Response from server: {response}")
@@ -214,26 +310,65 @@ class FerroControllerClient:
             "strength": strength,
             "duration": duration,
         }
+        if self.pulse_ttl is not None:
+            message["deadline"] = time.time() + self.pulse_ttl
+        self._journal(message)
+        self.socket.send_pyobj(message)
+        response = self.socket.recv_pyobj()
+        # print(f"Response from server: {response}")
+
+    def set_idle(self, idle):
+        # rest the fluid while nothing is playing (idle=True), and back
+        message = {"type": "set_idle", "idle": idle}
+        self._journal(message)
         self.socket.send_pyobj(message)
         response = self.socket.recv_pyobj()
         # print(f"Response from server: {response}")
 
+    def _journal(self, message):
+        if self.journal is not None:
+            self.journal.append(message)
+            if message["type"] == "stop":
+                self.journal.close()
+
     def stop(self):
         message = {"type": "stop"}
+        self._journal(message)
         self.socket.send_pyobj(message)
         response = self.socket.recv_pyobj()
         # print(f"Response from server: {response}")
 
 
 if __name__ == "__main__":
+    import argparse
     import threading
 
+    from .sync import EventSubscriber
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--publisher",
+        metavar="HOST",
+        help="also fire the events fanned out by the analyser on HOST",
+    )
+    parser.add_argument("--name", help="node name in the publisher stats")
+    parser.add_argument("--journal", metavar="PATH", help="journal every event, see controller.replay")
+    args = parser.parse_args()
+
     controller = FerroFluidController()
-    fero_controller_server = FerroControllerServer(controller)
+    fero_controller_server = FerroControllerServer(controller, journal_path=args.journal)
     
     # Start the server in a separate thread
     server_thread = threading.Thread(target=fero_controller_server.run)
     server_thread.start()
+    if args.publisher is not None:
+        subscriber = EventSubscriber(
+            fero_controller_server.submit,
+            "ferro",
+            host=args.publisher,
+            name=args.name,
+        )
+        threading.Thread(target=subscriber.run, daemon=True).start()
     
     # try:
     #     # Create a client and use it to control the ferrofluid
@@ -0,0 +1,114 @@
+"""Events waiting for a controller server's next tick.
+
+Servers put every event they receive into an EventInbox and apply what
+drain() returns once per tick, so a burst collapses into what is worth
+rendering:
+- set_idle, set_mode and bands: the latest wins
+- send_pulse: merged into one pulse with the largest strength and duration
+- pulses whose deadline (time.time() in the message) passed, or that waited
+  longer than max_age without one, are dropped; the beat has been heard. The
+  merged pulse carries the deadline on to the controller
+- stop and anything else are kept, in order, after the merged events
+
+    inbox = EventInbox(max_age=0.1, wakeup=True)
+    inbox.put(message)  # from any thread
+    poller.register(inbox, zmq.POLLIN)  # readable while events wait
+    for message in inbox.drain():
+        server.handle_message(message)
+"""
+import collections
+import os
+import threading
+import time
+
+# applied in this order, the last of each kind wins
+LATEST_WINS = ("set_idle", "set_mode", "bands")
+
+
+class EventInbox:
+    def __init__(self, max_age=0.1, clock=time.time, wakeup=False):
+        """
+        max_age: seconds a pulse without a deadline may wait
+        clock: the clock of the deadlines, wall clock like the clients'
+        wakeup: make fileno() readable while events wait, so a server polling
+            it applies the events put from other threads right away
+        """
+        self.max_age = max_age
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (receive time, message)
+        self.pending = []
+        # received, applied, coalesced (merged into a later or stronger
+        # event) and dropped (past their deadline)
+        self.counts = collections.Counter()
+        self.wakeup_fds = None
+        if wakeup:
+            self.wakeup_fds = os.pipe()
+            os.set_blocking(self.wakeup_fds[0], False)
+        # a byte is in the pipe
+        self.signalled = False
+
+    def fileno(self):
+        return self.wakeup_fds[0]
+
+    def put(self, message):
+        with self.lock:
+            self.pending.append((self.clock(), message))
+            self.counts["received"] += 1
+            if self.wakeup_fds is not None and not self.signalled:
+                self.signalled = True
+                os.write(self.wakeup_fds[1], b"\0")
+
+    def deadline(self, received, message):
+        deadline = message.get("deadline")
+        if deadline is None and message.get("type") == "send_pulse":
+            deadline = received + self.max_age
+        return deadline
+
+    def drain(self):
+        """Coalesced events received since the last drain, in the order to
+        apply them."""
+        with self.lock:
+            batch, self.pending = self.pending, []
+            if self.signalled:
+                self.signalled = False
+                os.read(self.wakeup_fds[0], 1)
+        if not batch:
+            return []
+        now = self.clock()
+        latest = {}
+        pulse = None
+        rest = []
+        for received, message in batch:
+            kind = message.get("type")
+            deadline = self.deadline(received, message)
+            if deadline is not None and now > deadline:
+                self.counts["dropped"] += 1
+            elif kind in LATEST_WINS:
+                if kind in latest:
+                    self.counts["coalesced"] += 1
+                latest[kind] = message
+            elif kind == "send_pulse":
+                if pulse is None:
+                    # the controller drops it too if it only gets to it late
+                    pulse = dict(message, deadline=deadline)
+                else:
+                    self.counts["coalesced"] += 1
+                    if message["strength"] > pulse["strength"]:
+                        pulse["pulse_pattern"] = message["pulse_pattern"]
+                        pulse["strength"] = message["strength"]
+                    pulse["duration"] = max(pulse["duration"], message["duration"])
+                    pulse["deadline"] = max(pulse["deadline"], deadline)
+            else:
+                rest.append(message)
+
+        events = [latest[kind] for kind in LATEST_WINS if kind in latest]
+        if pulse is not None:
+            events.append(pulse)
+        events += rest
+        self.counts["applied"] += len(events)
+        return events
+
+    def stats(self):
+        c = self.counts
+        return f"{c['received']} received, {c['applied']} applied, {c['coalesced']} coalesced, {c['dropped']} dropped"
@@ -0,0 +1,143 @@
+"""Binary journal of controller events, for replaying shows.
+
+A journal starts with a 32 byte header (magic, target, wall clock start time)
+followed by one record per event: a 13 byte record header (seconds since the
+start, event type, payload length) and the payload. The common events have
+fixed struct payloads, anything else is pickled:
+
+    set_mode    <fBBBB tempo, has_color, r, g, b + mode (utf8)
+    send_pulse  <fff strength, duration, ttl + pulse pattern (utf8)
+    bands       float32 band levels
+    stop        empty
+
+A pulse's deadline is kept as its ttl, the seconds it had left when it was
+journalled (NaN without one), and read back as "ttl" for the replay to set a
+deadline from.
+
+    journal = EventJournal("show.journal", "light")
+    journal.append(message)
+    header, events = read_journal("show.journal")
+"""
+import pickle
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b"CTLJRN02"
+# magic, target, start time (time.time())
+HEADER_FORMAT = "<8s16sd"
+# seconds since start, type, payload length
+RECORD_FORMAT = "<dBI"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+SET_MODE, SEND_PULSE, BANDS, STOP, PICKLED = 1, 2, 3, 4, 255
+TYPE_CODES = {"set_mode": SET_MODE, "send_pulse": SEND_PULSE, "bands": BANDS, "stop": STOP}
+
+
+def encode(message, now):
+    """now: time.time() when the message was received, for the ttl of a
+    pulse"""
+    kind = TYPE_CODES.get(message.get("type"), PICKLED)
+    if kind == SET_MODE:
+        color = message.get("base_color")
+        head = struct.pack(
+            "<fBBBB",
+            message["tempo"],
+            color is not None,
+            *(np.clip(color, 0, 255).astype(int) if color is not None else (0, 0, 0)),
+        )
+        return kind, head + message["mode"].encode()
+    if kind == SEND_PULSE:
+        deadline = message.get("deadline")
+        ttl = deadline - now if deadline is not None else float("nan")
+        head = struct.pack("<fff", message["strength"], message["duration"], ttl)
+        return kind, head + message["pulse_pattern"].encode()
+    if kind == BANDS:
+        return kind, bytes(message["data"])
+    if kind == STOP:
+        return kind, b""
+    return kind, pickle.dumps(message)
+
+
+def decode(kind, payload):
+    if kind == SET_MODE:
+        tempo, has_color, r, g, b = struct.unpack_from("<fBBBB", payload)
+        message = {"type": "set_mode", "mode": payload[8:].decode(), "tempo": tempo}
+        if has_color:
+            message["base_color"] = [r, g, b]
+        return message
+    if kind == SEND_PULSE:
+        strength, duration, ttl = struct.unpack_from("<fff", payload)
+        message = {
+            "type": "send_pulse",
+            "pulse_pattern": payload[12:].decode(),
+            "strength": strength,
+            "duration": duration,
+        }
+        if ttl == ttl:
+            message["ttl"] = ttl
+        return message
+    if kind == BANDS:
+        return {"type": "bands", "data": payload}
+    if kind == STOP:
+        return {"type": "stop"}
+    return pickle.loads(payload)
+
+
+class EventJournal:
+    def __init__(self, path, target, flush_interval=1.0):
+        """
+        target: "light" or "ferro", which controller the events are for
+        flush_interval: seconds between flushes to disk, what a crash can lose
+        """
+        self.file = open(path, "wb")
+        self.start = time.monotonic()
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, target.encode(), time.time()))
+        self.flush_interval = flush_interval
+        self.last_flush = self.start
+        self.count = 0
+        # servers append from their REP and fan-out threads
+        self.lock = threading.Lock()
+
+    def append(self, message):
+        kind, payload = encode(message, time.time())
+        with self.lock:
+            if self.file.closed:
+                return
+            now = time.monotonic()
+            self.file.write(struct.pack(RECORD_FORMAT, now - self.start, kind, len(payload)))
+            self.file.write(payload)
+            self.count += 1
+            if now - self.last_flush > self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_journal(path):
+    """Returns (header, events) with events a list of (seconds since start,
+    message). A record cut short by a crash ends the journal."""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, target, start_time = struct.unpack_from(HEADER_FORMAT, data)
+    if magic[:6] == MAGIC[:6] and magic != MAGIC:
+        raise ValueError(f"{path} is a journal of an older format")
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a controller journal")
+    header = dict(target=target.rstrip(b"\0").decode(), start_time=start_time)
+
+    events = []
+    offset = struct.calcsize(HEADER_FORMAT)
+    while offset + RECORD_SIZE <= len(data):
+        t, kind, length = struct.unpack_from(RECORD_FORMAT, data, offset)
+        offset += RECORD_SIZE
+        if offset + length > len(data):
+            break
+        events.append((t, decode(kind, data[offset : offset + length])))
+        offset += length
+    return header, events
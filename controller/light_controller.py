@@ -6,9 +6,12 @@ import os
 import numpy as np
 import threading
 import time
-import spidev
 import zmq
 
+from .backends import open_spi
+from .inbox import EventInbox
+from .journal import EventJournal
+
 # LED strip configuration:
 LED_COUNT = 14  # Number of LED pixels.
 SPI_BUS = 0  # SPI bus (default is 0)
@@ -16,6 +19,12 @@ SPI_DEVICE = 0  # SPI device (default is 0)
 SPI_MAX_SPEED_HZ = 8000000  # Maximum speed for SPI in Hz
 LED_BRIGHTNESS = 100
 
+# SPI bytes for every value of a color byte, WS2812 bits are sent as one
+# SPI byte each: 0b11111000 for a 1 bit, 0b11000000 for a 0 bit
+SPI_LUT = np.where(
+    (np.arange(256)[:, None] >> (7 - np.arange(8))) & 1, 0b11111000, 0b11000000
+).astype(np.uint8)
+
 
 class Color:
     def __init__(self, r, g, b):
@@ -26,14 +35,24 @@ class Color:
 
 class PixelStrip:
     def __init__(
-        self, LED_COUNT=0, LED_FREQ_HZ=0, LED_BUS=0, LED_DEVICE=0, LED_BRIGHTNESS=255
+        self,
+        LED_COUNT=0,
+        LED_FREQ_HZ=0,
+        LED_BUS=0,
+        LED_DEVICE=0,
+        LED_BRIGHTNESS=255,
+        spi=None,
     ):
-        self.strip = spidev.SpiDev()
-        self.strip.open(LED_BUS, LED_DEVICE)
-        self.strip.max_speed_hz = LED_FREQ_HZ
+        # spi: an spidev.SpiDev like object, e.g. backends.FakeSpi off-device
+        if spi is None:
+            spi = open_spi(LED_BUS, LED_DEVICE, LED_FREQ_HZ)
+        else:
+            spi.max_speed_hz = LED_FREQ_HZ
+        self.strip = spi
 
         self.LED_COUNT = LED_COUNT
-        self.led_colors = [Color(0, 0, 0)] * self.LED_COUNT
+        # (LED_COUNT, 3) rgb
+        self.led_colors = np.zeros((self.LED_COUNT, 3))
 
         self.Brightness = LED_BRIGHTNESS
 
@@ -43,51 +62,65 @@ class PixelStrip:
 
     def setPixelColor(self, n: int, color: Color):
         if 0 <= n < self.LED_COUNT:
-            self.led_colors[n] = color
+            self.led_colors[n] = (color.r, color.g, color.b)
+
+    def setPixelColors(self, colors):
+        """Set every pixel at once from an (n_pixels, 3) rgb array."""
+        self.led_colors[:] = colors
 
     def rgb_to_spi_data(self, r, g, b):
-        r, g, b = int(r), int(g), int(b)
-        data = []
-        for color in [g, r, b]:  # WS2812 expects GRB order
-            for i in range(8):
-                if color & (1 << (7 - i)):
-                    data.append(0b11111000)  # 1 bit
-                else:
-                    data.append(0b11000000)  # 0 bit
-        return data
+        return self.colors_to_spi_data(np.array([[r, g, b]])).tolist()
+
+    def colors_to_spi_data(self, colors):
+        # truncate and keep the low byte, as int(x) & (1 << bit) did
+        values = np.trunc(colors[:, [1, 0, 2]]).astype(np.int64) & 0xFF  # GRB order
+        return SPI_LUT[values].reshape(-1)
 
     def show(self):
         k = self.Brightness / 255
-        data = [
-            self.rgb_to_spi_data(color.r * k, color.g * k, color.b * k)
-            for color in self.led_colors
-        ]
-        # flatten the list
-        data = sum(data, [])
-        self.strip.xfer2(data)
+        self.strip.xfer2(self.colors_to_spi_data(self.led_colors * k).tolist())
 
     def numPixels(self):
         return self.LED_COUNT
 
 
 class LightStripController:
-    def __init__(self, dt=0.005):
+    def __init__(self, dt=0.005, led_count=LED_COUNT, spi=None):
         self.strip = PixelStrip(
-            LED_COUNT,
+            led_count,
             SPI_MAX_SPEED_HZ,
             SPI_BUS,
             SPI_DEVICE,
             LED_BRIGHTNESS,
+            spi=spi,
         )
 
         self.dt = dt
         self.t = 0
+        # nothing is playing: a slow ambient glow rendered every idle_dt
+        # instead of the mode, see set_idle
+        self.idle = False
+        self.idle_dt = 0.1
+        self.ambient_period = 8.0
 
         self.mode = "walk"
         self.pulse_pattern = "NULL"
         self.pattern_interval = 2.0
         self.base_color = Color(0, 0, 0)
         self.do_pulse = False
+        # time.time() after which a pending pulse is no longer worth starting
+        self.pulse_deadline = None
+        self.pulses_expired = 0
+
+        # latest band vector for the spectrum mode, see set_bands
+        self.bands = None
+        self.bands_time = 0
+        self.levels = np.zeros(led_count)
+        # per tick smoothing of the pixel levels when rising / falling
+        self.spectrum_attack = 0.6
+        self.spectrum_decay = 0.15
+        # bands older than this fade out
+        self.spectrum_timeout = 0.5
 
         n_pixels = self.strip.numPixels()
         self.rand_pixels = int(0.5 * n_pixels)
@@ -128,15 +161,27 @@ class LightStripController:
             self.water()
         elif self.mode == "sparkling":
             self.sparkling()
+        elif self.mode == "spectrum":
+            self.spectrum()
         else:
             pass
             # print(f"Invalid mode for {self.__class__.__name__}")
 
-    def send_pulse(self, pulse_pattern_string, strength, duration):
-        self.do_pulse = True
+    def set_bands(self, bands):
+        # only the latest vector is rendered, older ones are simply replaced
+        self.bands = bands
+        self.bands_time = time.time()
+
+    def set_idle(self, idle):
+        self.idle = idle
+        print(f"Light strip {'idle' if idle else 'active'}")
+
+    def send_pulse(self, pulse_pattern_string, strength, duration, deadline=None):
         # TOFIX
         self.pulse_strength = 255
         self.pulse_duration = duration
+        self.pulse_deadline = deadline
+        self.do_pulse = True
 
     def pulse(self, strength, duration):
         # turn off then turn on for several times
@@ -162,12 +207,20 @@ class LightStripController:
         while self.running:
             st = time.time()
             if self.do_pulse:
-                self.pulse(self.pulse_strength, self.pulse_duration)
                 self.do_pulse = False
+                # pulses sent while the last one was rendering only start
+                # if they are still on time
+                if self.pulse_deadline is not None and time.time() > self.pulse_deadline:
+                    self.pulses_expired += 1
+                else:
+                    self.pulse(self.pulse_strength, self.pulse_duration)
+            elif self.idle:
+                self.ambient()
             else:
                 self.update()
             end = time.time()
-            sleep_time = max(0, self.dt - (end - st))
+            dt = self.idle_dt if self.idle else self.dt
+            sleep_time = max(0, dt - (end - st))
             self.t += (end - st) + sleep_time
             self.t %= self.pattern_interval
             time.sleep(sleep_time)
@@ -245,6 +298,34 @@ class LightStripController:
                 self.strip.setPixelColor(i, Color(0, 0, 0))
         self.strip.show()
 
+    def spectrum(self):
+        # in this mode the band levels streamed by the analyser are spread
+        # over the strip, low bands at the start, and drive the brightness of
+        # the base color of each pixel
+        bands = self.bands
+        num_pixels = self.strip.numPixels()
+        if bands is None or time.time() - self.bands_time > self.spectrum_timeout:
+            target = np.zeros(num_pixels)
+        else:
+            target = np.interp(
+                np.linspace(0, 1, num_pixels), np.linspace(0, 1, len(bands)), bands
+            )
+        rate = np.where(target > self.levels, self.spectrum_attack, self.spectrum_decay)
+        self.levels += rate * (target - self.levels)
+
+        self.strip.setBrightness(LED_BRIGHTNESS)
+        self.strip.setPixelColors(np.outer(self.levels, self.start_color))
+        self.strip.show()
+
+    def ambient(self):
+        # in this mode the whole strip slowly breathes the base color at low
+        # brightness, while nothing is playing
+        phase = 2 * np.pi * time.time() / self.ambient_period
+        brightness = LED_BRIGHTNESS * (0.2 + 0.1 * np.cos(phase))
+        self.strip.setBrightness(brightness)
+        self.strip.setPixelColors(self.start_color)
+        self.strip.show()
+
     def stop(self):
         self.running = False
         self.run_thread.join()
@@ -282,58 +363,135 @@ class LightControllerServer:
     def __init__(
         self,
         light_controller1: LightStripController,
+        journal_path=None,
+        bind=True,
+        max_age=0.1,
+        tick_s=0.01,
     ):
+        """
+        journal_path: append every received event to this journal
+        bind: listen for clients, False to only submit() and tick() (replay)
+        max_age: seconds a pulse without a deadline may wait to be applied
+        tick_s: longest wait between two ticks applying the received events
+        """
         self.light_controller1 = light_controller1
+        self.journal = None
+        if journal_path is not None:
+            self.journal = EventJournal(journal_path, "light")
+        # events received since the last tick, coalesced when applied
+        self.inbox = EventInbox(max_age, wakeup=bind)
+        self.tick_s = tick_s
+        # set by a stop message, from any source
+        self.stopped = False
+        if not bind:
+            return
 
         # Set up ZMQ context and socket
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.REP)
         self.socket.bind("tcp://*:5555")
+        # band vectors for the spectrum mode, raw float32. CONFLATE keeps
+        # only the newest one queued, a slow render loop never falls behind
+        self.spectrum_socket = self.context.socket(zmq.SUB)
+        self.spectrum_socket.setsockopt(zmq.CONFLATE, 1)
+        self.spectrum_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        self.spectrum_socket.bind("tcp://*:5557")
 
     def run(self):
         print("Light Controller Server started. Waiting for requests...")
-        while True:
-            message = self.socket.recv_pyobj()
-            print(f"Received message: {message}")
-
-            if message["type"] == "set_mode":
-                self.handle_set_mode(
-                    message["mode"],
-                    message["tempo"],
-                    message["base_color"],
-                )
-            elif message["type"] == "send_pulse":
-                self.handle_send_pulse(
-                    message["pulse_pattern"],
-                    message["strength"],
-                    message["duration"],
-                )
-            elif message["type"] == "stop":
-                self.handle_stop()
-            else:
-                print("Unknown message type.")
-
-            self.socket.send_pyobj("OK")
-
-            if message["type"] == "stop":
-                break
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.spectrum_socket, zmq.POLLIN)
+        # wakes up as soon as a fan-out subscriber submits an event, which
+        # it does at the synced fire time
+        poller.register(self.inbox, zmq.POLLIN)
+        while not self.stopped:
+            events = dict(poller.poll(self.tick_s * 1000))
+            if self.spectrum_socket in events:
+                self.submit({"type": "bands", "data": self.spectrum_socket.recv()})
+            # drain every queued request, replying on receipt so clients
+            # never wait for the rendering
+            while self.socket.poll(0):
+                message = self.socket.recv_pyobj()
+                self.socket.send_pyobj("OK")
+                print(f"Received message: {message}")
+                self.submit(message)
+            self.tick()
+
+    def submit(self, message):
+        """Queue message for the next tick, from any thread."""
+        if self.journal is not None:
+            self.journal.append(message)
+        self.inbox.put(message)
+
+    def tick(self):
+        for message in self.inbox.drain():
+            self.handle_message(message)
+
+    def handle_message(self, message):
+        if message["type"] == "set_mode":
+            self.handle_set_mode(
+                message["mode"],
+                message["tempo"],
+                message["base_color"],
+            )
+        elif message["type"] == "send_pulse":
+            self.handle_send_pulse(
+                message["pulse_pattern"],
+                message["strength"],
+                message["duration"],
+                message.get("deadline"),
+            )
+        elif message["type"] == "bands":
+            self.handle_bands(message["data"])
+        elif message["type"] == "set_idle":
+            self.handle_set_idle(message["idle"])
+        elif message["type"] == "stop":
+            self.handle_stop()
+        else:
+            print("Unknown message type.")
 
     def handle_set_mode(self, mode, tempo, base_color):
         self.light_controller1.set_mode(mode, tempo, base_color)
 
-    def handle_send_pulse(self, pulse_pattern, strength, duration):
-        self.light_controller1.send_pulse(pulse_pattern, strength, duration)
+    def handle_send_pulse(self, pulse_pattern, strength, duration, deadline=None):
+        self.light_controller1.send_pulse(pulse_pattern, strength, duration, deadline)
+
+    def handle_bands(self, data):
+        self.light_controller1.set_bands(np.frombuffer(data, dtype=np.float32))
+
+    def handle_set_idle(self, idle):
+        self.light_controller1.set_idle(idle)
 
     def handle_stop(self):
-        self.light_controller1.stop()
+        if not self.stopped:
+            self.stopped = True
+            self.light_controller1.stop()
+            if self.journal is not None:
+                self.journal.close()
+            print(
+                f"Light server events: {self.inbox.stats()}, "
+                f"{self.light_controller1.pulses_expired} pulses expired while rendering"
+            )
 
 
 class LightControllerClient:
-    def __init__(self):
+    def __init__(self, journal_path=None, pulse_ttl=0.1):
+        # journal_path: append every event sent to this journal
+        # pulse_ttl: seconds a pulse stays worth rendering, the server drops
+        # it after that, None for no deadline
+        self.pulse_ttl = pulse_ttl
+        self.journal = None
+        if journal_path is not None:
+            self.journal = EventJournal(journal_path, "light")
+
         # Set up ZMQ context and socket
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.REQ)
         self.socket.connect("tcp://localhost:5555")
+        self.spectrum_socket = self.context.socket(zmq.PUB)
+        self.spectrum_socket.setsockopt(zmq.CONFLATE, 1)
+        self.spectrum_socket.connect("tcp://localhost:5557")
 
     def set_mode(self, mode, tempo, base_color):
         message = {
@@ -342,6 +500,7 @@ class LightControllerClient:
             "tempo": tempo,
             "base_color": base_color,
         }
+        self._journal(message)
         self.socket.send_pyobj(message)
         response = self.socket.recv_pyobj()
         # print(f"Response from server: {response}")
@@ -353,18 +512,59 @@ class LightControllerClient:
             "strength": strength,
             "duration": duration,
         }
+        if self.pulse_ttl is not None:
+            message["deadline"] = time.time() + self.pulse_ttl
+        self._journal(message)
         self.socket.send_pyobj(message)
         response = self.socket.recv_pyobj()
         # print(f"Response from server: {response}")
 
+    def set_idle(self, idle):
+        """Switch to the ambient effect while nothing is playing (idle=True)
+        and back."""
+        message = {"type": "set_idle", "idle": idle}
+        self._journal(message)
+        self.socket.send_pyobj(message)
+        response = self.socket.recv_pyobj()
+        # print(f"Response from server: {response}")
+
+    def send_bands(self, bands):
+        """Stream a band vector (values in [0, 1]) for the spectrum mode.
+        Fire and forget, vectors the server has not rendered yet are
+        replaced."""
+        data = np.asarray(bands, dtype=np.float32).tobytes()
+        self._journal({"type": "bands", "data": data})
+        self.spectrum_socket.send(data)
+
+    def _journal(self, message):
+        if self.journal is not None:
+            self.journal.append(message)
+            if message["type"] == "stop":
+                self.journal.close()
+
     def stop(self):
         message = {"type": "stop"}
+        self._journal(message)
         self.socket.send_pyobj(message)
         response = self.socket.recv_pyobj()
         # print(f"Response from server: {response}")
 
 
 if __name__ == "__main__":
+    import argparse
+
+    from .sync import EventSubscriber
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--publisher",
+        metavar="HOST",
+        help="also fire the events fanned out by the analyser on HOST",
+    )
+    parser.add_argument("--name", help="node name in the publisher stats")
+    parser.add_argument("--journal", metavar="PATH", help="journal every event, see controller.replay")
+    args = parser.parse_args()
+
     # try:
     #     light_controller = LightStripController()
     #     light_controller_server = LightControllerServer(light_controller)
@@ -373,11 +573,19 @@ if __name__ == "__main__":
     #     pass
 
     light_controller = LightStripController()
-    light_controller_server = LightControllerServer(light_controller)
+    light_controller_server = LightControllerServer(light_controller, journal_path=args.journal)
     import threading
 
     server_thread = threading.Thread(target=light_controller_server.run)
     server_thread.start()
+    if args.publisher is not None:
+        subscriber = EventSubscriber(
+            light_controller_server.submit,
+            "light",
+            host=args.publisher,
+            name=args.name,
+        )
+        threading.Thread(target=subscriber.run, daemon=True).start()
 
     # try:
     #     light_controller_client = LightControllerClient()
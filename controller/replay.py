@@ -0,0 +1,121 @@
+"""Replay a controller journal into a controller on fake hardware.
+
+    python -m controller.replay show.journal               # real time
+    python -m controller.replay show.journal --fast        # as fast as possible
+    python -m controller.replay show.journal --speed 4 --led-count 300
+
+The events go through the server's submit() and tick(), batched per tick
+as they would arrive from clients, and the controller renders to FakeSpi /
+FakeGPIO. Pulses get as much time before their deadline as they had left
+when they were journalled, so the replay drops the pulses the show received too late. At the end the
+replay reports how many events per second were absorbed and what reached the
+output. --fast measures the most a server can take, the real time replay
+reproduces a show deterministically.
+"""
+import argparse
+import contextlib
+import io
+import math
+import time
+
+from .backends import FakeGPIO, FakeSpi
+from .ferro_controller import FerroControllerServer, FerroFluidController
+from .journal import read_journal
+from .light_controller import LED_COUNT, LightControllerServer, LightStripController
+
+
+def make_server(target, led_count):
+    """Controller server on fake hardware, and the fake it outputs to."""
+    if target == "light":
+        output = FakeSpi()
+        controller = LightStripController(led_count=led_count, spi=output)
+        return LightControllerServer(controller, bind=False), output
+    if target == "ferro":
+        output = FakeGPIO()
+        controller = FerroFluidController(gpio=output)
+        return FerroControllerServer(controller, bind=False), output
+    raise ValueError(f"Unknown journal target {target}")
+
+
+def output_count(output):
+    if isinstance(output, FakeSpi):
+        return output.n_transfers
+    return output.n_duty_changes
+
+
+def replay(events, server, speed=1.0, fast=False):
+    """Submit (time, message) events to server and apply them on the server's
+    tick grid, paced by their times divided by speed unless fast. Every event
+    recorded at or before a tick is submitted before it, so the inbox
+    coalesces and expires them as it would live. Returns the replay duration
+    and the lateness of every tick."""
+    lateness = []
+    start = time.perf_counter()
+    t0 = events[0][0] if events else 0.0
+    # journal seconds between two ticks
+    step = server.tick_s * speed
+    i = 0
+    while i < len(events):
+        # the first tick at or after the next event, idle ticks apply nothing
+        tick_t = max(t0 + math.ceil((events[i][0] - t0) / step) * step, events[i][0])
+        due = start + (tick_t - t0) / speed
+        if not fast:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lateness.append(time.perf_counter() - due)
+        while i < len(events) and events[i][0] <= tick_t:
+            t, message = events[i]
+            i += 1
+            if "ttl" in message:
+                # the time the pulse had left when it was journalled, scaled
+                # like the pacing and counted from when it was recorded
+                message = dict(message)
+                received = 0.0 if fast else (t - t0) / speed - (time.perf_counter() - start)
+                message["deadline"] = time.time() + received + message.pop("ttl") / speed
+            server.submit(message)
+        server.tick()
+    return time.perf_counter() - start, lateness
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("journal")
+    parser.add_argument("--fast", action="store_true", help="no pacing, measure throughput")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--led-count", type=int, default=LED_COUNT)
+    parser.add_argument("--loops", type=int, default=1, help="replay the journal this many times")
+    parser.add_argument("--verbose", action="store_true", help="keep the controller output")
+    args = parser.parse_args()
+
+    header, events = read_journal(args.journal)
+    print(f"{args.journal}: {len(events)} {header['target']} events over {events[-1][0] if events else 0:.1f}s, recorded {time.ctime(header['start_time'])}")
+    if events and events[-1][1]["type"] == "stop":
+        # stopping belongs to the replay, not to every loop
+        events = events[:-1]
+    if args.loops > 1 and events:
+        span = events[-1][0] - events[0][0] + 1e-3
+        events = [(t + i * span, m) for i in range(args.loops) for t, m in events]
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        server, output = make_server(header["target"], args.led_count)
+        output_before = output_count(output)
+        elapsed, lateness = replay(events, server, args.speed, args.fast)
+        # a pulse still rendering finishes before the controller stops
+        st = time.perf_counter()
+        server.handle_stop()
+        drain = time.perf_counter() - st
+    outputs = output_count(output) - output_before
+
+    print(f"replayed {len(events)} events in {elapsed:.3f}s: {len(events) / max(elapsed, 1e-9):.0f} events/s")
+    if lateness:
+        lateness = sorted(lateness)
+        print(f"pacing lateness p50 {lateness[len(lateness) // 2] * 1e3:.2f} ms, max {lateness[-1] * 1e3:.2f} ms")
+    kind = "SPI frames" if header["target"] == "light" else "duty cycle changes"
+    print(f"{outputs} {kind} output in {elapsed + drain:.3f}s ({outputs / max(elapsed + drain, 1e-9):.0f}/s), {drain:.3f}s to drain after the last event")
+    print(f"server events: {server.inbox.stats()}")
+
+
+if __name__ == "__main__":
+    main()
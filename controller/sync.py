@@ -0,0 +1,283 @@
+"""Fan controller events out to any number of nodes, fired in sync.
+
+The analyser side EventPublisher stamps every event with the time it should
+fire on its own monotonic clock and publishes it on a PUB socket, with the
+controller ("light", "ferro") as topic. Each node runs an EventSubscriber
+that estimates the offset between the publisher clock and its own with NTP
+style round trips over a DEALER/ROUTER pair, converts the fire time to its
+local clock and hands the event to the controller server at that time. Nodes
+piggyback their stats on the sync requests, so the publisher knows the round
+trip, offset and lateness of every node.
+
+    # analyser
+    publisher = EventPublisher()
+    light = FanoutClient(publisher, "light")
+    light.send_pulse("beat", 255, 0.1)
+
+    # every Pi
+    python -m controller.light_controller --publisher analyser.local
+"""
+import collections
+import heapq
+import itertools
+import pickle
+import socket
+import threading
+import time
+
+import numpy as np
+import zmq
+
+EVENT_PORT = 5560
+SYNC_PORT = 5561
+
+
+class EventPublisher:
+    def __init__(
+        self,
+        host="*",
+        event_port=EVENT_PORT,
+        sync_port=SYNC_PORT,
+        lead_s=0.05,
+        stats_interval=30.0,
+        clock=time.monotonic,
+    ):
+        """
+        lead_s: events fire this long after they are published, must cover
+            the network latency of the slowest node
+        stats_interval: seconds between node stats printouts, None disables
+        clock: publisher clock, fire times are in this clock
+        """
+        self.lead_s = lead_s
+        self.clock = clock
+        self.stats_interval = stats_interval
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.bind(f"tcp://{host}:{event_port}")
+        self.sync_socket = self.context.socket(zmq.ROUTER)
+        self.sync_socket.bind(f"tcp://{host}:{sync_port}")
+        # node name -> latest stats reported by the node
+        self.nodes = {}
+        self.lock = threading.Lock()
+        # zmq sockets are not thread safe, and the runtime publishes from
+        # one sender thread per controller
+        self.publish_lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self._serve_sync, daemon=True)
+        self.thread.start()
+
+    def publish(self, target, message, fire_time=None):
+        """Publish message to every node of target ("light", "ferro"), to be
+        fired at fire_time on the publisher clock (default: now + lead_s)."""
+        now = self.clock()
+        message = dict(message, sent=now, fire=now + self.lead_s if fire_time is None else fire_time)
+        frames = [target.encode(), pickle.dumps(message)]
+        with self.publish_lock:
+            self.socket.send_multipart(frames)
+
+    def _serve_sync(self):
+        last_print = self.clock()
+        while self.running:
+            if self.sync_socket.poll(100):
+                identity, payload = self.sync_socket.recv_multipart()
+                t1 = self.clock()
+                request = pickle.loads(payload)
+                reply = dict(seq=request["seq"], t0=request["t0"], t1=t1, t2=self.clock())
+                self.sync_socket.send_multipart([identity, pickle.dumps(reply)])
+                if request.get("stats") is not None:
+                    with self.lock:
+                        self.nodes[identity.decode()] = dict(request["stats"], seen=t1)
+            if self.stats_interval and self.clock() - last_print > self.stats_interval:
+                last_print = self.clock()
+                self.print_stats()
+
+    def node_stats(self):
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.nodes.items()}
+
+    def print_stats(self):
+        now = self.clock()
+        print("Node stats:")
+        for name, s in sorted(self.node_stats().items()):
+            print(
+                f"  {name:<16} rtt {s['rtt_ms']:6.2f} ms  offset {s['offset_ms']:+9.2f} ms  "
+                f"transit {s['transit_ms']:6.2f} ms  late p50 {s['late_p50_ms']:6.2f} / "
+                f"p99 {s['late_p99_ms']:6.2f} ms  events {s['events']}  "
+                f"(seen {now - s['seen']:.1f}s ago)"
+            )
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        # let a final stop reach the nodes
+        with self.publish_lock:
+            self.socket.close(linger=1000)
+        self.sync_socket.close(linger=0)
+
+
+class FanoutClient:
+    """Drop-in for LightControllerClient / FerroControllerClient that
+    publishes to every node of target instead of one local server."""
+
+    def __init__(self, publisher, target):
+        self.publisher = publisher
+        self.target = target
+
+    def set_mode(self, mode, tempo, base_color=None):
+        message = {"type": "set_mode", "mode": mode, "tempo": tempo}
+        if base_color is not None:
+            message["base_color"] = base_color
+        self.publisher.publish(self.target, message)
+
+    def send_pulse(self, pulse_pattern, strength, duration):
+        message = {
+            "type": "send_pulse",
+            "pulse_pattern": pulse_pattern,
+            "strength": strength,
+            "duration": duration,
+        }
+        self.publisher.publish(self.target, message)
+
+    def set_idle(self, idle):
+        self.publisher.publish(self.target, {"type": "set_idle", "idle": idle})
+
+    def send_bands(self, bands):
+        message = {"type": "bands", "data": np.asarray(bands, dtype=np.float32).tobytes()}
+        self.publisher.publish(self.target, message)
+
+    def stop(self):
+        self.publisher.publish(self.target, {"type": "stop"})
+
+
+class EventSubscriber:
+    def __init__(
+        self,
+        handler,
+        target,
+        host="localhost",
+        name=None,
+        event_port=EVENT_PORT,
+        sync_port=SYNC_PORT,
+        sync_interval=1.0,
+        window=8,
+        clock=time.monotonic,
+    ):
+        """
+        handler: called with each event message at its fire time, e.g. the
+            submit of a controller server
+        target: topic to subscribe to, "light" or "ferro"
+        name: node name in the publisher stats, the hostname by default
+        sync_interval: seconds between clock sync round trips
+        window: round trips kept, the one with the shortest delay sets the
+            offset since it is the least skewed by queueing
+        """
+        self.handler = handler
+        self.name = name or socket.gethostname()
+        self.clock = clock
+        self.sync_interval = sync_interval
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, target.encode())
+        self.socket.connect(f"tcp://{host}:{event_port}")
+        self.sync_socket = self.context.socket(zmq.DEALER)
+        self.sync_socket.setsockopt(zmq.IDENTITY, self.name.encode())
+        self.sync_socket.connect(f"tcp://{host}:{sync_port}")
+
+        # (delay, offset) of the last round trips, offset = publisher - local
+        self.samples = collections.deque(maxlen=window)
+        self.offset = None
+        self.rtt = None
+        self.seq = 0
+        self.events = 0
+        self.unsynced = 0
+        # fired - intended fire time, and receive - send time of each event
+        self.lateness = collections.deque(maxlen=1000)
+        self.transit = collections.deque(maxlen=1000)
+        # (local fire time, n, message) of events waiting to fire
+        self.pending = []
+        self.counter = itertools.count()
+        self.running = True
+
+    def stats(self):
+        def ms(values, q):
+            return float(np.percentile(values, q) * 1e3) if len(values) else 0.0
+
+        return dict(
+            rtt_ms=(self.rtt or 0.0) * 1e3,
+            offset_ms=(self.offset or 0.0) * 1e3,
+            transit_ms=ms(self.transit, 50),
+            late_p50_ms=ms(self.lateness, 50),
+            late_p99_ms=ms(self.lateness, 99),
+            events=self.events,
+            unsynced=self.unsynced,
+        )
+
+    def _send_sync(self):
+        self.seq += 1
+        request = dict(seq=self.seq, t0=self.clock(), stats=self.stats())
+        self.sync_socket.send(pickle.dumps(request))
+
+    def _receive_sync(self):
+        t3 = self.clock()
+        reply = pickle.loads(self.sync_socket.recv())
+        t0, t1, t2 = reply["t0"], reply["t1"], reply["t2"]
+        delay = (t3 - t0) - (t2 - t1)
+        self.samples.append((delay, ((t1 - t0) + (t2 - t3)) / 2))
+        self.rtt, self.offset = min(self.samples)
+
+    def _receive_event(self):
+        _, payload = self.socket.recv_multipart()
+        now = self.clock()
+        message = pickle.loads(payload)
+        if self.offset is None:
+            # not synced yet, better late than never
+            self.unsynced += 1
+            fire = now
+        else:
+            fire = message["fire"] - self.offset
+            self.transit.append(now - (message["sent"] - self.offset))
+        heapq.heappush(self.pending, (fire, next(self.counter), message))
+
+    def _fire_due(self):
+        while self.pending and self.pending[0][0] <= self.clock():
+            fire, _, message = heapq.heappop(self.pending)
+            self.lateness.append(self.clock() - fire)
+            self.events += 1
+            self.handler(message)
+            if message["type"] == "stop":
+                self.running = False
+                return
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.sync_socket, zmq.POLLIN)
+        # a quick burst so the first events already fire in sync
+        for _ in range(4):
+            self._send_sync()
+        next_sync = self.clock() + self.sync_interval
+        while self.running:
+            now = self.clock()
+            if now >= next_sync:
+                self._send_sync()
+                next_sync = now + self.sync_interval
+            wait = next_sync - now
+            if self.pending:
+                wait = min(wait, self.pending[0][0] - now)
+            # zmq polls with millisecond resolution, sleep the last stretch
+            if wait < 0.002:
+                time.sleep(max(wait, 0))
+                self._fire_due()
+                continue
+            events = dict(poller.poll(wait * 1000 - 1))
+            if self.sync_socket in events:
+                self._receive_sync()
+            if self.socket in events:
+                self._receive_event()
+            self._fire_due()
+        self.socket.close(linger=0)
+        self.sync_socket.close(linger=0)
+
+    def close(self):
+        # run() returns within sync_interval and closes the sockets
+        self.running = False
@@ -1 +1 @@
-from analyzer import MusicAnalyser
\ No newline at end of file
+from .analyzer import MusicAnalyser
@@ -1,8 +1,11 @@
-import librosa
+import copy
+import functools
 import numpy as np
 
+import threading
 import time
-import pickle
+
+from .ring import make_ring
 
 # import line_profiler
 
@@ -13,6 +16,83 @@ import pickle
 # 1. determine if the song changes beat or there is a new song playing. it will use librosa to get the tempo of the audio data. and generate a color pattern for the light strip.
 # 2. determine if there is a beat in the most recent 0.01s frame
 
+# librosa pulls in numba and scipy and takes seconds to import on a Pi, so it
+# is only imported once an analysis actually needs it
+_librosa = None
+
+
+def _import_librosa():
+    global _librosa
+    if _librosa is None:
+        import librosa
+
+        _librosa = librosa
+    return _librosa
+
+
+@functools.lru_cache(maxsize=None)
+def mel_filterbank(sr, n_fft, n_mels):
+    """Mel filterbank as a CSR matrix, built once per configuration and
+    shared by every analyser using it. Each filter only covers a few bins, so
+    projecting a frame touches ~2 * n_fft / 2 weights instead of
+    n_mels * n_fft / 2."""
+    from scipy import sparse
+
+    librosa = _import_librosa()
+    return sparse.csr_matrix(
+        librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmax=0.5 * sr)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def band_filterbank(sr, n_fft, n_bands, fmin=40.0, fmax=16000.0):
+    """Log-spaced rectangular bands as a CSR matrix averaging the STFT bins
+    of each band. Bands too narrow to hold a bin take the nearest one."""
+    from scipy import sparse
+
+    freqs = np.arange(n_fft // 2 + 1) * sr / n_fft
+    edges = np.geomspace(fmin, min(fmax, sr / 2), n_bands + 1)
+    rows, cols = [], []
+    for band, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+        bins = np.flatnonzero((freqs >= lo) & (freqs < hi))
+        if not len(bins):
+            bins = [np.argmin(np.abs(freqs - np.sqrt(lo * hi)))]
+        rows.extend([band] * len(bins))
+        cols.extend(bins)
+    weights = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(n_bands, len(freqs)),
+    )
+    counts = np.asarray(weights.sum(axis=1)).ravel()
+    return sparse.diags(1 / counts).dot(weights).tocsr()
+
+
+# librosa.onset.onset_strength frames with its default n_fft, whatever the
+# STFT above it used
+ONSET_N_FFT = 2048
+
+# cheaper configurations the analyser steps down through when its hops take
+# longer than their budget: fraction of the history analysed, fraction of
+# frame_length used as n_fft, and the onset detector
+DEGRADATION_LADDER = [
+    dict(name="full", history=1.0, n_fft=1.0, detector="spectral"),
+    dict(name="short history", history=0.5, n_fft=1.0, detector="spectral"),
+    dict(name="fewer bins", history=0.5, n_fft=0.5, detector="spectral"),
+    dict(name="energy flux", history=0.5, n_fft=0.5, detector="energy"),
+]
+
+
+def default_peak_pick_params(sr, hop_length):
+    """Peak picking settings tuned on the device, in onset frames."""
+    return dict(
+        pre_max=0.03 * sr // hop_length,  # 30ms
+        post_max=0.00 * sr // hop_length + 1,  # 0ms
+        pre_avg=0.10 * sr // hop_length,  # 100ms
+        post_avg=0.10 * sr // hop_length + 1,  # 100ms
+        wait=0.03 * sr // hop_length,  # 30ms
+        delta=0.5,
+    )
+
 
 class MusicAnalyser:
     def __init__(
@@ -22,12 +102,23 @@ class MusicAnalyser:
         hop_length=512,
         frame_length=2048,
         delay_seconds=0.2,
+        track_cache=None,
+        onset_mode="linear",
+        n_mels=48,
+        n_bands=0,
+        cost_budget=None,
         **kwargs
     ):
+        """
+        cost_budget: fraction of the audio duration of a frame its analysis
+            may take. Over it the analyser steps down DEGRADATION_LADDER, and
+            back up once there is headroom again. None keeps the full
+            configuration.
+        """
         self.sr = sr
         # buffer last 5s audio data
         self.history_len = history_len = int(sr * history_s)
-        self.buffer = np.zeros(history_len * 4, dtype=np.int16)
+        self.history = self.make_history(history_len)
         self.t = history_len
 
         self.count = 0
@@ -35,13 +126,19 @@ class MusicAnalyser:
 
         self.hop_length = hop_length
         self.frame_length = frame_length
+        # "linear": flux over all STFT bins, "mel": flux over n_mels log-mel bands
+        if onset_mode not in ("linear", "mel"):
+            raise ValueError(f"Unknown onset mode {onset_mode}")
+        self.onset_mode = onset_mode
+        self.n_mels = n_mels
+        # band energies of the audio being heard, for streaming to the lights
+        self.n_bands = n_bands
+        self.magnitude = None
+        # the analysed window when the energy detector skipped the STFT
+        self.signal = None
         self.kwargs = kwargs
-        kwargs.setdefault("pre_max", 0.03 * sr // hop_length)  # 30ms
-        kwargs.setdefault("post_max", 0.00 * sr // hop_length + 1)  # 0ms
-        kwargs.setdefault("pre_avg", 0.10 * sr // hop_length)  # 100ms
-        kwargs.setdefault("post_avg", 0.10 * sr // hop_length + 1)  # 100ms
-        kwargs.setdefault("wait", 0.03 * sr // hop_length)  # 30ms
-        kwargs.setdefault("delta", 0.5)
+        for key, value in default_peak_pick_params(sr, hop_length).items():
+            kwargs.setdefault(key, value)
 
         self.delay_frames = int(sr * delay_seconds / hop_length)
         self.delay_s = self.delay_frames * hop_length / sr
@@ -51,66 +148,273 @@ class MusicAnalyser:
         self.detected_tempo_change_last_time = False
         self.tempo_change_threshold = 10
 
-        y = np.zeros(history_len, dtype=np.float32)
-        S = librosa.feature.melspectrogram(
-            y=y,
-            sr=self.sr,
-            n_fft=self.frame_length,
-            hop_length=self.hop_length,
-            n_mels=128,
-            fmax=0.5 * self.sr,
-        )
+        # optional fingerprint.TrackCache, follows precomputed beat timelines
+        # of tracks that were played before
+        self.track_cache = track_cache
 
-    def store_frame(self, frame):
-        frame_len = len(frame)
-        if self.t + frame_len > len(self.buffer):
-            self.buffer[: self.history_len] = self.buffer[
-                self.t - self.history_len : self.t
-            ].copy()
-            self.t = self.history_len
-        self.buffer[self.t : self.t + frame_len] = frame
-        self.t += frame_len
+        self.warmup_seconds = None
 
-    # @line_profiler.profile
-    def analyze(self, frame):
+        self.cost_budget = cost_budget
+        # smoothed analysis time / audio duration of the frames
+        self.cost = None
+        self.hops_seen = 0
+        self.hops_at_level = 0
+        # hops of headroom before stepping back up, doubled when a step up
+        # had to be undone right away
+        self.recover_hops = 100
+        self.stepped_up = False
+        self.set_level(0)
+
+    def make_history(self, history_len):
+        """The ring the audio is stored in, one int16 sample per item."""
+        return make_ring(history_len, dtype=np.int16)
+
+    def set_level(self, level):
+        """Analyse with DEGRADATION_LADDER[level] from the next hop on."""
+        config = DEGRADATION_LADDER[level]
+        self.level = level
+        self.n_fft = int(self.frame_length * config["n_fft"])
+        # at least the frames the delayed check and the peak picker look at
+        min_len = (self.delay_frames + 2) * self.hop_length + self.n_fft
+        self.window_len = min(self.history_len, max(int(self.history_len * config["history"]), min_len))
+        self.detector = config["detector"]
+        self.hops_at_level = 0
+        # the smoothed cost of the previous level would step on from there
+        # before the cost of this one shows
+        self.cost = None
+
+    def monitor_cost(self, elapsed, frame_len):
+        """Track the analysis cost of a frame and step down or up the
+        degradation ladder."""
+        self.hops_seen += 1
+        # the first hops pay for imports and JIT compilation
+        if self.cost_budget is None or self.hops_seen <= 10:
+            return
+        cost = elapsed * self.sr / frame_len
+        self.cost = cost if self.cost is None else 0.8 * self.cost + 0.2 * cost
+        self.hops_at_level += 1
+        if self.cost > self.cost_budget and self.hops_at_level >= 5 and self.level + 1 < len(DEGRADATION_LADDER):
+            if self.stepped_up:
+                self.recover_hops = min(2 * self.recover_hops, 3200)
+            self.stepped_up = False
+            print(
+                f"Analysis over budget ({self.cost:.0%} of real time > {self.cost_budget:.0%}), "
+                f"degrading to {DEGRADATION_LADDER[self.level + 1]['name']}"
+            )
+            self.set_level(self.level + 1)
+        elif self.cost < 0.5 * self.cost_budget and self.hops_at_level >= self.recover_hops and self.level > 0:
+            self.stepped_up = True
+            print(
+                f"Analysis has headroom ({self.cost:.0%} of real time), "
+                f"recovering to {DEGRADATION_LADDER[self.level - 1]['name']}"
+            )
+            self.set_level(self.level - 1)
+        elif self.hops_at_level >= self.recover_hops:
+            # the level held, a later step up starts from scratch
+            self.stepped_up = False
+
+    def warmup(self, background=False):
+        """Import librosa and run the detection once on silence so that the
+        first real hop does not pay for imports and JIT compilation. Runs on
+        a copy of the analyser, so analyze can run while it does."""
+        if background:
+            thread = threading.Thread(target=self.warmup, daemon=True)
+            thread.start()
+            return thread
         st = time.time()
-        self.store_frame(frame)
-        y = self.buffer[self.t - self.history_len: self.t].astype(np.float32) / np.iinfo(np.int16).max
-        # print("get y from buffer: ", time.time() - st)
-        
-        # compute mel spectrogram
+        # detect_onsets keeps the STFT magnitude and reads the level on the
+        # analyser, the copy has its own
+        scratch = copy.copy(self)
+        scratch.set_level(0)
+        shape = self.history.shape + (self.history_len,)
+        scratch.detect_onsets(np.zeros(shape, dtype=np.float32))
+        # the filterbanks of the cheaper n_fft too, so stepping down does not
+        # cost a slow hop
+        n_ffts = {self.frame_length}
+        if self.cost_budget is not None:
+            n_ffts |= {int(self.frame_length * config["n_fft"]) for config in DEGRADATION_LADDER}
+        for n_fft in n_ffts:
+            if self.n_bands:
+                band_filterbank(self.sr, n_fft, self.n_bands)
+            if self.onset_mode == "mel":
+                mel_filterbank(self.sr, n_fft, self.n_mels)
+        self.warmup_seconds = time.time() - st
+
+    def store_frame(self, frame):
+        # frames are stored along the last axis, leading axes index sources
+        self.history.write(frame)
+        self.t += frame.shape[-1]
+
+    def energy_envelope(self, y):
+        """Positive flux of the frame log energy along the last axis, aligned
+        like onset_strength. No STFT, the last rung of the ladder."""
+        librosa = _import_librosa()
+        rms = librosa.feature.rms(y=y, frame_length=self.n_fft, hop_length=self.hop_length)[..., 0, :]
+        db = 20 * np.log10(rms + 1e-10)
+        flux = np.maximum(0.0, np.diff(db, axis=-1))
+        # the lag and the framing shift of onset_strength, then its length
+        pad = [(0, 0)] * (flux.ndim - 1) + [(1 + ONSET_N_FFT // (2 * self.hop_length), 0)]
+        return np.pad(flux, pad)[..., : rms.shape[-1]]
+
+    def onset_envelope(self, y):
+        """Unnormalised onset strength of y along the last axis."""
+        librosa = _import_librosa()
+        if self.detector == "energy":
+            # band_energies only transforms the frames it needs
+            self.magnitude = None
+            self.signal = y
+            return self.energy_envelope(y)
+        # compute spectrogram
         st = time.time()
         S = librosa.stft(
             y=y,
-            n_fft=self.frame_length,
+            n_fft=self.n_fft,
             hop_length=self.hop_length,
         )
         print("compute stft: ", time.time() - st)
-        S = librosa.core.power_to_db(np.abs(S))
+        # kept for band_energies
+        self.magnitude = magnitude = np.abs(S)
+        if self.onset_mode == "mel":
+            # built on the first call (normally by warmup) and then cached
+            mel_basis = mel_filterbank(self.sr, self.n_fft, self.n_mels)
+            power = magnitude**2
+            # sparse matrices only multiply 2-D arrays, put all frames of all
+            # sources side by side
+            bins, frames = power.shape[-2:]
+            power = np.moveaxis(power, -2, 0).reshape(bins, -1)
+            mel = (mel_basis @ power).reshape((-1,) + S.shape[:-2] + (frames,))
+            S = librosa.core.power_to_db(np.moveaxis(mel, 0, -2), top_db=None)
+        else:
+            S = librosa.core.power_to_db(magnitude, top_db=None)
+        # clip to 80 dB below the peak of each source, as power_to_db would
+        # for a single one
+        S = np.maximum(S, S.max(axis=(-2, -1), keepdims=True) - 80.0)
         # compute onset strength
-        onset_env = librosa.onset.onset_strength(
+        return librosa.onset.onset_strength(
             S=S, sr=self.sr, hop_length=self.hop_length
         )
+
+    def detect_onsets(self, y):
+        """Onset envelope and detected onset frames of y, along the last axis.
+        For 2-D y every row is processed in the same stacked operations and
+        the detected onsets are returned as a list with one array per row."""
+        librosa = _import_librosa()
+        onset_env = self.onset_envelope(y)
         # normalize onset strength
-        onset_env = onset_env - np.min(onset_env)
-        onset_env /= np.max(onset_env) + librosa.util.tiny(onset_env)
+        onset_env = onset_env - np.min(onset_env, axis=-1, keepdims=True)
+        onset_env /= np.max(onset_env, axis=-1, keepdims=True) + librosa.util.tiny(
+            onset_env
+        )
 
-        onsets_detected = librosa.util.peak_pick(onset_env, **self.kwargs)
-        
+        if onset_env.ndim == 1:
+            onsets_detected = librosa.util.peak_pick(onset_env, **self.kwargs)
+        else:
+            onsets_detected = [
+                librosa.util.peak_pick(env, **self.kwargs) for env in onset_env
+            ]
+        return onset_env, onsets_detected
+
+    def frames_to_check(self, n_onset_frames, frame_len):
+        """Onset frames covering the audio being heard now, i.e. the new hops
+        shifted back by the playback delay."""
+        frames_to_check = [n_onset_frames - self.delay_frames + i for i in range(frame_len // self.hop_length)]
+        return [frame_to_check for frame_to_check in frames_to_check if frame_to_check < n_onset_frames]
+
+    def frames_magnitude(self, y, frames):
+        """STFT magnitude of only the given frames of y, framed, padded and
+        windowed like librosa.stft. Shape (..., bins, len(frames))."""
+        pad = [(0, 0)] * (y.ndim - 1) + [(self.n_fft // 2, self.n_fft // 2)]
+        y = np.pad(y, pad)
+        window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(self.n_fft) / self.n_fft)
+        columns = np.stack(
+            [y[..., k * self.hop_length : k * self.hop_length + self.n_fft] for k in frames], axis=-1
+        )
+        return np.abs(np.fft.rfft(columns * window[:, None], axis=-2)).astype(np.float32)
+
+    def band_energies(self, frames_to_check, floor_db=-60.0):
+        """Mean magnitude of each band over frames_to_check of the last STFT,
+        in dB relative to a full scale sine and mapped from [floor_db, 0] to
+        [0, 1]. float32 with shape (..., n_bands), None if n_bands is 0."""
+        if not self.n_bands or not frames_to_check:
+            return None
+        bands = band_filterbank(self.sr, self.n_fft, self.n_bands)
+        if self.magnitude is None:
+            # the energy detector, a few frames are still cheap to transform
+            magnitude = self.frames_magnitude(self.signal, frames_to_check).mean(axis=-1)
+        else:
+            magnitude = self.magnitude[..., frames_to_check].mean(axis=-1)
+        energies = (bands @ magnitude.reshape(-1, magnitude.shape[-1]).T).T
+        # a full scale sine peaks at n_fft / 4 with the hann window
+        db = 20 * np.log10(energies / (self.n_fft / 4) + 1e-10)
+        levels = np.clip(1 - db / floor_db, 0, 1).astype(np.float32)
+        return levels.reshape(magnitude.shape[:-1] + (self.n_bands,))
+
+    def tick_mode(self, frame_len):
+        # ask for a new mode every 100 history windows
+        if self.t % self.history_len != (self.t - frame_len) % self.history_len:
+            self.count += 1
+            if self.count == 100:
+                self.count = 0
+                return True
+        return False
+
+    def follow_timeline(self, frame, track_changed):
+        """Pulse on the precomputed beats of the recognised track instead of
+        detecting onsets."""
+        cache = self.track_cache
+        # same window as the onset path: the audio being heard right now
+        start = -self.delay_s
+        end = start + len(frame) / self.sr
+        send_pulse = len(cache.beats_between(start, end)) > 0
+        set_mode = track_changed or len(cache.sections_between(start, end)) > 0
+        self.tempo = float(cache.timeline["tempo"])
+
+        next_beat_time = None
+        upcoming = cache.beats_between(end, end + 60 / self.tempo)
+        if len(upcoming):
+            next_beat_time = upcoming[0] - (cache.position + end)
+
+        bands = None
+        if self.n_bands:
+            # the spectrum mode still needs the levels of the frames heard
+            # now, and only those are transformed
+            y = self.history.window(self.window_len).astype(np.float32) / np.iinfo(np.int16).max
+            self.magnitude, self.signal = None, y
+            n_frames = 1 + y.shape[-1] // self.hop_length
+            bands = self.band_energies(self.frames_to_check(n_frames, len(frame)))
+
+        return dict(
+            send_pulse=send_pulse,
+            strength=255,
+            set_mode=set_mode,
+            tempo=self.tempo,
+            next_beat_time=next_beat_time,
+            onset_value=float(send_pulse),
+            onsets=np.zeros(0, dtype=np.int64),
+            bands=bands,
+        )
+
+    # @line_profiler.profile
+    def analyze(self, frame):
+        start = time.perf_counter()
         st = time.time()
-        frames_to_check = [len(onset_env) - self.delay_frames + i for i in range(len(frame) // self.hop_length)]
-        frames_to_check = [frame_to_check for frame_to_check in frames_to_check if frame_to_check < len(onset_env)]
+        self.store_frame(frame)
+        if self.track_cache is not None:
+            track_changed = self.track_cache.update(frame)
+            if self.track_cache.track is not None:
+                return self.follow_timeline(frame, track_changed)
+        y = self.history.window(self.window_len).astype(np.float32) / np.iinfo(np.int16).max
+        # print("get y from buffer: ", time.time() - st)
+
+        onset_env, onsets_detected = self.detect_onsets(y)
+
+        st = time.time()
+        frames_to_check = self.frames_to_check(len(onset_env), len(frame))
         send_pulse = any(frame_to_check in onsets_detected for frame_to_check in frames_to_check)
-        # pulse_strength = max(onset_env[frames_to_check])
+        onset_value = float(max(onset_env[frames_to_check])) if frames_to_check else 0.0
         # print("check pulse: ", time.time() - st)
         # print(self.t, len(onset_env), send_pulse, onsets_detected[-5:], frames_to_check[-1])
 
-        # # save [y, onset_env, onsets_detected, frame_to_check, send_pulse, pulse_strength]
-        # st = time.time()
-        # with open("data.pkl", "wb") as f:
-        #     pickle.dump([y, self.sr, onset_env, onsets_detected, frames_to_check, send_pulse, pulse_strength], f)
-        # print("end saving", time.time() - st)
-        
         set_mode = False
         next_beat_time = None
         # if self.t % self.history_len == 0:
@@ -133,11 +437,9 @@ class MusicAnalyser:
         #             [frame_to_check - beats[-1]], sr=self.sr, hop_length=self.hop_length
         #         )[0]
         #         next_beat_time += np.ceil(-next_beat_time / (60 / tempo)) * (60 / tempo)
-        if self.t % self.history_len != (self.t - len(frame)) % self.history_len:
-            self.count += 1
-            if self.count == 100:
-                self.count = 0
-                set_mode = True
+        set_mode = self.tick_mode(len(frame))
+        bands = self.band_energies(frames_to_check)
+        self.monitor_cost(time.perf_counter() - start, len(frame))
 
         return dict(
             send_pulse=send_pulse,
@@ -145,4 +447,7 @@ class MusicAnalyser:
             set_mode=set_mode,
             tempo=self.tempo,
             next_beat_time=next_beat_time,
+            onset_value=onset_value,
+            onsets=onsets_detected,
+            bands=bands,
         )
@@ -0,0 +1,338 @@
+"""Recognise tracks that were played before and reuse their offline analysis.
+
+The incoming audio is reduced to one 32 bit sub-fingerprint per hop (signs of
+the energy differences between 33 log-spaced bands, across bands and time, as
+in Haitsma & Kalker). Tracks that are not recognised are accumulated and, once
+they end, analysed in a worker process with librosa at leisure (beats, tempo,
+sections). The result is stored in an on-disk index keyed by fingerprint, so
+the next time the track plays the analyser can follow the precomputed timeline
+instead of detecting onsets in real time.
+"""
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+
+import numpy as np
+
+FP_N_FFT = 4096
+FP_BANDS = 33
+FP_FMIN = 300.0
+FP_FMAX = 2000.0
+
+
+class Fingerprinter:
+    def __init__(self, sr=44100, hop_length=512, n_fft=FP_N_FFT):
+        self.sr = sr
+        self.hop_length = hop_length
+        self.n_fft = n_fft
+        self.window = np.hanning(n_fft).astype(np.float32)
+
+        # rectangular bands on the rfft bins, log-spaced between fmin and fmax
+        edges = np.geomspace(FP_FMIN, FP_FMAX, FP_BANDS + 1)
+        bins = np.fft.rfftfreq(n_fft, 1 / sr)
+        band_of_bin = np.searchsorted(edges, bins, side="right") - 1
+        self.bands = np.zeros((FP_BANDS, len(bins)), dtype=np.float32)
+        valid = (band_of_bin >= 0) & (band_of_bin < FP_BANDS)
+        self.bands[band_of_bin[valid], np.nonzero(valid)[0]] = 1
+        self.bit_weights = np.uint64(1) << np.arange(FP_BANDS - 1, dtype=np.uint64)
+
+        # streaming state
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.last_energy = None
+
+    def band_energies(self, frames):
+        spectrum = np.abs(np.fft.rfft(frames * self.window, axis=-1)) ** 2
+        return spectrum @ self.bands.T
+
+    def bits(self, energy, last_energy):
+        # F(n, m) = E(n, m) - E(n, m + 1) - (E(n - 1, m) - E(n - 1, m + 1)) > 0
+        diff = np.diff(energy, axis=-1) - np.diff(last_energy, axis=-1)
+        return ((diff > 0) @ self.bit_weights).astype(np.uint32)
+
+    def compute(self, y, block=1024):
+        """Fingerprint a whole signal. Frame n covers samples
+        [n * hop_length, n * hop_length + n_fft) and its fingerprint compares it
+        with frame n - 1, so the first frame has none and is dropped."""
+        y = np.asarray(y, dtype=np.float32)
+        if len(y) < self.n_fft + self.hop_length:
+            return np.zeros(0, dtype=np.uint32)
+        frames = np.lib.stride_tricks.sliding_window_view(y, self.n_fft)[
+            :: self.hop_length
+        ]
+        energies = np.concatenate(
+            [
+                self.band_energies(frames[i : i + block])
+                for i in range(0, len(frames), block)
+            ]
+        )
+        return self.bits(energies[1:], energies[:-1])
+
+    def update(self, y):
+        """Feed new samples, return the fingerprints of the hops they complete."""
+        self.pending = np.concatenate((self.pending, np.asarray(y, dtype=np.float32)))
+        n = (len(self.pending) - self.n_fft) // self.hop_length + 1
+        if n <= 0:
+            return np.zeros(0, dtype=np.uint32)
+        frames = np.lib.stride_tricks.sliding_window_view(self.pending, self.n_fft)[
+            : n * self.hop_length : self.hop_length
+        ]
+        energies = self.band_energies(frames)
+        self.pending = self.pending[n * self.hop_length :]
+        if self.last_energy is None:
+            prev = energies[:-1]
+            energies = energies[1:]
+        else:
+            prev = np.vstack((self.last_energy, energies[:-1]))
+        self.last_energy = energies[-1] if len(energies) else self.last_energy
+        return self.bits(energies, prev)
+
+    def frame_end_time(self, n):
+        """Time in seconds at which the frame of fingerprint n ends."""
+        return (n * self.hop_length + self.n_fft) / self.sr
+
+
+def analyse_track(y, sr, hop_length):
+    """Full-track offline analysis, run in a worker process."""
+    import librosa
+
+    y = np.asarray(y, dtype=np.float32) / np.iinfo(np.int16).max
+    fingerprint = Fingerprinter(sr, hop_length).compute(y)
+    tempo, beats = librosa.beat.beat_track(y=y, sr=sr, hop_length=hop_length)
+    duration = len(y) / sr
+    chroma = librosa.feature.chroma_stft(y=y, sr=sr, hop_length=hop_length * 4)
+    k = int(max(2, min(duration // 30, chroma.shape[1])))
+    boundaries = librosa.segment.agglomerative(chroma, k)
+    return dict(
+        fingerprint=fingerprint,
+        tempo=float(np.atleast_1d(tempo)[0]),
+        beats=librosa.frames_to_time(beats, sr=sr, hop_length=hop_length),
+        sections=librosa.frames_to_time(boundaries[1:], sr=sr, hop_length=hop_length * 4),
+        duration=duration,
+    )
+
+
+class TrackIndex:
+    """Directory of analysed tracks, one .npz per track, with an in-memory
+    lookup table from sub-fingerprint to (track, frame)."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.tracks = {}
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".npz"):
+                with np.load(os.path.join(path, name)) as data:
+                    self.tracks[name[:-4]] = {k: data[k] for k in data.files}
+        self._build()
+
+    def add(self, analysis):
+        fingerprint = analysis["fingerprint"]
+        track_id = hashlib.sha1(fingerprint.tobytes()).hexdigest()[:16]
+        np.savez(os.path.join(self.path, track_id + ".npz"), **analysis)
+        self.tracks[track_id] = analysis
+        self._build()
+        return track_id
+
+    def _build(self):
+        self.ids = list(self.tracks)
+        if not self.ids:
+            self.values = np.zeros(0, dtype=np.uint32)
+            return
+        fps = [self.tracks[i]["fingerprint"] for i in self.ids]
+        values = np.concatenate(fps)
+        track = np.concatenate([np.full(len(fp), i, np.int32) for i, fp in enumerate(fps)])
+        frame = np.concatenate([np.arange(len(fp), dtype=np.int32) for fp in fps])
+        order = np.argsort(values, kind="stable")
+        self.values = values[order]
+        self.track_of = track[order]
+        self.frame_of = frame[order]
+
+    def lookup(self, query, max_hits=16, min_votes=3, max_ber=0.35):
+        """Find the track and frame matching the last element of `query`.
+        Returns (track_id, frame) or None."""
+        if not len(self.values) or not len(query):
+            return None
+        # silence and clipping give degenerate fingerprints that match anything
+        usable = np.nonzero((query != 0) & (query != 0xFFFFFFFF))[0]
+        lo = np.searchsorted(self.values, query[usable], side="left")
+        hi = np.minimum(np.searchsorted(self.values, query[usable], side="right"), lo + max_hits)
+        counts = hi - lo
+        if not counts.sum():
+            return None
+        hits = np.repeat(lo, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+        # frame in the track aligned with the end of the query
+        end_frame = self.frame_of[hits] + (len(query) - 1 - np.repeat(usable, counts))
+        keys = self.track_of[hits].astype(np.int64) << 32 | end_frame.astype(np.int64) & 0xFFFFFFFF
+        keys, votes = np.unique(keys, return_counts=True)
+        best = np.argmax(votes)
+        if votes[best] < min_votes:
+            return None
+        track_idx, frame = int(keys[best] >> 32), int(keys[best] & 0xFFFFFFFF)
+        track_id = self.ids[track_idx]
+        if self.bit_error_rate(track_id, frame, query) > max_ber:
+            return None
+        return track_id, frame
+
+    def bit_error_rate(self, track_id, frame, query):
+        fp = self.tracks[track_id]["fingerprint"]
+        start = frame - len(query) + 1
+        if start < 0 or frame >= len(fp):
+            return 1.0
+        diff = np.bitwise_xor(fp[start : frame + 1], query)
+        return np.unpackbits(diff.view(np.uint8)).mean()
+
+
+class TrackCache:
+    """Follows the audio seen by MusicAnalyser, recognises known tracks and
+    schedules the analysis of new ones.
+
+    While a track is recognised, `position` is the time in the track at the end
+    of the audio passed to the last update().
+    """
+
+    def __init__(
+        self,
+        path,
+        sr=44100,
+        hop_length=512,
+        query_s=3.0,
+        recheck_s=2.0,
+        silence_rms=1e-3,
+        silence_s=1.5,
+        min_track_s=30.0,
+        max_track_s=480.0,
+    ):
+        self.index = TrackIndex(path)
+        self.sr = sr
+        self.fingerprinter = Fingerprinter(sr, hop_length)
+        self.query_len = int(query_s * sr / hop_length)
+        self.recheck_hops = int(recheck_s * sr / hop_length)
+        self.silence_level = silence_rms * np.iinfo(np.int16).max
+        self.silence_samples = int(silence_s * sr)
+        self.min_track_samples = int(min_track_s * sr)
+        self.max_track_samples = int(max_track_s * sr)
+
+        self.recent = np.zeros(self.query_len, dtype=np.uint32)
+        self.n_fingerprints = 0
+        self.hops_since_check = 0
+        self.silent_samples = 0
+
+        self.track = None
+        self.position = None
+        self.match_frame = None
+        self.track_audio = []
+        self.track_samples = 0
+
+        # analyses run in a separate process so they never compete with the
+        # analyser for the GIL; spawn avoids forking the audio threads
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.futures = []
+
+    @property
+    def timeline(self):
+        return self.index.tracks[self.track] if self.track is not None else None
+
+    def update(self, frame):
+        """Feed a hop of mono int16 audio. Returns True when the recognised
+        track changed (including becoming unrecognised)."""
+        self._collect_analyses()
+        changed = False
+
+        if np.sqrt(np.mean(frame.astype(np.float32) ** 2)) < self.silence_level:
+            self.silent_samples += len(frame)
+            if self.silent_samples >= self.silence_samples:
+                changed = self._end_track()
+        else:
+            self.silent_samples = 0
+
+        if self.track is not None:
+            self.position += len(frame) / self.sr
+        else:
+            self.track_audio.append(frame.copy())
+            self.track_samples += len(frame)
+            if self.track_samples >= self.max_track_samples:
+                self._end_track()
+
+        fingerprints = self.fingerprinter.update(frame)
+        n = len(fingerprints)
+        if n:
+            self.recent = np.roll(self.recent, -n)
+            self.recent[-min(n, self.query_len) :] = fingerprints[-self.query_len :]
+            self.n_fingerprints += n
+            self.hops_since_check += n
+            if self.match_frame is not None:
+                self.match_frame += n
+
+        if self.n_fingerprints >= self.query_len and self.hops_since_check >= self.recheck_hops:
+            self.hops_since_check = 0
+            changed |= self._check()
+        return changed
+
+    def _check(self):
+        if self.track is not None:
+            # verify we are still where we think we are
+            ber = self.index.bit_error_rate(self.track, self.match_frame, self.recent)
+            if ber <= 0.35:
+                return False
+            print(f"Track {self.track} lost (bit error rate {ber:.2f})")
+            self.track = self.position = self.match_frame = None
+            return True
+
+        match = self.index.lookup(self.recent)
+        if match is None:
+            return False
+        self.track, self.match_frame = match
+        # the last fingerprint ends where the last pending samples start
+        pending = len(self.fingerprinter.pending) - (
+            self.fingerprinter.n_fft - self.fingerprinter.hop_length
+        )
+        self.position = self.fingerprinter.frame_end_time(self.match_frame + 1) + pending / self.sr
+        print(f"Recognised track {self.track} at {self.position:.2f}s")
+        # known track, no need to analyse it again
+        self.track_audio = []
+        self.track_samples = 0
+        return True
+
+    def _end_track(self):
+        if self.track_samples >= self.min_track_samples:
+            audio = np.concatenate(self.track_audio)
+            print(f"Scheduling analysis of a {len(audio) / self.sr:.0f}s track")
+            self.futures.append(
+                self.pool.submit(
+                    analyse_track, audio, self.sr, self.fingerprinter.hop_length
+                )
+            )
+        self.track_audio = []
+        self.track_samples = 0
+        changed = self.track is not None
+        self.track = self.position = self.match_frame = None
+        return changed
+
+    def _collect_analyses(self):
+        if not self.futures or not any(f.done() for f in self.futures):
+            return
+        for future in [f for f in self.futures if f.done()]:
+            self.futures.remove(future)
+            try:
+                track_id = self.index.add(future.result())
+                print(f"Stored analysis of track {track_id}")
+            except Exception as e:
+                print(f"Track analysis failed: {e}")
+
+    def beats_between(self, start, end):
+        """Beat times of the recognised track within [start, end) seconds,
+        relative to `position`."""
+        beats = self.timeline["beats"]
+        lo, hi = np.searchsorted(beats, [self.position + start, self.position + end])
+        return beats[lo:hi]
+
+    def sections_between(self, start, end):
+        sections = self.timeline["sections"]
+        lo, hi = np.searchsorted(sections, [self.position + start, self.position + end])
+        return sections[lo:hi]
+
+    def close(self):
+        self.pool.shutdown(wait=False)
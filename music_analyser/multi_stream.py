@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+
+from .analyzer import MusicAnalyser
+from .ring import make_ring
+
+
+class MultiStreamAnalyser(MusicAnalyser):
+    """Analyse several sources (e.g. one per zone) in lockstep.
+
+    The history of all sources lives in one ring of (n_sources,) items and the
+    STFT, onset strength and normalisation run as single stacked operations, so
+    the per-call overhead of librosa is paid once per hop instead of once per
+    source. Only peak picking, which librosa implements for 1-D envelopes, is
+    done per source. A cost_budget applies to the hop of all sources
+    together, the ladder steps down for all of them at once.
+    """
+
+    def __init__(self, n_sources, **kwargs):
+        if kwargs.get("track_cache") is not None:
+            raise ValueError("track_cache is not supported for multiple sources")
+        self.n_sources = n_sources
+        super().__init__(**kwargs)
+
+    def make_history(self, history_len):
+        return make_ring(history_len, (self.n_sources,), np.int16)
+
+    def analyze(self, frames):
+        """frames: (n_sources, n) int16, one hop of audio per source.
+        Returns one result dict per source, as MusicAnalyser.analyze."""
+        start = time.perf_counter()
+        frames = np.asarray(frames)
+        if frames.shape[0] != self.n_sources:
+            raise ValueError(
+                f"Expected frames for {self.n_sources} sources, got {frames.shape[0]}"
+            )
+        self.store_frame(frames)
+        y = self.history.window(self.window_len).astype(np.float32) / np.iinfo(np.int16).max
+        onset_env, onsets_detected = self.detect_onsets(y)
+
+        frames_to_check = self.frames_to_check(onset_env.shape[-1], frames.shape[-1])
+        set_mode = self.tick_mode(frames.shape[-1])
+
+        bands = self.band_energies(frames_to_check)
+        self.monitor_cost(time.perf_counter() - start, frames.shape[-1])
+        results = []
+        for i, (env, detected) in enumerate(zip(onset_env, onsets_detected)):
+            results.append(
+                dict(
+                    send_pulse=bool(np.isin(frames_to_check, detected).any()),
+                    strength=255,
+                    set_mode=set_mode,
+                    tempo=self.tempo,
+                    next_beat_time=None,
+                    onset_value=float(env[frames_to_check].max()) if frames_to_check else 0.0,
+                    onsets=detected,
+                    bands=None if bands is None else bands[i],
+                )
+            )
+        return results
@@ -0,0 +1,279 @@
+"""Onset analysis without allocations in the hop loop.
+
+PreallocatedAnalyser computes what MusicAnalyser.analyze does, but every
+intermediate (float window, framed and windowed audio, STFT, magnitude, dB
+spectrum, spectral flux, onset envelope, peaks) lives in a workspace
+allocated once at construction and is updated with out= operations, and the
+results are written into the same AnalysisResult every hop. On the Pi the
+allocator and the garbage collector otherwise show up in the tail latency of
+analyze, which is what makes the lights miss beats.
+
+The STFT is computed here rather than by librosa, with the same centered,
+zero padded hann frames, so librosa is only needed for the mel filterbank and
+the peak picker is a numba copy of librosa's that writes into a preallocated
+array. Single source only, and without the track cache.
+
+    analyser = PreallocatedAnalyser(sr=44100, hop_length=512)
+    result = analyser.analyze(frame)  # valid until the next analyze
+    if result.send_pulse:
+        ...
+
+    python -m benchmarks.analyzer_allocations  # checks zero allocations per hop
+"""
+import threading
+import time
+
+import numpy as np
+
+from .analyzer import ONSET_N_FFT, MusicAnalyser, band_filterbank, mel_filterbank
+
+# numpy 2.0 added out= to the fft functions
+RFFT_OUT = np.lib.NumpyVersion(np.__version__) >= "2.0.0"
+
+_peak_pick = None
+
+
+def _peak_pick_into(x, pre_max, post_max, pre_avg, post_avg, delta, wait, peaks, indices):
+    """librosa.util.peak_pick writing the peak mask to peaks and the peak
+    frames to indices. Returns the number of peaks."""
+    length = x.shape[0]
+    peaks[:] = False
+    count = 0
+    # special case the first frame
+    peaks[0] = x[0] >= np.max(x[: min(post_max, length)]) and x[0] >= np.mean(
+        x[: min(post_avg, length)]
+    ) + delta
+    if peaks[0]:
+        indices[count] = 0
+        count += 1
+        n = wait + 1
+    else:
+        n = 1
+    while n < length:
+        # local max and sufficiently above average
+        if x[n] == np.max(x[max(0, n - pre_max) : min(n + post_max, length)]):
+            if x[n] >= np.mean(x[max(0, n - pre_avg) : min(n + post_avg, length)]) + delta:
+                peaks[n] = True
+                indices[count] = n
+                count += 1
+                # skip the next wait frames
+                n += wait + 1
+                continue
+        n += 1
+    return count
+
+
+def _compile_peak_pick():
+    global _peak_pick
+    if _peak_pick is None:
+        import numba
+
+        _peak_pick = numba.njit(cache=True)(_peak_pick_into)
+    return _peak_pick
+
+
+def warmup_peak_pick():
+    """Compile the peak picker for the argument types analyze passes it, or
+    load it from numba's cache."""
+    x = np.zeros(8, dtype=np.float32)
+    _compile_peak_pick()(x, 1, 1, 1, 1, 0.5, 1, np.zeros(8, dtype=bool), np.zeros(8, dtype=np.int64))
+
+
+class AnalysisResult:
+    """Results of one hop, with the keys of the MusicAnalyser.analyze dict as
+    attributes. The analyser overwrites it every hop, copy what has to
+    outlive the next analyze (as_dict() and copying the arrays)."""
+
+    __slots__ = (
+        "send_pulse",
+        "strength",
+        "set_mode",
+        "tempo",
+        "next_beat_time",
+        "onset_value",
+        "onsets",
+        "bands",
+    )
+
+    def __init__(self):
+        for key in self.__slots__:
+            setattr(self, key, None)
+
+    # dict style access, so code written for the analyze dicts keeps working
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class PreallocatedAnalyser(MusicAnalyser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.track_cache is not None:
+            raise ValueError("PreallocatedAnalyser does not follow track timelines")
+        if self.cost_budget is not None:
+            raise ValueError("PreallocatedAnalyser has fixed workspaces, it does not degrade")
+        n_fft, hop = self.frame_length, self.hop_length
+        self.n_frames = n_frames = 1 + self.history_len // hop
+        n_bins = n_fft // 2 + 1
+
+        # the history window, zero padded by n_fft // 2 on both sides like
+        # librosa.stft(center=True), and its frames as a strided view of it.
+        # float64 like the windowed frames in librosa, numpy's float32 rfft
+        # converts to float64 in a temporary anyway
+        self.y = np.empty(self.history_len, dtype=np.float32)
+        self.pad = n_fft // 2
+        self.padded = np.zeros(self.history_len + 2 * self.pad)
+        self.frames = np.lib.stride_tricks.as_strided(
+            self.padded,
+            shape=(n_frames, n_fft),
+            strides=(hop * self.padded.itemsize, self.padded.itemsize),
+            writeable=False,
+        )
+        # periodic hann, as scipy.signal.get_window("hann", n_fft) in librosa
+        self.fft_window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)
+        self.windowed = np.empty((n_frames, n_fft))
+        self.spectrum = np.empty((n_frames, n_bins), dtype=np.complex128)
+        # librosa stores the STFT as complex64
+        self.spectrum64 = np.empty((n_frames, n_bins), dtype=np.complex64)
+        # everything is (frames, bins), the transpose of librosa, so that the
+        # operands of every ufunc below are contiguous and numpy does not
+        # allocate buffers to iterate them
+        self.magnitude = np.empty((n_frames, n_bins), dtype=np.float32)
+        if self.onset_mode == "mel":
+            self.power = np.empty_like(self.magnitude)
+            self.db = np.empty((n_frames, self.n_mels), dtype=np.float32)
+        else:
+            self.db = np.empty_like(self.magnitude)
+        self.flux = np.empty((n_frames - 1, self.db.shape[1]), dtype=np.float32)
+        self.onset_env = np.empty(n_frames, dtype=np.float32)
+        self.onset_pad = min(1 + ONSET_N_FFT // (2 * hop), n_frames)
+        self.peaks = np.zeros(n_frames, dtype=bool)
+        self.peak_frames = np.zeros(n_frames, dtype=np.int64)
+        self.tiny = np.finfo(np.float32).tiny
+
+        # librosa.util.peak_pick rounds its frame counts up
+        params = dict(self.kwargs)
+        self.peak_params = tuple(
+            int(np.ceil(params[key])) for key in ("pre_max", "post_max", "pre_avg", "post_avg")
+        ) + (float(params["delta"]), int(np.ceil(params["wait"])))
+
+        # dense filterbanks, built by warmup or the first hop
+        self.mel_basis = None
+        self.band_weights = None
+        if self.n_bands:
+            self.band_magnitude = np.empty(n_bins, dtype=np.float32)
+            self.band_levels = np.empty(self.n_bands, dtype=np.float32)
+
+        self.result = AnalysisResult()
+        self.result.strength = 255
+        self.result.next_beat_time = None
+
+    def warmup(self, background=False):
+        """Compile the peak picker and build the filterbanks. Leaves the
+        workspaces alone, so analyze can run while it does."""
+        if background:
+            thread = threading.Thread(target=self.warmup, daemon=True)
+            thread.start()
+            return thread
+        st = time.time()
+        warmup_peak_pick()
+        self.build_filterbanks()
+        self.warmup_seconds = time.time() - st
+
+    def build_filterbanks(self):
+        if self.onset_mode == "mel" and self.mel_basis is None:
+            self.mel_basis = mel_filterbank(self.sr, self.frame_length, self.n_mels).toarray()
+        if self.n_bands and self.band_weights is None:
+            bands = band_filterbank(self.sr, self.frame_length, self.n_bands)
+            self.band_weights = bands.toarray().astype(np.float32)
+
+    def onset_envelope_into(self):
+        """Normalised onset strength of the history window into onset_env,
+        librosa.onset.onset_strength over the dB spectrum as in
+        MusicAnalyser.onset_envelope."""
+        self.padded[self.pad : self.pad + self.history_len] = self.y
+        # frame by frame, multiplying the overlapping frames in one call
+        # makes numpy buffer them
+        for i in range(self.n_frames):
+            np.multiply(self.frames[i], self.fft_window, out=self.windowed[i])
+        if RFFT_OUT:
+            np.fft.rfft(self.windowed, axis=-1, out=self.spectrum)
+        else:
+            self.spectrum[...] = np.fft.rfft(self.windowed, axis=-1)
+        np.copyto(self.spectrum64, self.spectrum)
+        np.abs(self.spectrum64, out=self.magnitude)
+
+        db = self.db
+        if self.onset_mode == "mel":
+            np.multiply(self.magnitude, self.magnitude, out=self.power)
+            np.matmul(self.power, self.mel_basis.T, out=db)
+            features = db
+        else:
+            features = self.magnitude
+        # power_to_db(top_db=None), then clip 80 dB below the peak
+        np.maximum(features, 1e-10, out=db)
+        np.log10(db, out=db)
+        np.multiply(db, 10.0, out=db)
+        np.maximum(db, db.max() - 80.0, out=db)
+
+        # positive flux between frames, averaged over bins and shifted by the
+        # lag and the framing of onset_strength
+        np.subtract(db[1:], db[:-1], out=self.flux)
+        np.maximum(self.flux, 0.0, out=self.flux)
+        env, pad = self.onset_env, self.onset_pad
+        env[:pad] = 0.0
+        # np.mean, without its python overhead
+        np.add.reduce(self.flux[: self.n_frames - pad], axis=1, out=env[pad:])
+        np.divide(env[pad:], self.flux.shape[1], out=env[pad:])
+
+        np.subtract(env, env.min(), out=env)
+        np.divide(env, env.max() + self.tiny, out=env)
+
+    def band_energies_into(self, start, stop, floor_db=-60.0):
+        """MusicAnalyser.band_energies of frames start:stop into band_levels."""
+        if not self.n_bands or stop <= start:
+            return None
+        levels = self.band_levels
+        np.add.reduce(self.magnitude[start:stop], axis=0, out=self.band_magnitude)
+        np.divide(self.band_magnitude, stop - start, out=self.band_magnitude)
+        np.matmul(self.band_weights, self.band_magnitude, out=levels)
+        # a full scale sine peaks at frame_length / 4 with the hann window
+        np.multiply(levels, 4.0 / self.frame_length, out=levels)
+        np.add(levels, 1e-10, out=levels)
+        np.log10(levels, out=levels)
+        # 20 * log10 mapped from [floor_db, 0] to [0, 1]
+        np.multiply(levels, -20.0 / floor_db, out=levels)
+        np.add(levels, 1.0, out=levels)
+        # np.clip keeps a little of every call on its python path
+        np.maximum(levels, 0.0, out=levels)
+        np.minimum(levels, 1.0, out=levels)
+        return levels
+
+    def analyze(self, frame):
+        self.store_frame(frame)
+        # only builds them when warmup has not
+        self.build_filterbanks()
+        # cast, then scale, dividing the int16 window directly makes numpy
+        # buffer the cast
+        np.copyto(self.y, self.history.window(self.history_len))
+        np.divide(self.y, np.iinfo(np.int16).max, out=self.y)
+        self.onset_envelope_into()
+        n_peaks = _compile_peak_pick()(self.onset_env, *self.peak_params, self.peaks, self.peak_frames)
+
+        # MusicAnalyser.frames_to_check as a slice
+        start = self.n_frames - self.delay_frames
+        stop = min(start + len(frame) // self.hop_length, self.n_frames)
+
+        result = self.result
+        result.send_pulse = stop > start and bool(self.peaks[start:stop].any())
+        result.onset_value = float(self.onset_env[start:stop].max()) if stop > start else 0.0
+        result.set_mode = self.tick_mode(len(frame))
+        result.tempo = self.tempo
+        result.onsets = self.peak_frames[:n_peaks]
+        result.bands = self.band_energies_into(start, stop)
+        return result
@@ -0,0 +1,217 @@
+"""Record captured audio and per-hop analyser outputs for post-mortems.
+
+A session is a directory with one file per stream. Each file is a 64 byte
+header followed by contiguous fixed-size items; the writer grows the file in
+preallocated chunks and memory maps it, and commits the item count in the
+header after every write, so a session cut short by a crash is still readable
+up to its last write. All writes happen on a background thread, the hot loop
+only enqueues; when the writer falls behind by max_queued items the newest
+are dropped and counted rather than queued without bound, leaving a gap in
+the session. Audio is recorded interleaved, with all its channels.
+
+    recorder = SessionRecorder("sessions/today", sr=44100, channels=2)
+    recorder.record_audio(frame)
+    recorder.record_hop(analyse_results)
+    ...
+    recorder.close()
+
+    session = load_session("sessions/today")
+    session["audio"], session["hops"], session["onsets"]
+"""
+import collections
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b"ARCREC01"
+HEADER_SIZE = 64
+# magic, kind, item_size, channels, rate
+HEADER_FORMAT = "<8s16sIII"
+COUNT_OFFSET = 48
+
+STREAM_DTYPES = {
+    "audio": np.dtype("<i2"),
+    "hops": np.dtype(
+        [
+            ("time", "<f8"),
+            ("hop", "<u8"),
+            ("onset_value", "<f4"),
+            ("strength", "<f4"),
+            ("send_pulse", "u1"),
+            ("set_mode", "u1"),
+        ]
+    ),
+    # onset frames detected in the history window at each hop
+    "onsets": np.dtype([("hop", "<u8"), ("frame", "<i4")]),
+}
+
+
+class _StreamFile:
+    def __init__(self, path, kind, channels, rate, chunk_bytes):
+        self.dtype = STREAM_DTYPES[kind]
+        self.chunk_bytes = chunk_bytes
+        self.count = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.size = HEADER_SIZE + chunk_bytes
+        os.ftruncate(self.fd, self.size)
+        self.mm = mmap.mmap(self.fd, self.size)
+        struct.pack_into(
+            HEADER_FORMAT,
+            self.mm,
+            0,
+            MAGIC,
+            kind.encode(),
+            self.dtype.itemsize,
+            channels,
+            rate,
+        )
+        self._commit()
+
+    def append(self, items):
+        items = np.ascontiguousarray(items, dtype=self.dtype)
+        start = HEADER_SIZE + self.count * self.dtype.itemsize
+        end = start + items.nbytes
+        if end > self.size:
+            self._grow(end)
+        self.mm[start:end] = items.tobytes()
+        self.count += len(items)
+        self._commit()
+
+    def _grow(self, needed):
+        while self.size < needed:
+            self.size += self.chunk_bytes
+        self.mm.close()
+        os.ftruncate(self.fd, self.size)
+        self.mm = mmap.mmap(self.fd, self.size)
+
+    def _commit(self):
+        struct.pack_into("<Q", self.mm, COUNT_OFFSET, self.count)
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        # drop the unused tail of the last chunk
+        os.ftruncate(self.fd, HEADER_SIZE + self.count * self.dtype.itemsize)
+        os.close(self.fd)
+
+
+class SessionRecorder:
+    def __init__(self, path, sr=44100, channels=1, chunk_s=10.0, max_queued=512):
+        """
+        path: session directory, created if needed
+        sr, channels: format of the interleaved audio passed to record_audio
+        chunk_s: seconds of audio preallocated each time a file grows
+        max_queued: items waiting for the writer before new ones are dropped
+        """
+        os.makedirs(path, exist_ok=True)
+        audio_chunk = int(chunk_s * sr) * channels * STREAM_DTYPES["audio"].itemsize
+        self.streams = {
+            "audio": _StreamFile(
+                os.path.join(path, "audio.bin"), "audio", channels, sr, audio_chunk
+            ),
+            "hops": _StreamFile(
+                os.path.join(path, "hops.bin"), "hops", channels, sr, 1 << 20
+            ),
+            "onsets": _StreamFile(
+                os.path.join(path, "onsets.bin"), "onsets", channels, sr, 1 << 20
+            ),
+        }
+        self.hop = 0
+        # items that failed to write
+        self.dropped = 0
+        # items of each stream dropped because the writer was behind
+        self.overflows = collections.Counter()
+        self.queue = queue.Queue(max_queued)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record_audio(self, frame):
+        self._put("audio", frame)
+
+    def record_hop(self, analyse_results):
+        """Enqueue the outputs of MusicAnalyser.analyze for one hop."""
+        hop = self.hop
+        self.hop += 1
+        self._put(
+            "hops",
+            (
+                time.time(),
+                hop,
+                analyse_results.get("onset_value", 0.0),
+                analyse_results["strength"],
+                analyse_results["send_pulse"],
+                analyse_results["set_mode"],
+            ),
+        )
+        onsets = analyse_results.get("onsets")
+        if onsets is not None and len(onsets):
+            self._put("onsets", (hop, onsets))
+
+    def _put(self, kind, payload):
+        try:
+            self.queue.put_nowait((kind, payload))
+        except queue.Full:
+            self.overflows[kind] += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, payload = item
+            if kind == "hops":
+                payload = np.array([payload], dtype=STREAM_DTYPES["hops"])
+            elif kind == "onsets":
+                hop, frames = payload
+                payload = np.empty(len(frames), dtype=STREAM_DTYPES["onsets"])
+                payload["hop"] = hop
+                payload["frame"] = frames
+            try:
+                self.streams[kind].append(payload)
+            except OSError as e:
+                # a full disk must not take the show down
+                self.dropped += 1
+                print(f"Recorder failed to write {kind}: {e}")
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for stream in self.streams.values():
+            stream.close()
+        if self.overflows:
+            dropped = ", ".join(f"{n} {kind}" for kind, n in self.overflows.items())
+            print(f"Recorder fell behind and dropped {dropped}")
+
+
+def load_stream(path):
+    """Map a recorded stream file and return (items, header) with items a
+    read-only numpy view of the committed records."""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, kind, item_size, channels, rate = struct.unpack_from(HEADER_FORMAT, mm)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a recorded stream")
+    kind = kind.rstrip(b"\0").decode()
+    dtype = STREAM_DTYPES[kind]
+    if dtype.itemsize != item_size:
+        raise ValueError(f"{path}: item size {item_size} does not match {kind}")
+    (count,) = struct.unpack_from("<Q", mm, COUNT_OFFSET)
+    items = np.frombuffer(mm, dtype=dtype, count=count, offset=HEADER_SIZE)
+    if kind == "audio" and channels > 1:
+        items = items.reshape(-1, channels)
+    return items, dict(kind=kind, channels=channels, rate=rate)
+
+
+def load_session(path):
+    session = {}
+    for kind in STREAM_DTYPES:
+        items, header = load_stream(os.path.join(path, f"{kind}.bin"))
+        session[kind] = items
+        if kind == "audio":
+            session["sr"] = header["rate"]
+    return session
@@ -0,0 +1,159 @@
+"""History ring buffers whose windows are always contiguous views.
+
+MirroredRing maps the same memfd pages twice, back to back, so the items
+written at the end of the ring also appear before its start in the second
+mapping, and the last n items are a plain slice wherever the write position
+is. No compaction copies, and the ring only holds its capacity (rounded up to
+whole pages). Where memfd_create or mmap through libc is not available,
+DoubledRing gets the same views by writing every item twice into an array of
+twice the capacity.
+
+Items are stored time major, (capacity, *shape), so the windows of a ring of
+several sources are contiguous too; window() returns them with time on the
+last axis like the frames passed to write().
+"""
+import ctypes
+import ctypes.util
+import mmap
+import os
+import weakref
+
+import numpy as np
+
+# Linux values, memfd_create only exists there
+PROT_NONE = 0x0
+MAP_PRIVATE = 0x02
+MAP_ANONYMOUS = 0x20
+MAP_FIXED = 0x10
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_size_t,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_long,
+        ]
+        libc.munmap.restype = ctypes.c_int
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        _libc = libc
+    return _libc
+
+
+def _map_mirrored(size):
+    """Address of 2 * size bytes of address space whose halves are the same
+    size bytes of memory, and the memfd backing them."""
+    libc = _load_libc()
+    fd = os.memfd_create("music_analyser_ring")
+    try:
+        os.ftruncate(fd, size)
+        # reserve both halves, then map the memfd over each of them
+        addr = libc.mmap(None, 2 * size, PROT_NONE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0)
+        if addr in (None, MAP_FAILED):
+            raise OSError(ctypes.get_errno(), "mmap reserve failed")
+        for half in (addr, addr + size):
+            mapped = libc.mmap(
+                half,
+                size,
+                mmap.PROT_READ | mmap.PROT_WRITE,
+                mmap.MAP_SHARED | MAP_FIXED,
+                fd,
+                0,
+            )
+            if mapped != half:
+                libc.munmap(addr, 2 * size)
+                raise OSError(ctypes.get_errno(), "mmap mirror failed")
+    except Exception:
+        os.close(fd)
+        raise
+    return addr, fd
+
+
+def _unmap_mirrored(addr, size, fd):
+    _load_libc().munmap(addr, 2 * size)
+    os.close(fd)
+
+
+class _Ring:
+    def __init__(self, capacity, shape, dtype):
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        # absolute number of items written, the write position is its modulo
+        self.count = 0
+
+    def write(self, frame):
+        """Append frame, (*shape, n) with time on the last axis."""
+        frame = np.moveaxis(np.asarray(frame), -1, 0)
+        n = len(frame)
+        if n > self.capacity:
+            frame = frame[-self.capacity :]
+            self.count += n - self.capacity
+            n = self.capacity
+        self._write(self.count % self.capacity, frame)
+        self.count += n
+
+    def window(self, n):
+        """View of the last n items, (*shape, n)."""
+        if n > self.capacity:
+            raise ValueError(f"Window of {n} items exceeds the capacity {self.capacity}")
+        start = (self.count - n) % self.capacity
+        return np.moveaxis(self.data[start : start + n], 0, -1)
+
+
+class MirroredRing(_Ring):
+    def __init__(self, capacity, shape=(), dtype=np.int16):
+        """capacity: items kept, rounded up so the ring is whole pages"""
+        dtype = np.dtype(dtype)
+        item_bytes = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+        # the smallest number of items that fills whole pages
+        items_per_unit = mmap.PAGESIZE // int(np.gcd(mmap.PAGESIZE, item_bytes))
+        capacity = -(-capacity // items_per_unit) * items_per_unit
+        super().__init__(capacity, shape, dtype)
+
+        size = capacity * item_bytes
+        addr, fd = _map_mirrored(size)
+        memory = (ctypes.c_char * (2 * size)).from_address(addr)
+        # unmapped once the last view of the memory is gone, left to the OS
+        # at exit when views may still be in use
+        weakref.finalize(memory, _unmap_mirrored, addr, size, fd).atexit = False
+        self.data = np.frombuffer(memory, dtype=dtype).reshape((2 * capacity,) + self.shape)
+        # memfd pages start zeroed, like the history of a fresh analyser
+
+    def _write(self, pos, frame):
+        n = len(frame)
+        self.data[pos : pos + n] = frame
+
+
+class DoubledRing(_Ring):
+    def __init__(self, capacity, shape=(), dtype=np.int16):
+        super().__init__(capacity, shape, dtype)
+        self.data = np.zeros((2 * capacity,) + self.shape, dtype=dtype)
+
+    def _write(self, pos, frame):
+        n = len(frame)
+        # each item goes to pos and pos + capacity, so any window starting
+        # in the first half is contiguous
+        first = min(n, self.capacity - pos)
+        self.data[pos : pos + n] = frame
+        self.data[pos + self.capacity : pos + self.capacity + first] = frame[:first]
+        self.data[: n - first] = frame[first:]
+
+
+def make_ring(capacity, shape=(), dtype=np.int16):
+    """MirroredRing where the platform allows it, DoubledRing otherwise."""
+    if hasattr(os, "memfd_create"):
+        try:
+            return MirroredRing(capacity, shape, dtype)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return DoubledRing(capacity, shape, dtype)
@@ -0,0 +1,208 @@
+"""Sweep the onset peak picking settings against annotated recordings.
+
+The onset envelope of every file is computed once (and cached on disk), then
+each setting of the grid replays the real-time detection on it: for every
+analysis step the envelope of the last history window is normalised and
+peak picked, and the frames at the playback delay are checked, like
+MusicAnalyser.analyze does. It is an approximation of the live scores, not a
+reproduction: analyze computes the envelope of each history window from
+that window's audio alone, so the frames at its edges (the STFT padding) and
+the dB floor relative to the window's loudest frame differ from a slice of
+the whole file's envelope. Settings are evaluated in a process pool.
+
+Each audio file needs an annotation file next to it with the same name and a
+.txt extension, holding one onset time in seconds per line (first column):
+
+    python -m music_analyser.sweep recordings/*.wav --workers 8 --top 20
+"""
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import itertools
+import os
+import time
+
+import numpy as np
+
+from config import sr, history_s, hop_length, frame_length, delay_seconds, hops_per_analyse
+from music_analyser.analyzer import MusicAnalyser, default_peak_pick_params
+
+DEFAULT_GRID = dict(
+    pre_max=[1, 2, 3],
+    post_max=[1, 2],
+    pre_avg=[4, 8, 12],
+    post_avg=[1, 5, 9],
+    wait=[1, 2, 4],
+    delta=[0.2, 0.3, 0.4, 0.5, 0.6, 0.7],
+)
+
+# tolerance window for a detection to count as a hit, as in MIREX
+TOLERANCE_S = 0.05
+
+
+def load_envelope(path, analyser, cache_dir):
+    """Onset envelope of a whole file, cached per analyser configuration."""
+    key = hashlib.sha1(
+        repr(
+            (
+                os.path.abspath(path),
+                os.path.getmtime(path),
+                analyser.sr,
+                analyser.hop_length,
+                analyser.frame_length,
+                analyser.onset_mode,
+                analyser.n_mels,
+            )
+        ).encode()
+    ).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"{os.path.basename(path)}-{key}.npy")
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    import librosa
+
+    y, _ = librosa.load(path, sr=analyser.sr, mono=True)
+    env = analyser.onset_envelope(y)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_path, env)
+    return env
+
+
+def load_annotations(path):
+    with open(path) as f:
+        return np.sort(
+            np.array([float(line.split()[0]) for line in f if line.strip()])
+        )
+
+
+def replay(env, params, history_frames, delay_frames, step_frames):
+    """Detection times (in frames) the real-time analyser would produce on
+env, up to the edge differences of its windowed envelopes."""
+    import librosa
+
+    detected = []
+    for end in range(history_frames, len(env) + 1, step_frames):
+        window = env[end - history_frames : end]
+        window = window - window.min()
+        window = window / (window.max() + librosa.util.tiny(window))
+        peaks = librosa.util.peak_pick(window, **params)
+        for i in range(step_frames):
+            frame = history_frames - delay_frames + i
+            if frame < history_frames and frame in peaks:
+                detected.append(end - history_frames + frame)
+    return np.unique(detected)
+
+
+def f_measure(detected, reference, tolerance):
+    """Greedy one-to-one matching of sorted detections to sorted references."""
+    hits = 0
+    i = j = 0
+    while i < len(detected) and j < len(reference):
+        if abs(detected[i] - reference[j]) <= tolerance:
+            hits += 1
+            i += 1
+            j += 1
+        elif detected[i] < reference[j]:
+            i += 1
+        else:
+            j += 1
+    return hits, len(detected) - hits, len(reference) - hits
+
+
+# per worker state, set by _init_worker so envelopes are sent once per process
+_tracks = None
+_frames = None
+
+
+def _init_worker(tracks, frames):
+    global _tracks, _frames
+    _tracks, _frames = tracks, frames
+
+
+def evaluate(params):
+    history_frames, delay_frames, step_frames, frame_s = _frames
+    tp = fp = fn = 0
+    steps = 0
+    st = time.process_time()
+    for env, reference in _tracks:
+        detected = replay(env, params, history_frames, delay_frames, step_frames)
+        # the delayed frame is what is heard, its time is the onset time
+        counts = f_measure(detected * frame_s, reference, TOLERANCE_S)
+        tp, fp, fn = tp + counts[0], fp + counts[1], fn + counts[2]
+        steps += max(0, (len(env) - history_frames) // step_frames + 1)
+    cpu = time.process_time() - st
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return dict(
+        params,
+        f_measure=f,
+        precision=precision,
+        recall=recall,
+        cpu_us_per_step=cpu / max(steps, 1) * 1e6,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("audio", nargs="+", help="annotated audio files")
+    parser.add_argument("--cache", default=".sweep_cache", help="envelope cache directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--onset-mode", default="linear", choices=["linear", "mel"])
+    parser.add_argument("--top", type=int, default=10, help="settings to print")
+    parser.add_argument("--csv", help="write every setting's results to this file")
+    args = parser.parse_args()
+
+    analyser = MusicAnalyser(
+        sr=sr,
+        history_s=history_s,
+        hop_length=hop_length,
+        frame_length=frame_length,
+        delay_seconds=delay_seconds,
+        onset_mode=args.onset_mode,
+    )
+    tracks = []
+    for path in args.audio:
+        st = time.time()
+        env = load_envelope(path, analyser, args.cache)
+        reference = load_annotations(os.path.splitext(path)[0] + ".txt")
+        tracks.append((env, reference))
+        print(f"{path}: {len(env)} frames, {len(reference)} onsets ({time.time() - st:.1f}s)")
+
+    frames = (
+        # onset envelope of a history window has one frame per hop plus one
+        analyser.history_len // hop_length + 1,
+        analyser.delay_frames,
+        hops_per_analyse,
+        hop_length / sr,
+    )
+    names = list(DEFAULT_GRID)
+    grid = [dict(zip(names, values)) for values in itertools.product(*DEFAULT_GRID.values())]
+    print(f"Evaluating {len(grid)} settings with {args.workers} workers...")
+
+    st = time.time()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers, initializer=_init_worker, initargs=(tracks, frames)
+    ) as pool:
+        results = list(pool.map(evaluate, grid, chunksize=8))
+    print(f"Done in {time.time() - st:.1f}s")
+
+    _init_worker(tracks, frames)
+    current = evaluate(default_peak_pick_params(sr, hop_length))
+    results.sort(key=lambda r: r["f_measure"], reverse=True)
+    columns = names + ["f_measure", "precision", "recall", "cpu_us_per_step"]
+    print(" ".join(f"{c:>10.10}" for c in columns))
+    for r in [current] + results[: args.top]:
+        print(" ".join(f"{r[c]:>10.3f}" if isinstance(r[c], float) else f"{r[c]:>10}" for c in columns))
+    print("(first row: current defaults)")
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Precompile the numba kernels used by the analyser.
+
+librosa and the peak picker of PreallocatedAnalyser cache their jitted
+functions on disk, so running this once after installing (as a user that can
+write to the package directories) lets later starts load compiled code
+instead of compiling on the first hop:
+
+    python -m music_analyser.warmup
+"""
+import time
+
+from config import sr, history_s, hop_length, frame_length, delay_seconds
+from music_analyser import MusicAnalyser
+from music_analyser.preallocated import warmup_peak_pick
+
+
+def warmup():
+    analyser = MusicAnalyser(
+        sr=sr,
+        history_s=history_s,
+        hop_length=hop_length,
+        frame_length=frame_length,
+        delay_seconds=delay_seconds,
+    )
+    analyser.warmup()
+    # a dummy envelope, the kernel compiles for the types and not the sizes
+    warmup_peak_pick()
+
+
+if __name__ == "__main__":
+    st = time.time()
+    warmup()
+    print(f"Warmed up in {time.time() - st:.2f}s")
@@ -0,0 +1,472 @@
+"""Asyncio runtime of the analyser: capture, analysis and controller sends
+as concurrent stages with their own deadlines.
+
+    capture -> frames -> analyse (worker thread) -> events -> one sender per client
+
+capture polls the audio monitor and never waits for the later stages,
+analyse runs analyze() in a worker thread so the loop keeps capturing while
+it runs, and every controller client sends from its own thread, so a slow
+or dead controller server only delays its own events. Events that cannot be
+sent before their deadline are dropped instead of sent late.
+
+After idle_after_s of silence, measured by the monitor on its capture
+thread, capture stops handing audio to the analyser, checks the monitor once
+a hop and tells the controllers to switch to their ambient effect. The first
+hop with sound goes to the analyser again.
+
+How capture reads the monitor and the deadlines of the stages come from a
+profile in config.profiles: main.py runs the "hop" profile (fixed reads of
+hops_per_analyse hops), main_poll.py the "poll" profile (everything queued).
+"""
+import time
+
+startup_marks = [("start", time.perf_counter())]
+
+import argparse
+import asyncio
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from pa_monitor import AudioMonitor
+from music_analyser import MusicAnalyser
+from music_analyser.analyzer import DEGRADATION_LADDER
+from music_analyser.fingerprint import TrackCache
+from music_analyser.preallocated import PreallocatedAnalyser
+from music_analyser.recorder import SessionRecorder
+from controller import FerroControllerClient, LightControllerClient
+from controller.sync import EventPublisher, FanoutClient
+
+from config import *
+
+startup_marks.append(("imports", time.perf_counter()))
+
+CHANNELS = 2
+
+
+def print_startup_profile(marks):
+    print("Startup profile:")
+    t0 = marks[0][1]
+    last = t0
+    for step, t in marks[1:]:
+        print(f"  {step:<16} +{(t - last) * 1000:8.1f} ms  ({(t - t0) * 1000:8.1f} ms)")
+        last = t
+
+
+class Sender:
+    """Calls the methods of one controller client from its own thread, in
+    order. An event still waiting when its deadline passes is dropped, a call
+    not answered within timeout_s is given up on (the thread stays blocked
+    until the server answers, and later events wait for it). A call that
+    raises is counted as failed, and the next event is sent."""
+
+    def __init__(self, name, client, timeout_s, deadline_s):
+        self.name = name
+        self.client = client
+        self.timeout_s = timeout_s
+        self.deadline_s = deadline_s
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix=f"send-{name}")
+        self.queue = asyncio.Queue()
+        # the call in flight, possibly one that timed out
+        self.call = None
+        self.counts = collections.Counter()
+
+    def send(self, method, *args):
+        loop = asyncio.get_running_loop()
+        self.queue.put_nowait((loop.time() + self.deadline_s, method, args))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            deadline, method, args = await self.queue.get()
+            if method is None:
+                return
+            if self.call is not None and not self.call.done():
+                # a timed out call is still blocking the thread
+                await asyncio.wait([self.call], timeout=max(deadline - loop.time(), 0))
+            if loop.time() > deadline or not self.call_done():
+                self.counts["dropped"] += 1
+                continue
+            self.call = loop.run_in_executor(self.executor, getattr(self.client, method), *args)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.call), self.timeout_s)
+                self.counts["sent"] += 1
+            except asyncio.TimeoutError:
+                self.counts["timed_out"] += 1
+                print(f"{self.name}: {method} not answered within {self.timeout_s * 1000:.0f} ms")
+                # it may still fail once the server answers
+                self.call.add_done_callback(lambda call, method=method: self.check_late(call, method))
+            except Exception as e:
+                self.failed(method, e)
+
+    def failed(self, method, error):
+        self.counts["failed"] += 1
+        print(f"{self.name}: {method} failed: {error!r}")
+
+    def check_late(self, call, method):
+        if not call.cancelled() and call.exception() is not None:
+            self.failed(method, call.exception())
+
+    def call_done(self):
+        return self.call is None or self.call.done()
+
+    def close(self):
+        """Send stop after the queued events and end run()."""
+        self.send("stop")
+        self.queue.put_nowait((None, None, None))
+
+    def shutdown(self):
+        # a thread blocked on a dead server must not keep the process alive
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Runtime:
+    def __init__(
+        self,
+        audio_source,
+        profile="hop",
+        record_path=None,
+        track_cache_path=None,
+        journal_path=None,
+    ):
+        if profile not in profiles:
+            raise ValueError(f"Unknown runtime profile {profile}, one of {', '.join(profiles)}")
+        self.profile = profile
+        self.settings = profiles[profile]
+
+        self.publisher = None
+        if fanout:
+            print("publishing controller events to all nodes...")
+            self.publisher = EventPublisher(lead_s=fanout_lead_s)
+            self.ferro_fluid_controller = FanoutClient(self.publisher, "ferro")
+            self.light_strip_controller = FanoutClient(self.publisher, "light")
+        else:
+            journals = dict(light=None, ferro=None)
+            if journal_path is not None:
+                os.makedirs(journal_path, exist_ok=True)
+                for target in journals:
+                    journals[target] = os.path.join(journal_path, f"{target}.journal")
+            print("initializing ferro controller...")
+            self.ferro_fluid_controller = FerroControllerClient(journals["ferro"])
+            print("initializing light controller...")
+            self.light_strip_controller = LightControllerClient(journals["light"])
+
+        # the first modes are set before the loop runs, blocking is fine here
+        mode = self.generate_ferrofluid_mode(120)
+        self.ferro_fluid_controller.set_mode(mode, 120)
+        mode, color = self.generate_light_mode_and_color(120)
+        self.light_strip_controller.set_mode(
+            "spectrum" if spectrum_bands else "water", 60, color
+        )
+        startup_marks.append(("controllers", time.perf_counter()))
+
+        print("initializing audio monitor...")
+        self.audio_monitor = AudioMonitor(
+            audio_source,
+            delay_seconds=delay_seconds,
+            fragment_seconds=fragment_seconds,
+        )
+        self.audio_monitor.set_silence_threshold(silence_threshold)
+        self.track_cache = None
+        if track_cache_path is not None:
+            print(f"loading track cache from {track_cache_path}...")
+            self.track_cache = TrackCache(track_cache_path, sr=sr, hop_length=hop_length)
+        print("initializing music analyzer...")
+        analyser_class = PreallocatedAnalyser if preallocate else MusicAnalyser
+        self.audio_analyzer = analyser_class(
+            sr=sr,
+            history_s=history_s,
+            hop_length=hop_length,
+            frame_length=frame_length,
+            delay_seconds=delay_seconds,
+            track_cache=self.track_cache,
+            onset_mode=onset_mode,
+            n_mels=n_mels,
+            n_bands=spectrum_bands,
+            cost_budget=None if preallocate else cost_budget,
+        )
+        # load librosa while the monitor is starting up
+        self.audio_analyzer.warmup(background=True)
+        # analyze() is not reentrant, one worker runs the hops in order
+        self.analysis_executor = ThreadPoolExecutor(1, thread_name_prefix="analyse")
+
+        self.recorder = None
+        if record_path is not None:
+            print(f"recording session to {record_path}")
+            self.recorder = SessionRecorder(record_path, sr=sr, channels=CHANNELS)
+
+        # samples per channel read at once by the "hop" read mode
+        self.read_length = hop_length * hops_per_analyse
+        # watch mode, nothing is analysed while idle
+        self.idle = False
+        # silence_seconds is free to poll, resume within a hop of sound
+        self.idle_poll_s = hop_length / sr
+        self.counts = collections.Counter()
+        self.analyse_times = collections.deque(maxlen=1000)
+        self.first_hop = True
+
+    def generate_light_mode_and_color(self, tempo):
+        mode = np.random.choice(["water", "breathe", "sparkling"], p=[0.5, 0.3, 0.2])
+        color = colors_dict[np.random.choice(list(colors_dict.keys()))]
+        print("random sampled", color, mode)
+        return mode, color
+
+    def generate_ferrofluid_mode(self, tempo):
+        return "walk"
+
+    def read_frame(self, read=None):
+        """Interleaved audio to analyse next, empty if not enough has been
+        captured yet. read overrides the read mode of the profile."""
+        if (read or self.settings["read"]) == "hop":
+            if self.audio_monitor.queue_length() < self.read_length * CHANNELS:
+                return np.zeros(0, dtype=np.int16)
+            frame = self.audio_monitor.get_data(self.read_length)
+        else:
+            frame = self.audio_monitor.get_data(self.audio_monitor.queue_length() // CHANNELS)
+        return frame
+
+    def watch(self, light, ferro):
+        """Go idle after idle_after_s of silence and back on the first sound.
+        Returns whether the runtime is idle."""
+        if idle_after_s is None:
+            return False
+        silent = self.audio_monitor.silence_seconds()
+        if not self.idle and silent >= idle_after_s:
+            self.idle = True
+            self.counts["idle_periods"] += 1
+            print(f"Silent for {silent:.1f}s, idling")
+        elif self.idle and silent < idle_after_s:
+            self.idle = False
+            print("Sound back, analysing")
+        else:
+            return self.idle
+        light.send("set_idle", self.idle)
+        ferro.send("set_idle", self.idle)
+        return self.idle
+
+    async def capture(self, frames, light, ferro):
+        loop = asyncio.get_running_loop()
+        poll_s = self.settings["poll_s"]
+        timeout_s = self.settings["capture_timeout_s"]
+        last_audio = loop.time()
+        stalled = False
+        while True:
+            if frames.full() and self.settings["read"] == "queue":
+                # the audio waits in the monitor and goes into the next read
+                await asyncio.sleep(poll_s)
+                continue
+            if self.idle:
+                # check once a hop, dropping what was captured meanwhile
+                await asyncio.sleep(self.idle_poll_s)
+                frame = self.read_frame("queue")
+            else:
+                frame = self.read_frame()
+            now = loop.time()
+            if not len(frame):
+                if not stalled and now - last_audio > timeout_s:
+                    stalled = True
+                    print(f"No audio captured for {timeout_s:.1f}s")
+                await asyncio.sleep(poll_s)
+                continue
+            if stalled:
+                print(f"Audio back after {now - last_audio:.1f}s")
+                stalled = False
+            last_audio = now
+            if self.watch(light, ferro):
+                # silence, and the history already holds idle_after_s of it
+                self.counts["idle_frames"] += 1
+                continue
+            self.counts["frames"] += 1
+            if frames.full():
+                # analysis is behind, the oldest audio is the least useful
+                frames.get_nowait()
+                self.counts["frames_dropped"] += 1
+            frames.put_nowait((now, frame))
+
+    def analyse_frame(self, frame):
+        """Runs in the analysis thread. Returns what the loop needs of the
+        results, copied since PreallocatedAnalyser reuses its arrays."""
+        # channel 0 is analysed, all of them are recorded
+        results = self.audio_analyzer.analyze(frame[::CHANNELS])
+        hop = dict(
+            send_pulse=bool(results["send_pulse"]),
+            strength=results["strength"],
+            set_mode=bool(results["set_mode"]),
+            tempo=results["tempo"],
+            onset_value=results.get("onset_value", 0.0),
+            onsets=None if results.get("onsets") is None else np.array(results["onsets"]),
+            bands=None if results["bands"] is None else np.array(results["bands"]),
+        )
+        if self.recorder is not None:
+            self.recorder.record_audio(frame)
+            self.recorder.record_hop(hop)
+        return hop
+
+    async def analyse(self, frames, light, ferro):
+        loop = asyncio.get_running_loop()
+        deadline_s = self.settings["analyse_deadline_s"]
+        while True:
+            read_time, frame = await frames.get()
+            st = loop.time()
+            hop = await loop.run_in_executor(self.analysis_executor, self.analyse_frame, frame)
+            now = loop.time()
+            self.analyse_times.append(now - st)
+            self.counts["hops"] += 1
+            if self.first_hop:
+                self.first_hop = False
+                startup_marks.append(("first_hop", time.perf_counter()))
+                if self.startup_profile:
+                    print_startup_profile(startup_marks)
+                    warmup = self.audio_analyzer.warmup_seconds
+                    if warmup is not None:
+                        print(f"  analyser warmup took {warmup * 1000:.1f} ms")
+
+            late = now - read_time > deadline_s
+            if late:
+                self.counts["late_hops"] += 1
+            if hop["bands"] is not None:
+                light.send("send_bands", hop["bands"])
+            elif hop["send_pulse"]:
+                if late:
+                    # the beat has already been heard
+                    self.counts["late_pulses_dropped"] += 1
+                else:
+                    light.send("send_pulse", "beat", hop["strength"], 0.1)
+            if hop["set_mode"]:
+                self.change_modes(hop["tempo"], light, ferro)
+
+    def change_modes(self, tempo, light, ferro):
+        # set mode and color for lightstrip
+        mode_light, color = self.generate_light_mode_and_color(tempo)
+        if spectrum_bands:
+            mode_light = "spectrum"
+        light.send("set_mode", mode_light, tempo, color)
+
+        # set mode for ferrofluid
+        # mode_fluid = self.generate_ferrofluid_mode(tempo)
+        # ferro.send("set_mode", mode_fluid, tempo)
+
+    def print_stats(self, senders):
+        times = np.array(self.analyse_times) * 1e3
+        print(
+            f"Runtime ({self.profile}): {self.counts['frames']} frames captured, "
+            f"{self.counts['frames_dropped']} dropped, {self.counts['hops']} analysed, "
+            f"{self.counts['late_hops']} late ({self.counts['late_pulses_dropped']} pulses dropped)"
+        )
+        if self.counts["idle_periods"]:
+            print(f"  idle {self.counts['idle_periods']} times, {self.counts['idle_frames']} reads not analysed")
+        print(f"  {self.audio_monitor.reroute_count()} sink inputs rerouted to the monitor")
+        print(f"  analyser configuration: {DEGRADATION_LADDER[self.audio_analyzer.level]['name']}")
+        if len(times):
+            print(f"  analyse p50 {np.percentile(times, 50):.2f} ms, p99 {np.percentile(times, 99):.2f} ms, max {times.max():.2f} ms")
+        for sender in senders:
+            counts = sender.counts
+            print(
+                f"  {sender.name}: {counts['sent']} sent, {counts['dropped']} dropped, "
+                f"{counts['timed_out']} timed out, {counts['failed']} failed"
+            )
+
+    async def run_async(self):
+        settings = self.settings
+        light = Sender("light", self.light_strip_controller, settings["send_timeout_s"], settings["event_deadline_s"])
+        ferro = Sender("ferro", self.ferro_fluid_controller, settings["send_timeout_s"], settings["event_deadline_s"])
+        senders = [light, ferro]
+        frames = asyncio.Queue(maxsize=settings["frame_queue"])
+        tasks = [asyncio.create_task(sender.run()) for sender in senders]
+        stages = [
+            asyncio.create_task(self.capture(frames, light, ferro)),
+            asyncio.create_task(self.analyse(frames, light, ferro)),
+        ]
+        try:
+            # the stages only end by raising, and the senders only before
+            # close() by a bug, which ends the run rather than leaving the
+            # events of that controller piling up. Unlike gather, wait does
+            # not cancel the senders when interrupted, they still send stop
+            done, _ = await asyncio.wait(stages + tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for stage in stages:
+                stage.cancel()
+            for sender in senders:
+                sender.close()
+            # stop goes out after the queued events, give each its timeout
+            await asyncio.wait(tasks, timeout=2 * settings["send_timeout_s"])
+            for sender, task in zip(senders, tasks):
+                sender.shutdown()
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    print(f"{sender.name} sender died: {task.exception()!r}")
+            self.print_stats(senders)
+
+    def run(self, startup_profile=False):
+        self.startup_profile = startup_profile
+        print("starting monitor")
+        self.audio_monitor.run()
+        # a failed startup raises, and stops what was started all the same
+        try:
+            ready = self.audio_monitor.wait_ready(startup_timeout_s)
+            for step, elapsed in self.audio_monitor.startup_timings().items():
+                print(f"  {step}: {elapsed * 1000:.1f} ms")
+            if not ready:
+                # exits through the finally below
+                raise SystemExit(f"Audio monitor not ready after {startup_timeout_s}s, giving up")
+            startup_marks.append(("monitor_ready", time.perf_counter()))
+            asyncio.run(self.run_async())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.audio_monitor.stop()
+            self.analysis_executor.shutdown(wait=True)
+            if self.publisher is not None:
+                self.publisher.print_stats()
+                self.publisher.close()
+            if self.recorder is not None:
+                self.recorder.close()
+            if self.track_cache is not None:
+                self.track_cache.close()
+            print("Stopped monitoring")
+
+
+def main(profile=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile",
+        default=profile or runtime_profile,
+        choices=sorted(profiles),
+        help="how capture polls and the stage deadlines, see config.profiles",
+    )
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="report import and first-hop latency",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="DIR",
+        help="record audio and analyser outputs to a session directory",
+    )
+    parser.add_argument(
+        "--track-cache",
+        metavar="DIR",
+        help="recognise previously played tracks and reuse their beat timelines",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="DIR",
+        help="journal the controller events sent, replay with python -m controller.replay",
+    )
+    args = parser.parse_args()
+
+    runtime = Runtime(
+        "alsa_output.platform-bcm2835_audio.stereo-fallback.monitor",
+        profile=args.profile,
+        record_path=args.record,
+        track_cache_path=args.track_cache,
+        journal_path=args.journal,
+    )
+    runtime.run(startup_profile=args.startup_profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import numpy as np
+
+from music_analyser import MusicAnalyser
+from music_analyser.analyzer import DEGRADATION_LADDER
+from music_analyser.multi_stream import MultiStreamAnalyser
+
+
+def noise_hops(n, length, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n * length) / 44100
+    y = 0.2 * np.sin(2 * np.pi * 440 * t) + 0.05 * rng.standard_normal(len(t))
+    audio = (y * np.iinfo(np.int16).max).astype(np.int16)
+    return audio.reshape(n, length)
+
+
+def analyse_at(level, hops):
+    analyser = MusicAnalyser(n_bands=8, cost_budget=0.8)
+    analyser.set_level(level)
+    for hop in hops:
+        result = analyser.analyze(hop)
+    return result
+
+
+def test_energy_rung_keeps_streaming_bands():
+    energy = len(DEGRADATION_LADDER) - 1
+    assert DEGRADATION_LADDER[energy]["detector"] == "energy"
+    hops = noise_hops(30, 1536)
+    result = analyse_at(energy, hops)
+    assert result["bands"] is not None
+    assert result["bands"].shape == (8,)
+    # the rung above analyses the same window with the same n_fft through
+    # the full STFT, the bands of the heard frames agree
+    spectral = analyse_at(energy - 1, hops)
+    np.testing.assert_allclose(result["bands"], spectral["bands"], atol=1e-3)
+    # the 440 Hz tone is heard
+    assert result["bands"].max() > 0.5
+
+
+def test_energy_rung_is_aligned_with_the_spectral_envelope():
+    energy = len(DEGRADATION_LADDER) - 1
+    sr = 44100
+    y = np.zeros(int(0.5 * sr), dtype=np.float32)
+    rng = np.random.default_rng(0)
+    clicks = [0.1, 0.23, 0.37]
+    for t in clicks:
+        start = int(t * sr)
+        y[start : start + 200] = rng.standard_normal(200)
+    analyser = MusicAnalyser(sr=sr)
+    envs = []
+    # the rung above frames the same n_fft through the full STFT
+    for level in (energy - 1, energy):
+        analyser.set_level(level)
+        envs.append(analyser.onset_envelope(y))
+    spectral, flux = envs
+    assert len(flux) == len(spectral)
+    peaks = [np.sort(np.argsort(env)[-len(clicks) :]) for env in envs]
+    np.testing.assert_array_equal(peaks[1], peaks[0])
+
+
+def drive(analyser, costs, n_hops, frame_len=1536):
+    """Feed monitor_cost n_hops hops costing costs[level] of real time, and
+    return the level after each."""
+    levels = []
+    for _ in range(n_hops):
+        cost = costs[analyser.level]
+        analyser.monitor_cost(cost * frame_len / analyser.sr, frame_len)
+        levels.append(analyser.level)
+    return levels
+
+
+def test_overload_steps_down_one_rung_per_settling_period():
+    analyser = MusicAnalyser(cost_budget=0.8)
+    # the first rung down is cheap enough
+    levels = drive(analyser, [1.6, 0.5, 0.3, 0.1], 200)
+    assert max(levels) == 1
+    # 10 warmup hops, then 5 at the full rung
+    assert levels.index(1) == 14
+
+    analyser = MusicAnalyser(cost_budget=0.8)
+    levels = drive(analyser, [2.0, 2.0, 2.0, 2.0], 40)
+    steps = [i for i in range(1, len(levels)) if levels[i] != levels[i - 1]]
+    assert [levels[i] for i in steps] == [1, 2, 3]
+    # every rung settles for 5 hops before stepping again
+    assert np.diff(steps).tolist() == [5, 5]
+
+
+def test_undone_step_up_doubles_the_recovery_period():
+    analyser = MusicAnalyser(cost_budget=0.8)
+    # the full rung is over budget, the next one has headroom
+    costs = [1.0, 0.3, 0.3, 0.3]
+    levels = drive(analyser, costs, 400)
+    ups = [i for i in range(1, len(levels)) if levels[i] < levels[i - 1]]
+    downs = [i for i in range(1, len(levels)) if levels[i] > levels[i - 1]]
+    assert levels[0] == 0 and downs[0] == 14
+    # recover_hops of headroom, then back up, then down again at once
+    assert ups[0] - downs[0] == 100
+    assert downs[1] - ups[0] == 5
+    # the next attempt waits twice as long, and fails too
+    assert ups[1] - downs[1] == 200
+    assert downs[2] - ups[1] == 5
+    assert analyser.recover_hops == 400
+
+
+def test_multi_stream_analyses_every_rung():
+    hops = noise_hops(30, 1536)
+    frames = np.stack([hops, hops[::-1]], axis=1)
+    for level in range(len(DEGRADATION_LADDER)):
+        analyser = MultiStreamAnalyser(2, n_bands=8, cost_budget=0.8)
+        analyser.set_level(level)
+        for hop in frames:
+            results = analyser.analyze(hop)
+        assert analyser.history.window(analyser.window_len).shape == (2, analyser.window_len)
+        assert [r["bands"].shape for r in results] == [(8,), (8,)]
+    # every hop feeds the cost monitor, as for one source
+    assert analyser.hops_seen == len(frames)
@@ -0,0 +1,24 @@
+import pytest
+
+from benchmarks.analyzer_allocations import hops, make_audio, trace
+from music_analyser.preallocated import PreallocatedAnalyser
+
+
+@pytest.mark.parametrize("kwargs", [dict(), dict(onset_mode="mel", n_bands=16)])
+def test_no_net_growth_in_the_hop_loop(kwargs):
+    sr, hop, settle, n = 44100, 3 * 512, 2, 300
+    frames = hops(make_audio((settle + n) * hop / sr + 1, sr), hop)[: settle + n]
+    analyser = PreallocatedAnalyser(sr=sr, hop_length=512, **kwargs)
+    analyser.warmup()
+    growth, peaks = trace(analyser, frames[:settle], frames[settle:])
+    # more than 256 hops, so a per hop counter would show up too
+    assert not growth.any(), f"{int(growth.max())} bytes left allocated"
+
+
+def test_warmup_compiles_the_peak_picker(monkeypatch):
+    from music_analyser import preallocated, warmup
+
+    # compile afresh, an earlier test may have done it already
+    monkeypatch.setattr(preallocated, "_peak_pick", None)
+    warmup.warmup()
+    assert preallocated._peak_pick.signatures
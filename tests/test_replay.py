@@ -0,0 +1,24 @@
+import contextlib
+import io
+
+from controller.replay import make_server, replay
+
+
+def set_mode(tempo):
+    return {"type": "set_mode", "mode": "rainbow", "tempo": tempo, "base_color": [10, 20, 30]}
+
+
+def test_events_between_two_ticks_are_coalesced():
+    # a burst well inside one 10 ms tick, then one event a tick later
+    events = [(0.0, set_mode(100.0))]
+    events += [(0.0001 * k, set_mode(100.0 + k)) for k in range(1, 20)]
+    events += [(0.015, set_mode(140.0))]
+    with contextlib.redirect_stdout(io.StringIO()):
+        server, _ = make_server("light", 60)
+        replay(events, server, fast=True)
+        server.handle_stop()
+    counts = server.inbox.counts
+    assert counts["received"] == 21
+    # the first event has a tick of its own, the rest of the burst shares one
+    assert counts["coalesced"] == 18
+    assert counts["applied"] == 3
@@ -0,0 +1,40 @@
+import numpy as np
+
+from controller.backends import FakeSpi
+from controller.light_controller import Color, PixelStrip
+
+
+def per_bit_spi_data(r, g, b):
+    """The encoder the lookup table replaced."""
+    r, g, b = int(r), int(g), int(b)
+    data = []
+    for color in [g, r, b]:  # WS2812 expects GRB order
+        for i in range(8):
+            if color & (1 << (7 - i)):
+                data.append(0b11111000)  # 1 bit
+            else:
+                data.append(0b11000000)  # 0 bit
+    return data
+
+
+def test_lut_matches_per_bit_encoder_for_every_byte():
+    strip = PixelStrip(LED_COUNT=1, spi=FakeSpi())
+    for value in range(256):
+        for rgb in [(value, 0, 0), (0, value, 0), (0, 0, value), (value, 255 - value, value)]:
+            assert strip.rgb_to_spi_data(*rgb) == per_bit_spi_data(*rgb)
+
+
+def test_show_matches_per_bit_encoder_with_brightness():
+    rng = np.random.default_rng(0)
+    spi = FakeSpi()
+    strip = PixelStrip(LED_COUNT=50, spi=spi)
+    colors = [Color(*rng.integers(0, 256, 3)) for _ in range(50)]
+    for n, color in enumerate(colors):
+        strip.setPixelColor(n, color)
+    for brightness in [255, 200, 77, 1, 0]:
+        strip.setBrightness(brightness)
+        strip.show()
+        # the old show() scaled the float color by Brightness / 255 per pixel
+        k = brightness / 255
+        expected = sum((per_bit_spi_data(c.r * k, c.g * k, c.b * k) for c in colors), [])
+        assert spi.last_data == expected
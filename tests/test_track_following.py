@@ -0,0 +1,33 @@
+import numpy as np
+
+from music_analyser import MusicAnalyser
+from test_degradation import noise_hops
+
+
+class RecognisedTrack:
+    """A TrackCache that always follows the same track, without beats."""
+
+    track = "track"
+    position = 0.0
+    timeline = {"tempo": 120.0}
+
+    def update(self, frame):
+        return False
+
+    def beats_between(self, start, end):
+        return np.zeros(0)
+
+    def sections_between(self, start, end):
+        return np.zeros(0)
+
+
+def test_following_a_track_keeps_streaming_bands():
+    hops = noise_hops(30, 1536)
+    following = MusicAnalyser(n_bands=8, track_cache=RecognisedTrack())
+    detecting = MusicAnalyser(n_bands=8)
+    for hop in hops:
+        followed = following.analyze(hop)
+        detected = detecting.analyze(hop)
+    assert followed["bands"] is not None
+    assert followed["bands"].shape == (8,)
+    np.testing.assert_allclose(followed["bands"], detected["bands"], atol=1e-3)